@@ -1,247 +1,3167 @@
+from abc import ABC, abstractmethod
 from http.server import BaseHTTPRequestHandler
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+import calendar
+import csv
+import heapq
+import http.client
+import io
 import json
+import os
+import random
 import sqlite3
 import re
-from datetime import datetime
+import signal
+import tempfile
+import threading
+import time
+import urllib.parse
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from queue import Full, Queue
 
-class DatabaseManager:
+# Используем постоянное хранилище Vercel; путь можно переопределить
+# для самостоятельного хостинга и бенчмарков
+DB_PATH = os.environ.get('PODPISCONTROL_DB', '/tmp/podpiscontrol.db')
+
+# Каталог сжатых снимков БД (например, подключенный том). /tmp теряется
+# при пересоздании инстанса; без каталога снимки не создаются
+SNAPSHOT_DIR = os.environ.get('PODPISCONTROL_SNAPSHOT_DIR')
+
+# Миграции схемы: (версия, список SQL-выражений или функций от курсора).
+# Текущая версия хранится в PRAGMA user_version, применяются только
+# шаги с версией выше сохраненной
+MIGRATIONS = [
+    (1, [
+        # Основная таблица подписок
+        '''
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                service_name TEXT NOT NULL,
+                price DECIMAL(10,2) NOT NULL,
+                charge_day INTEGER NOT NULL CHECK(charge_day BETWEEN 1 AND 31),
+                end_date TEXT,
+                is_active BOOLEAN DEFAULT TRUE,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        # Таблица для статистики и аналитики
+        '''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                total_saved DECIMAL(10,2) DEFAULT 0,
+                subscriptions_cancelled INTEGER DEFAULT 0,
+                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        # Индексы для ускорения запросов
+        'CREATE INDEX IF NOT EXISTS idx_user_subscriptions ON subscriptions(user_id, is_active)',
+        'CREATE INDEX IF NOT EXISTS idx_user_created ON subscriptions(created_date)',
+    ]),
+    (2, [
+        # Сессии мастера добавления подписки, переживающие перезапуск инстанса
+        '''
+            CREATE TABLE IF NOT EXISTS user_sessions (
+                chat_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_updated ON user_sessions(updated_at)',
+    ]),
+    (3, [
+        # Агрегаты пользователя поддерживаются при каждой записи,
+        # поэтому статистика читается одним запросом по первичному ключу
+        "ALTER TABLE subscriptions ADD COLUMN category TEXT NOT NULL DEFAULT 'другое'",
+        'ALTER TABLE user_stats ADD COLUMN active_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE user_stats ADD COLUMN monthly_total DECIMAL(10,2) NOT NULL DEFAULT 0',
+        'ALTER TABLE user_stats ADD COLUMN cancelled_count INTEGER NOT NULL DEFAULT 0',
+        "ALTER TABLE user_stats ADD COLUMN category_totals TEXT NOT NULL DEFAULT '{}'",
+        lambda cursor: _backfill_user_stats(cursor),
+    ]),
+    (4, [
+        # Индексы для поиска подписок по дню списания и дате окончания
+        # во всей базе (напоминания), без полного сканирования таблицы
+        'CREATE INDEX IF NOT EXISTS idx_active_charge_day ON subscriptions(is_active, charge_day)',
+        'CREATE INDEX IF NOT EXISTS idx_active_end_date ON subscriptions(is_active, end_date)',
+    ]),
+    (5, [
+        # Даты окончания хранятся в ISO-формате (YYYY-MM-DD): строки
+        # сравниваются как даты, и диапазоны читаются по индексу
+        lambda cursor: _backfill_iso_end_dates(cursor),
+        'DROP INDEX IF EXISTS idx_active_end_date',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_active_end_date
+            ON subscriptions(is_active, end_date, user_id, service_name, price, charge_day)
+        ''',
+    ]),
+    (6, [
+        # Служебное состояние бота (например, offset для getUpdates)
+        '''
+            CREATE TABLE IF NOT EXISTS bot_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        ''',
+    ]),
+    (7, [
+        # Уже обработанные update_id: Telegram повторяет доставку вебхука,
+        # если ответ задержался
+        '''
+            CREATE TABLE IF NOT EXISTS processed_updates (
+                update_id INTEGER PRIMARY KEY,
+                seen_at REAL NOT NULL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_processed_updates_seen ON processed_updates(seen_at)',
+    ]),
+    (8, [
+        # Деньги хранятся целыми копейками: суммы считаются без ошибок
+        # округления float. Агрегаты пересчитываются в копейках, а категории
+        # подписок заполняются по названию или синониму из каталога
+        'UPDATE subscriptions SET price = CAST(ROUND(price * 100) AS INTEGER)',
+        'UPDATE user_stats SET total_saved = CAST(ROUND(total_saved * 100) AS INTEGER)',
+        lambda cursor: _backfill_user_stats(cursor),
+    ]),
+    (9, [
+        # Журнал изменений подписок: только добавление, пишется в той же
+        # транзакции, что и само изменение
+        '''
+            CREATE TABLE IF NOT EXISTS subscription_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                subscription_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                service_name TEXT NOT NULL,
+                category TEXT NOT NULL,
+                price INTEGER NOT NULL,
+                old_price INTEGER,
+                created_at TEXT NOT NULL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_events_user ON subscription_events(user_id, id)',
+        # Помесячная сводка пользователя, обновляемая по каждому событию:
+        # сумма активных и отмененных подписок на конец месяца и сумма
+        # подписок, подключенных за месяц (копейки)
+        '''
+            CREATE TABLE IF NOT EXISTS monthly_spend (
+                user_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                active_total INTEGER NOT NULL DEFAULT 0,
+                added INTEGER NOT NULL DEFAULT 0,
+                cancelled_total INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, month)
+            ) WITHOUT ROWID
+        ''',
+        # Экономия от отмен копится помесячно: total_saved учтен по месяц
+        # saved_through включительно, дальше - cancelled_monthly в месяц
+        'ALTER TABLE user_stats ADD COLUMN cancelled_monthly INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE user_stats ADD COLUMN saved_through TEXT',
+        lambda cursor: _backfill_subscription_events(cursor),
+    ]),
+    (10, [
+        # Аналитика читает изменения по журналу событий, а не по
+        # updated_date: индекс, созданный прежней версией миграции 8,
+        # только замедляет каждую запись
+        'DROP INDEX IF EXISTS idx_updated_date',
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Категория подписок вне каталога
+DEFAULT_CATEGORY = 'другое'
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, выделенными заранее"""
+    
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+    
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+    
+    def render(self, name, labels):
+        """Строки в текстовом формате Prometheus (корзины накопительные)"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class Metrics:
+    """Реестр метрик процесса.
+    
+    Гистограммы маршрутов создаются при сборке маршрутизатора, поэтому на
+    горячем пути выполняется только поиск в словаре и инкремент счетчиков.
+    """
+    
     def __init__(self):
-        # Используем постоянное хранилище Vercel
-        self.db_path = '/tmp/podpiscontrol.db'
-        self._init_db()
+        self.routes = {}
+        self.db_methods = {}
+        self.db_rows = {}
+        self.errors = {}
+        self.updates = Histogram()
+        self.slow_updates = 0
+        # Порог медленного обновления для счетчика slow_updates, секунды
+        self.slow_threshold = float(os.environ.get('PODPISCONTROL_SLOW_MS', 500)) / 1000
     
-    def _init_db(self):
-        """Инициализация базы данных с улучшенной структурой"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+    def route_histogram(self, name):
+        histogram = self.routes.get(name)
+        if histogram is None:
+            histogram = self.routes[name] = Histogram()
+        return histogram
+    
+    def observe_route(self, name, seconds):
+        (self.routes.get(name) or self.route_histogram(name)).observe(seconds)
+    
+    def observe_update(self, seconds):
+        self.updates.observe(seconds)
+        if seconds >= self.slow_threshold:
+            self.slow_updates += 1
+    
+    def observe_db(self, method, seconds, rows):
+        histogram = self.db_methods.get(method)
+        if histogram is None:
+            histogram = self.db_methods[method] = Histogram()
+            self.db_rows[method] = 0
+        histogram.observe(seconds)
+        self.db_rows[method] += rows
+    
+    def error(self, source):
+        self.errors[source] = self.errors.get(source, 0) + 1
+    
+    def render(self, processor=None):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = ['# TYPE podpis_update_latency_seconds histogram']
+        lines.extend(self.updates.render('podpis_update_latency_seconds', 'kind="all"'))
+        lines.append('# TYPE podpis_slow_updates_total counter')
+        lines.append(f'podpis_slow_updates_total {self.slow_updates}')
+        
+        lines.append('# TYPE podpis_route_latency_seconds histogram')
+        for name, histogram in sorted(self.routes.items()):
+            lines.extend(histogram.render('podpis_route_latency_seconds', f'route="{name}"'))
+        
+        lines.append('# TYPE podpis_db_latency_seconds histogram')
+        for method, histogram in sorted(self.db_methods.items()):
+            lines.extend(histogram.render('podpis_db_latency_seconds', f'method="{method}"'))
+        lines.append('# TYPE podpis_db_rows_total counter')
+        lines.extend(f'podpis_db_rows_total{{method="{method}"}} {rows}' for method, rows in sorted(self.db_rows.items()))
+        
+        lines.append('# TYPE podpis_errors_total counter')
+        lines.extend(f'podpis_errors_total{{source="{source}"}} {count}' for source, count in sorted(self.errors.items()))
+        
+        if processor is not None:
+            lines.append('# TYPE podpis_route_hits_total counter')
+            lines.extend(
+                f'podpis_route_hits_total{{route="{name}"}} {count}'
+                for name, count in sorted(processor.router.hits.items())
+            )
             
-            # Основная таблица подписок
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    service_name TEXT NOT NULL,
-                    price DECIMAL(10,2) NOT NULL,
-                    charge_day INTEGER NOT NULL CHECK(charge_day BETWEEN 1 AND 31),
-                    end_date TEXT,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            cache = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+            batches = operations = 0
+            for shard in processor.db.shards:
+                for key, value in shard.cache.stats().items():
+                    if key in cache:
+                        cache[key] += value
+                batches += shard.writer.batches
+                operations += shard.writer.operations
+            for key, value in cache.items():
+                lines.append(f'# TYPE podpis_cache_{key}_total counter')
+                lines.append(f'podpis_cache_{key}_total {value}')
             
-            # Таблица для статистики и аналитики
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_stats (
-                    user_id INTEGER PRIMARY KEY,
-                    total_saved DECIMAL(10,2) DEFAULT 0,
-                    subscriptions_cancelled INTEGER DEFAULT 0,
-                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            lines.append('# TYPE podpis_write_batches_total counter')
+            lines.append(f'podpis_write_batches_total {batches}')
+            lines.append('# TYPE podpis_write_operations_total counter')
+            lines.append(f'podpis_write_operations_total {operations}')
+            lines.append('# TYPE podpis_duplicate_updates_total counter')
+            lines.append(f'podpis_duplicate_updates_total {processor.deduplicator.duplicates}')
+            limiter = processor.limiter.stats()
+            lines.append('# TYPE podpis_rate_limited_total counter')
+            lines.append(f'podpis_rate_limited_total {limiter["rejected_rate"]}')
+            lines.append('# TYPE podpis_overloaded_total counter')
+            lines.append(f'podpis_overloaded_total {limiter["rejected_overload"]}')
+            keyboards = processor.keyboards.stats()
+            lines.append('# TYPE podpis_keyboards_omitted_total counter')
+            lines.append(f'podpis_keyboards_omitted_total {keyboards["omitted"]}')
+            lines.append('# TYPE podpis_edits_skipped_total counter')
+            lines.append(f'podpis_edits_skipped_total {keyboards["skipped_edits"]}')
+            lines.append('# TYPE podpis_outbound_bytes_saved_total counter')
+            lines.append(f'podpis_outbound_bytes_saved_total {keyboards["saved_bytes"]}')
+        
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def log_error(message, error):
+    """Вывод ошибки в лог с учетом в метриках"""
+    print(f'{message}: {error}')
+    metrics.error(message)
+
+def timed(method):
+    """Замер времени и числа строк метода DatabaseManager"""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            if isinstance(result, list):
+                rows = len(result)
+            elif isinstance(result, tuple):
+                rows = 1 if result[0] else 0
+            else:
+                rows = 1
+            metrics.observe_db(method, time.perf_counter() - started, rows)
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+class SlowUpdateProfiler:
+    """Выборочное профилирование медленных обновлений.
+    
+    Включается переменной PODPISCONTROL_PROFILE_SLOW_MS (порог, мс); доля
+    профилируемых обновлений - PODPISCONTROL_PROFILE_SAMPLE. Отчеты cProfile
+    по обновлениям медленнее порога пишутся в лог и хранятся в reports.
+    """
+    
+    def __init__(self, threshold_ms=None, sample_rate=None, keep=20):
+        if threshold_ms is None and os.environ.get('PODPISCONTROL_PROFILE_SLOW_MS'):
+            threshold_ms = float(os.environ['PODPISCONTROL_PROFILE_SLOW_MS'])
+        if sample_rate is None:
+            sample_rate = float(os.environ.get('PODPISCONTROL_PROFILE_SAMPLE', 0.01))
+        self.enabled = threshold_ms is not None
+        self.threshold = (threshold_ms or 0) / 1000
+        self.sample_rate = sample_rate
+        self.reports = deque(maxlen=keep)
+    
+    def run(self, func, *args):
+        if not self.enabled or random.random() >= self.sample_rate:
+            return func(*args)
+        
+        # Профилировщик нужен редко: не платим за его импорт при холодном старте
+        import cProfile, io, pstats
+        
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        result = profiler.runcall(func, *args)
+        elapsed = time.perf_counter() - started
+        if elapsed >= self.threshold:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(15)
+            self.reports.append((time.time(), elapsed, stream.getvalue()))
+            print(f'Медленное обновление: {elapsed * 1000:.1f} мс\n{stream.getvalue()}')
+        return result
+
+def _backfill_user_stats(cursor):
+    """Заполнение категорий и агрегатов user_stats по существующим подпискам"""
+    cursor.execute('SELECT DISTINCT service_name FROM subscriptions WHERE category = ?', (DEFAULT_CATEGORY,))
+    cursor.executemany(
+        'UPDATE subscriptions SET category = ? WHERE service_name = ?',
+        [
+            (category, name)
+            for name, category in ((name, CATALOG.category_of(name)) for (name,) in cursor.fetchall())
+            if category != DEFAULT_CATEGORY
+        ]
+    )
+    _recompute_user_stats(cursor)
+
+def _recompute_user_stats(cursor, condition='1', params=()):
+    """Пересчет агрегатов user_stats для владельцев строк subscriptions, подходящих под condition"""
+    users = f'SELECT user_id FROM subscriptions WHERE {condition}'
+    cursor.execute(f'INSERT OR IGNORE INTO user_stats (user_id) SELECT DISTINCT user_id FROM subscriptions WHERE {condition}', params)
+    # Агрегаты считаются одной группировкой: коррелированные подзапросы
+    # на каждого пользователя планировщик может выполнить полным сканированием
+    cursor.execute(f'''
+        SELECT user_id,
+               SUM(is_active = TRUE),
+               SUM(CASE WHEN is_active = TRUE THEN price ELSE 0 END),
+               SUM(is_active = FALSE)
+        FROM subscriptions WHERE user_id IN ({users}) GROUP BY user_id
+    ''', params)
+    cursor.executemany(
+        'UPDATE user_stats SET active_count = ?, monthly_total = ?, cancelled_count = ? WHERE user_id = ?',
+        [(active, total, cancelled, user_id) for user_id, active, total, cancelled in cursor.fetchall()]
+    )
+    
+    category_totals = {}
+    cursor.execute(f'''
+        SELECT user_id, category, SUM(price) FROM subscriptions
+        WHERE is_active = TRUE AND user_id IN ({users}) GROUP BY user_id, category
+    ''', params)
+    for user_id, category, total in cursor.fetchall():
+        category_totals.setdefault(user_id, {})[category] = total
+    cursor.executemany(
+        'UPDATE user_stats SET category_totals = ? WHERE user_id = ?',
+        [(json.dumps(totals, ensure_ascii=False), user_id) for user_id, totals in category_totals.items()]
+    )
+
+# Виды событий журнала подписок
+EVENT_ADD = 'add'
+EVENT_REACTIVATE = 'reactivate'
+EVENT_PRICE_CHANGE = 'price_change'
+EVENT_CANCEL = 'cancel'
+
+def current_month():
+    """Текущий месяц 'YYYY-MM' по UTC, как CURRENT_TIMESTAMP в SQLite"""
+    return time.strftime('%Y-%m', time.gmtime())
+
+def _month_number(month):
+    return int(month[:4]) * 12 + int(month[5:7]) - 1
+
+def _month_name(number):
+    return f'{number // 12:04d}-{number % 12 + 1:02d}'
+
+def record_subscription_event(cursor, subscription_id, user_id, kind, service_name, category,
+                              price, old_price=None, created_at=None):
+    """Запись события и обновление помесячной сводки в текущей транзакции.
+    
+    Для отмены price - цена отменяемой подписки; для реактивации old_price -
+    цена, по которой подписка была отменена.
+    """
+    created_at = created_at or time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    month = created_at[:7]
+    cursor.execute('''
+        INSERT INTO subscription_events
+            (subscription_id, user_id, kind, service_name, category, price, old_price, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (subscription_id, user_id, kind, service_name, category, price, old_price, created_at))
+    
+    if kind == EVENT_ADD:
+        active_delta, added, cancelled_delta = price, price, 0
+    elif kind == EVENT_REACTIVATE:
+        active_delta, added, cancelled_delta = price, price, -(old_price or 0)
+    elif kind == EVENT_PRICE_CHANGE:
+        active_delta, added, cancelled_delta = price - old_price, max(price - old_price, 0), 0
+    else:
+        active_delta, added, cancelled_delta = -price, 0, price
+    roll_spend_month(cursor, user_id, month, active_delta, added, cancelled_delta)
+
+def roll_spend_month(cursor, user_id, month, active_delta, added, cancelled_delta):
+    """Применение изменений сумм (копейки) к помесячной сводке и экономии пользователя"""
+    # Экономия за месяцы с прошлого события начисляется по прежней сумме отмен
+    cursor.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
+    cursor.execute('SELECT cancelled_monthly, saved_through FROM user_stats WHERE user_id = ?', (user_id,))
+    cancelled_monthly, saved_through = cursor.fetchone()
+    accrued = cancelled_monthly * max(_month_number(month) - _month_number(saved_through), 0) if saved_through else 0
+    cursor.execute('''
+        UPDATE user_stats SET
+            total_saved = total_saved + ?,
+            saved_through = ?,
+            cancelled_monthly = cancelled_monthly + ?
+        WHERE user_id = ?
+    ''', (accrued, month, cancelled_delta, user_id))
+    
+    # Сводка месяца начинается с итогов последнего месяца с событиями
+    cursor.execute('''
+        SELECT active_total, cancelled_total FROM monthly_spend
+        WHERE user_id = ? AND month <= ? ORDER BY month DESC LIMIT 1
+    ''', (user_id, month))
+    active_total, cancelled_total = cursor.fetchone() or (0, 0)
+    cursor.execute('''
+        INSERT INTO monthly_spend (user_id, month, active_total, added, cancelled_total)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, month) DO UPDATE SET
+            active_total = excluded.active_total,
+            added = added + excluded.added,
+            cancelled_total = excluded.cancelled_total
+    ''', (user_id, month, active_total + active_delta, added, cancelled_total + cancelled_delta))
+
+def _backfill_subscription_events(cursor):
+    """Восстановление журнала по текущим строкам: подключение в created_date,
+    отмена в updated_date (промежуточные реактивации не восстановить)"""
+    cursor.execute('''
+        SELECT id, user_id, service_name, category, price, is_active, created_date, updated_date
+        FROM subscriptions
+    ''')
+    events = []
+    for sub_id, user_id, name, category, price, is_active, created, updated in cursor.fetchall():
+        events.append((str(created), sub_id, user_id, EVENT_ADD, name, category, price))
+        if not is_active:
+            events.append((str(updated or created), sub_id, user_id, EVENT_CANCEL, name, category, price))
+    events.sort(key=lambda event: (event[2], event[0], event[3] == EVENT_CANCEL))
+    for created_at, sub_id, user_id, kind, name, category, price in events:
+        record_subscription_event(cursor, sub_id, user_id, kind, name, category, price, created_at=created_at)
+
+def to_kopecks(value):
+    """Сумма в рублях ('149.50', '149,5', 149) -> целые копейки; ValueError при ошибке"""
+    try:
+        amount = Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f'Неверная сумма: {value}')
+    if not amount.is_finite():
+        raise ValueError(f'Неверная сумма: {value}')
+    return int((amount * 100).quantize(Decimal(1)))
+
+def format_rub(kopecks):
+    """Копейки -> строка в рублях: 19900 -> '199', 14950 -> '149.50'"""
+    rubles, rest = divmod(abs(kopecks), 100)
+    sign = '-' if kopecks < 0 else ''
+    return f'{sign}{rubles}.{rest:02d}' if rest else f'{sign}{rubles}'
+
+def parse_end_date(value, default_year):
+    """Разбор даты окончания 'ДД.ММ' или 'ДД.ММ.ГГ' в date; None при ошибке"""
+    parts = value.split('.')
+    try:
+        if len(parts) == 2:
+            return date(default_year, int(parts[1]), int(parts[0]))
+        if len(parts) == 3 and len(parts[2]) == 2:
+            return date(2000 + int(parts[2]), int(parts[1]), int(parts[0]))
+    except ValueError:
+        pass
+    return None
+
+def format_end_date(value):
+    """Отображение сохраненной даты окончания в виде ДД.ММ.ГГГГ"""
+    try:
+        return date.fromisoformat(value).strftime('%d.%m.%Y')
+    except (TypeError, ValueError):
+        return value
+
+def _backfill_iso_end_dates(cursor):
+    """Перевод end_date из 'ДД.ММ'/'ДД.ММ.ГГ' в ISO; год без указания - год создания.
+    
+    Неразобранная дата остается как есть (и выводится в лог): пользователь
+    видит введенное значение, а не теряет дату окончания.
+    """
+    cursor.execute("SELECT id, end_date, created_date FROM subscriptions WHERE end_date IS NOT NULL AND end_date <> ''")
+    updates = []
+    unparsed = []
+    for sub_id, end_date, created_date in cursor.fetchall():
+        try:
+            created_year = int(str(created_date)[:4])
+        except ValueError:
+            created_year = datetime.now().year
+        parsed = parse_end_date(end_date, created_year)
+        if parsed is not None:
+            updates.append((parsed.isoformat(), sub_id))
+        elif not ISO_DATE_RE.match(end_date):
+            unparsed.append(f'{sub_id}={end_date!r}')
+    cursor.executemany('UPDATE subscriptions SET end_date = ? WHERE id = ?', updates)
+    if unparsed:
+        print(f"Даты окончания не в формате ДД.ММ, оставлены без изменений ({len(unparsed)}): {', '.join(unparsed[:20])}")
+
+class UserCache:
+    """Ограниченный LRU-кэш чтений по user_id.
+    
+    Хранит активные подписки и агрегаты пользователя; записи сбрасываются
+    при каждом изменении подписок этого пользователя. TTL ограничивает
+    устаревание, если запись прошла через другой инстанс.
+    
+    Сброс идет после фиксации записи и может попасть между чтением из БД и
+    put. Поэтому чтение берет метку (mark) до запроса, а put с меткой не
+    сохраняет значение, если пользователя сбросили после нее. Номера
+    последних сбросов хранятся для capacity пользователей; для вытесненных
+    действует номер самого свежего вытесненного сброса (floor).
+    """
+    
+    def __init__(self, capacity=2048, ttl=60.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Счетчик сбросов и номер последнего сброса по пользователю
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, user_id, key):
+        """Значение из кэша или None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    value = entry[1].get(key)
+                    if value is not None:
+                        self._entries.move_to_end(user_id)
+                        self.hits += 1
+                        return value
+                else:
+                    del self._entries[user_id]
+            self.misses += 1
+            return None
+    
+    def mark(self):
+        """Метка для put, снимаемая до чтения из БД"""
+        with self._lock:
+            return self._generation
+    
+    def put(self, user_id, key, value, mark=None):
+        with self._lock:
+            if mark is not None and self._invalidated.get(user_id, self._floor) > mark:
+                # Прочитанное могло устареть: пользователя сбросили после чтения
+                return
+            entry = self._entries.get(user_id)
+            if entry is None:
+                entry = (time.monotonic() + self.ttl, {})
+                self._entries[user_id] = entry
+            else:
+                self._entries.move_to_end(user_id)
+            entry[1][key] = value
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._invalidated[user_id] = self._generation
+            self._invalidated.move_to_end(user_id)
+            if len(self._invalidated) > self.capacity:
+                self._floor = self._invalidated.popitem(last=False)[1]
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+    
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._invalidated.clear()
+            self._floor = self._generation
+            self._entries.clear()
+    
+    def stats(self):
+        """Счетчики кэша"""
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+class WriteBatcher:
+    """Групповая фиксация записей (group commit).
+    
+    Операции из разных потоков ставятся в очередь, а фоновый поток выполняет
+    накопившиеся операции в одной транзакции, каждую в своей точке сохранения.
+    Пока идет одна фиксация, следующие операции копятся для следующей, поэтому
+    одиночная запись не ждет, а под нагрузкой fsync делится на весь пакет.
+    linger позволяет дополнительно подождать попутные операции.
+    """
+    
+    def __init__(self, db, max_batch=128, linger=0.0):
+        self.db = db
+        self.max_batch = max_batch
+        self.linger = linger
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self.batches = 0
+        self.operations = 0
+    
+    def submit(self, func, *args):
+        """Постановка операции в очередь; возвращает Future с ее результатом"""
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('WriteBatcher закрыт')
+            self._pending.append((future, func, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='podpis-writer', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+    
+    def execute(self, func, *args):
+        """Выполнение операции в ближайшей групповой транзакции с ожиданием результата"""
+        # Внутри уже открытой транзакции этого потока (например, пакет long polling)
+        # фоновый поток не получит блокировку БД - выполняем сразу
+        if self.db.in_transaction():
+            return func(*args)
+        return self.submit(func, *args).result()
+    
+    def _take_batch(self):
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if self.linger and len(self._pending) < self.max_batch:
+                self._condition.wait(self.linger)
+            batch = []
+            while self._pending and len(batch) < self.max_batch:
+                batch.append(self._pending.popleft())
+            return batch
+    
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
             
-            # Индексы для ускорения запросов
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_subscriptions ON subscriptions(user_id, is_active)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_created ON subscriptions(created_date)')
+            results = []
+            try:
+                with self.db.transaction():
+                    for future, func, args in batch:
+                        try:
+                            with self.db.transaction():
+                                results.append((future, func(*args), None))
+                        except Exception as e:
+                            results.append((future, None, e))
+            except Exception as e:
+                # Не удалось зафиксировать пакет - ошибка у каждого участника
+                for future, _, _ in batch:
+                    future.set_exception(e)
+                continue
             
-            conn.commit()
-            conn.close()
-            print("База данных инициализирована с улучшенной структурой")
-        except Exception as e:
-            print(f"Ошибка инициализации БД: {e}")
+            self.batches += 1
+            self.operations += len(batch)
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+    
+    def close(self):
+        """Остановка фонового потока после выполнения очереди"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+class SnapshotStore:
+    """Сжатые снимки файлов SQLite через online backup API.
     
-    def add_subscription(self, user_id, service_name, price, charge_day, end_date=None):
-        """Добавление подписки с улучшенной логикой"""
+    Копия снимается с общего соединения шарда шагами по PAGES страниц с
+    паузой между ними. Блокировка чтения держится только на время шага, а
+    записи через то же соединение сразу попадают в копию, поэтому backup не
+    перезапускается и не задерживает запросы. Для каждого файла хранятся
+    последние keep снимков; при холодном старте без файла БД
+    восстанавливается самый новый целый снимок.
+    """
+    
+    PAGES = 256
+    COMPRESS_LEVEL = 6
+    SUFFIX = '.gz'
+    
+    def __init__(self, directory, keep=5, interval=300.0, pause=0.002):
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+        # Пауза между шагами копирования, секунды
+        self.pause = pause
+        self.last = None
+        self._lock = threading.Lock()
+        self._watched = {}
+        self._thread = None
+    
+    @classmethod
+    def from_env(cls):
+        """Хранилище из PODPISCONTROL_SNAPSHOT_*; None, если каталог не задан"""
+        if not SNAPSHOT_DIR:
+            return None
+        return cls(
+            SNAPSHOT_DIR,
+            keep=int(os.environ.get('PODPISCONTROL_SNAPSHOT_KEEP', 5)),
+            interval=float(os.environ.get('PODPISCONTROL_SNAPSHOT_INTERVAL', 300))
+        )
+    
+    def snapshots(self, db_path):
+        """Пути снимков файла БД, от новых к старым"""
+        prefix = os.path.basename(db_path) + '.'
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        stamps = sorted(
+            (int(name[len(prefix):-len(self.SUFFIX)]), name)
+            for name in names
+            if name.startswith(prefix) and name.endswith(self.SUFFIX)
+            and name[len(prefix):-len(self.SUFFIX)].isdigit()
+        )
+        return [os.path.join(self.directory, name) for _, name in reversed(stamps)]
+    
+    def save(self, db):
+        """Снимок шарда db; возвращает путь к файлу снимка"""
+        import gzip
+        import shutil
+        
+        # Соединение открывается до блокировки: первое открытие вызывает watch()
+        conn = db._get_connection()
+        with self._lock:
+            started = time.perf_counter()
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.basename(db.db_path)
+            temp = os.path.join(self.directory, f'.{base}.backup')
+            if os.path.exists(temp):
+                os.remove(temp)
             
-            # Проверяем существующую подписку
-            cursor.execute('''
-                SELECT id, is_active FROM subscriptions 
-                WHERE user_id = ? AND service_name = ? 
-                ORDER BY created_date DESC LIMIT 1
-            ''', (user_id, service_name))
+            changes = conn.total_changes
+            target = sqlite3.connect(temp)
+            try:
+                # Шаг во время транзакции записи на том же соединении получает
+                # SQLITE_LOCKED и повторяется через sleep секунд
+                conn.backup(target, pages=self.PAGES, progress=self._pause, sleep=0.01)
+                pages = target.execute('PRAGMA page_count').fetchone()[0]
+            finally:
+                target.close()
+            copied = time.perf_counter()
             
-            existing = cursor.fetchone()
+            # Снимок появляется под итоговым именем только целиком
+            path = os.path.join(self.directory, f'{base}.{time.time_ns()}{self.SUFFIX}')
+            with open(temp, 'rb') as src, gzip.open(path + '.part', 'wb', compresslevel=self.COMPRESS_LEVEL) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(path + '.part', path)
+            os.remove(temp)
             
-            if existing:
-                sub_id, is_active = existing
-                if is_active:
-                    conn.close()
-                    return False, "Эта подписка уже активна"
+            for old in self.snapshots(db.db_path)[self.keep:]:
+                os.remove(old)
+            
+            finished = time.perf_counter()
+            self._watched[db] = changes
+            self.last = {
+                'path': path,
+                'pages': pages,
+                'bytes': os.path.getsize(path),
+                'backup_ms': round((copied - started) * 1000, 2),
+                'compress_ms': round((finished - copied) * 1000, 2),
+            }
+            metrics.observe_db('snapshot_save', finished - started, pages)
+            return path
+    
+    def _pause(self, status, remaining, total):
+        time.sleep(self.pause)
+    
+    def restore(self, db_path):
+        """Восстановление db_path из самого нового целого снимка; True при успехе"""
+        import gzip
+        import shutil
+        
+        for path in self.snapshots(db_path):
+            started = time.perf_counter()
+            partial = db_path + '.restore'
+            try:
+                # gzip проверяет контрольную сумму в конце файла
+                with gzip.open(path, 'rb') as src, open(partial, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+            except (OSError, EOFError) as e:
+                # Путь - только в тексте лога: сообщение становится меткой метрики
+                log_error('Снимок БД поврежден', f'{os.path.basename(path)}: {e}')
+                if os.path.exists(partial):
+                    os.remove(partial)
+                continue
+            
+            # Журнал WAL от прежнего файла нельзя применять к снимку
+            for leftover in (db_path + '-wal', db_path + '-shm'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            os.replace(partial, db_path)
+            
+            elapsed = time.perf_counter() - started
+            metrics.observe_db('snapshot_restore', elapsed, 0)
+            print(f'БД восстановлена из снимка {os.path.basename(path)} за {elapsed * 1000:.0f} мс')
+            return True
+        return False
+    
+    def watch(self, db):
+        """Периодические снимки шарда в фоновом потоке, если в нем были записи"""
+        with self._lock:
+            self._watched.setdefault(db, None)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='podpis-snapshot', daemon=True)
+                self._thread.start()
+    
+    def flush(self, db):
+        """Снимок шарда, если после прошлого снимка были записи"""
+        if db.is_open and self._watched.get(db) != db._get_connection().total_changes:
+            return self.save(db)
+        return None
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            for db in list(self._watched):
+                try:
+                    self.flush(db)
+                except Exception as e:
+                    log_error('Ошибка создания снимка БД', e)
+
+class SubscriptionStorage(ABC):
+    """Интерфейс хранилища подписок пользователей.
+    
+    Движки: DatabaseManager и ShardedDatabaseManager (SQLite) и MemoryStorage
+    (данные в памяти с отложенной записью в SQLite). Суммы - в копейках.
+    Операции записи возвращают пару (успех, сообщение для пользователя).
+    Движок без какой-либо из операций не создается (TypeError).
+    """
+    
+    @abstractmethod
+    def add_subscription(self, user_id, service_name, price, charge_day, end_date=None, category=DEFAULT_CATEGORY):
+        """Добавление подписки, смена цены активной или возврат отмененной"""
+    
+    @abstractmethod
+    def get_user_subscriptions(self, user_id):
+        """Активные подписки (id, service_name, price, charge_day, end_date, created_date) по названию"""
+    
+    @abstractmethod
+    def get_user_stats(self, user_id):
+        """Агрегаты: active_count, monthly_total, cancelled_count, yearly_total, categories, total_saved"""
+    
+    @abstractmethod
+    def get_spend_history(self, user_id, months=12):
+        """Помесячная сводка расходов за последние months месяцев"""
+    
+    @abstractmethod
+    def delete_subscription(self, user_id, service_name):
+        """Отмена активных подписок с названием"""
+    
+    @abstractmethod
+    def delete_subscription_by_id(self, user_id, subscription_id):
+        """Отмена подписки по id (кнопки inline-клавиатуры)"""
+    
+    def flush(self):
+        """Запись отложенных изменений в SQLite (у SQLite-движков записи синхронные)"""
+    
+    @abstractmethod
+    def invalidate(self, user_id=None):
+        """Сброс прочитанных данных пользователя (или всех) после записи в обход хранилища"""
+    
+    @abstractmethod
+    def close(self):
+        """Завершение работы: запись отложенного и закрытие соединений"""
+
+class DatabaseManager(SubscriptionStorage):
+    """Менеджер БД с одним долгоживущим соединением на процесс"""
+    
+    # WAL позволяет читать параллельно с записью, а synchronous=NORMAL
+    # в режиме WAL убирает fsync на каждый коммит без риска порчи базы
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-8000',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA busy_timeout=5000',
+    )
+    
+    # Размер кэша подготовленных выражений sqlite3
+    STATEMENT_CACHE_SIZE = 128
+    
+    def __init__(self, db_path=DB_PATH, cache=None, snapshots=None):
+        self.db_path = db_path
+        self.cache = cache if cache is not None else UserCache()
+        self.snapshots = snapshots
+        self.writer = WriteBatcher(self)
+        self._lock = threading.RLock()
+        self._conn = None
+        # Поток, открывший внешнюю транзакцию
+        self._transaction_owner = None
+    
+    def _get_connection(self):
+        """Ленивое открытие общего соединения с настройкой PRAGMA.
+        
+        Миграции применяются при первом обращении к БД, а не при импорте:
+        холодный старт со статической командой не открывает SQLite.
+        """
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    # Новый инстанс без файла БД - восстанавливаем последний снимок
+                    if self.snapshots is not None and not os.path.exists(self.db_path):
+                        self.snapshots.restore(self.db_path)
+                    conn = sqlite3.connect(
+                        self.db_path,
+                        check_same_thread=False,
+                        isolation_level=None,
+                        cached_statements=self.STATEMENT_CACHE_SIZE
+                    )
+                    for pragma in self.PRAGMAS:
+                        conn.execute(pragma)
+                    self._conn = conn
+                    self._init_db()
+                    if self.snapshots is not None:
+                        self.snapshots.watch(self)
+        return self._conn
+    
+    @property
+    def is_open(self):
+        """Открыто ли соединение (для диагностики ленивой инициализации)"""
+        return self._conn is not None
+    
+    @contextmanager
+    def read(self):
+        """Курсор для чтения под блокировкой соединения"""
+        with self._lock:
+            cursor = self._get_connection().cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+    
+    @contextmanager
+    def transaction(self):
+        """Транзакция записи.
+        
+        Вложенный вызов становится точкой сохранения (SAVEPOINT) внешней
+        транзакции: ошибка откатывает только его изменения.
+        """
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            if conn.in_transaction:
+                cursor.execute('SAVEPOINT nested')
+                try:
+                    yield cursor
+                except BaseException:
+                    cursor.execute('ROLLBACK TO nested')
+                    cursor.execute('RELEASE nested')
+                    raise
                 else:
+                    cursor.execute('RELEASE nested')
+                finally:
+                    cursor.close()
+                return
+            
+            cursor.execute('BEGIN IMMEDIATE')
+            self._transaction_owner = threading.get_ident()
+            try:
+                yield cursor
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                self._transaction_owner = None
+                cursor.close()
+    
+    def in_transaction(self):
+        """Открыта ли транзакция в текущем потоке"""
+        return self._transaction_owner == threading.get_ident()
+    
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(user_id)
+    
+    def get_state(self, key, default=None):
+        """Значение из таблицы служебного состояния"""
+        with self.read() as cursor:
+            cursor.execute('SELECT value FROM bot_state WHERE key = ?', (key,))
+            row = cursor.fetchone()
+        return row[0] if row else default
+    
+    def set_state(self, key, value):
+        """Сохранение служебного состояния (в текущей транзакции, если она открыта)"""
+        with self.transaction() as cursor:
+            cursor.execute('INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)', (key, str(value)))
+    
+    def close(self):
+        """Закрытие общего соединения (с последним снимком, если были записи)"""
+        self.writer.close()
+        if self.snapshots is not None:
+            try:
+                self.snapshots.flush(self)
+            except Exception as e:
+                log_error('Ошибка создания снимка БД', e)
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def _init_db(self):
+        """Применение недостающих миграций схемы (один раз на процесс)"""
+        try:
+            with self.read() as cursor:
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            
+            if version >= SCHEMA_VERSION:
+                return
+            
+            with self.transaction() as cursor:
+                # Перечитываем версию под блокировкой записи: параллельный
+                # холодный старт мог уже применить миграции
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+                for target, statements in MIGRATIONS:
+                    if target <= version:
+                        continue
+                    for statement in statements:
+                        if callable(statement):
+                            statement(cursor)
+                        else:
+                            cursor.execute(statement)
+                    cursor.execute(f'PRAGMA user_version = {target}')
+                    version = target
+            
+            print(f"Схема БД обновлена до версии {version}")
+        except Exception as e:
+            log_error('Ошибка инициализации БД', e)
+    
+    @timed('add_subscription')
+    def add_subscription(self, user_id, service_name, price, charge_day, end_date=None, category=DEFAULT_CATEGORY):
+        """Добавление подписки с улучшенной логикой (price - в копейках)"""
+        try:
+            return self.writer.execute(
+                self._add_subscription, user_id, service_name, price, charge_day, end_date, category
+            )
+        except Exception as e:
+            log_error('Ошибка добавления подписки', e)
+            return False, "Ошибка при сохранении подписки"
+        finally:
+            self.cache.invalidate(user_id)
+    
+    def _add_subscription(self, user_id, service_name, price, charge_day, end_date, category):
+        try:
+            with self.transaction() as cursor:
+                # Проверяем существующую подписку
+                cursor.execute('''
+                    SELECT id, is_active, price, category FROM subscriptions 
+                    WHERE user_id = ? AND service_name = ? 
+                    ORDER BY created_date DESC LIMIT 1
+                ''', (user_id, service_name))
+                
+                existing = cursor.fetchone()
+                
+                if existing:
+                    sub_id, is_active, old_price, old_category = existing
+                    if is_active:
+                        if old_price == price:
+                            return False, "Эта подписка уже активна"
+                        
+                        # Та же подписка с новой ценой - изменение цены
+                        cursor.execute('''
+                            UPDATE subscriptions SET price = ?, updated_date = CURRENT_TIMESTAMP WHERE id = ?
+                        ''', (price, sub_id))
+                        self._update_user_stats(cursor, user_id, old_category, old_price, active_delta=-1)
+                        self._update_user_stats(cursor, user_id, old_category, price, active_delta=1)
+                        record_subscription_event(
+                            cursor, sub_id, user_id, EVENT_PRICE_CHANGE, service_name, old_category, price, old_price
+                        )
+                        return True, "Цена подписки обновлена"
+                    
                     # Реактивируем удаленную подписку
                     cursor.execute('''
                         UPDATE subscriptions 
-                        SET is_active = TRUE, price = ?, charge_day = ?, end_date = ?, updated_date = CURRENT_TIMESTAMP
+                        SET is_active = TRUE, price = ?, charge_day = ?, end_date = ?, category = ?, updated_date = CURRENT_TIMESTAMP
                         WHERE id = ?
-                    ''', (price, charge_day, end_date, sub_id))
-            else:
-                # Добавляем новую подписку
-                cursor.execute('''
-                    INSERT INTO subscriptions (user_id, service_name, price, charge_day, end_date)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, service_name, price, charge_day, end_date))
+                    ''', (price, charge_day, end_date, category, sub_id))
+                    self._update_user_stats(cursor, user_id, category, price, active_delta=1, cancelled_delta=-1)
+                    record_subscription_event(
+                        cursor, sub_id, user_id, EVENT_REACTIVATE, service_name, category, price, old_price
+                    )
+                else:
+                    # Добавляем новую подписку
+                    cursor.execute('''
+                        INSERT INTO subscriptions (user_id, service_name, price, charge_day, end_date, category)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (user_id, service_name, price, charge_day, end_date, category))
+                    self._update_user_stats(cursor, user_id, category, price, active_delta=1)
+                    record_subscription_event(
+                        cursor, cursor.lastrowid, user_id, EVENT_ADD, service_name, category, price
+                    )
             
-            conn.commit()
-            conn.close()
             return True, "Подписка успешно сохранена"
             
         except Exception as e:
-            print(f"Ошибка добавления подписки: {e}")
+            log_error('Ошибка добавления подписки', e)
             return False, "Ошибка при сохранении подписки"
     
+    @timed('get_user_subscriptions')
     def get_user_subscriptions(self, user_id):
         """Получение подписок с улучшенной логикой"""
+        subscriptions = self.cache.get(user_id, 'subscriptions')
+        if subscriptions is not None:
+            return subscriptions
+        
+        mark = self.cache.mark()
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT service_name, price, charge_day, end_date, created_date
-                FROM subscriptions 
-                WHERE user_id = ? AND is_active = TRUE
-                ORDER BY service_name
-            ''', (user_id,))
+            with self.read() as cursor:
+                cursor.execute('''
+                    SELECT id, service_name, price, charge_day, end_date, created_date
+                    FROM subscriptions 
+                    WHERE user_id = ? AND is_active = TRUE
+                    ORDER BY service_name
+                ''', (user_id,))
+                
+                subscriptions = cursor.fetchall()
             
-            subscriptions = cursor.fetchall()
-            conn.close()
+            self.cache.put(user_id, 'subscriptions', subscriptions, mark)
             return subscriptions
             
         except Exception as e:
-            print(f"Ошибка получения подписок: {e}")
+            log_error('Ошибка получения подписок', e)
             return []
     
+    @timed('get_user_stats')
     def get_user_stats(self, user_id):
-        """Получение статистики пользователя"""
+        """Получение статистики пользователя (одна строка user_stats)"""
+        stats = self.cache.get(user_id, 'stats')
+        if stats is not None:
+            return stats
+        
+        mark = self.cache.mark()
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Общая стоимость активных подписок
-            cursor.execute('''
-                SELECT COUNT(*), COALESCE(SUM(price), 0) 
-                FROM subscriptions 
-                WHERE user_id = ? AND is_active = TRUE
-            ''', (user_id,))
-            
-            count, total = cursor.fetchone()
-            
-            # Количество отмененных подписок
-            cursor.execute('''
-                SELECT COUNT(*) 
-                FROM subscriptions 
-                WHERE user_id = ? AND is_active = FALSE
-            ''', (user_id,))
-            
-            cancelled = cursor.fetchone()[0]
+            with self.read() as cursor:
+                cursor.execute('''
+                    SELECT active_count, monthly_total, cancelled_count, category_totals,
+                           total_saved, cancelled_monthly, saved_through
+                    FROM user_stats
+                    WHERE user_id = ?
+                ''', (user_id,))
+                
+                row = cursor.fetchone()
             
-            conn.close()
+            if row is None:
+                return self._empty_stats()
             
-            return {
+            count, total, cancelled, category_totals, saved, cancelled_monthly, saved_through = row
+            if saved_through:
+                # Экономия за месяцы без событий досчитывается при чтении
+                saved += cancelled_monthly * max(_month_number(current_month()) - _month_number(saved_through), 0)
+            stats = {
                 'active_count': count,
                 'monthly_total': total,
                 'cancelled_count': cancelled,
-                'yearly_total': total * 12
+                'yearly_total': total * 12,
+                'categories': json.loads(category_totals),
+                'total_saved': saved
             }
+            self.cache.put(user_id, 'stats', stats, mark)
+            return stats
             
         except Exception as e:
-            print(f"Ошибка получения статистики: {e}")
-            return {'active_count': 0, 'monthly_total': 0, 'cancelled_count': 0, 'yearly_total': 0}
+            log_error('Ошибка получения статистики', e)
+            return self._empty_stats()
+    
+    @staticmethod
+    def _empty_stats():
+        return {
+            'active_count': 0, 'monthly_total': 0, 'cancelled_count': 0, 'yearly_total': 0,
+            'categories': {}, 'total_saved': 0
+        }
+    
+    @timed('get_spend_history')
+    def get_spend_history(self, user_id, months=12):
+        """Расходы и экономия по месяцам из помесячной сводки (копейки).
+        
+        Расход месяца - сумма активных подписок на его начало плюс
+        подключенные за месяц; экономия - сумма отмененных на его начало.
+        Месяцы без событий наследуют итоги предыдущего месяца.
+        """
+        history = self.cache.get(user_id, 'history')
+        if history is not None and len(history['months']) == months:
+            return history
+        
+        last = _month_number(current_month())
+        first = _month_name(last - months + 1)
+        mark = self.cache.mark()
+        try:
+            with self.read() as cursor:
+                cursor.execute('''
+                    SELECT active_total, cancelled_total FROM monthly_spend
+                    WHERE user_id = ? AND month < ? ORDER BY month DESC LIMIT 1
+                ''', (user_id, first))
+                opening = cursor.fetchone() or (0, 0)
+                cursor.execute('''
+                    SELECT month, active_total, added, cancelled_total FROM monthly_spend
+                    WHERE user_id = ? AND month >= ? ORDER BY month
+                ''', (user_id, first))
+                rows = {month: values for month, *values in cursor.fetchall()}
+        except Exception as e:
+            log_error('Ошибка получения истории расходов', e)
+            return {'months': [], 'total_spend': 0, 'total_saved': 0}
+        
+        result = []
+        active_total, cancelled_total = opening
+        for number in range(last - months + 1, last + 1):
+            month = _month_name(number)
+            row = rows.get(month)
+            result.append({
+                'month': month,
+                'spend': active_total + (row[1] if row else 0),
+                'saved': cancelled_total
+            })
+            if row:
+                active_total, _, cancelled_total = row
+        
+        history = {
+            'months': result,
+            'total_spend': sum(item['spend'] for item in result),
+            'total_saved': sum(item['saved'] for item in result)
+        }
+        self.cache.put(user_id, 'history', history, mark)
+        return history
     
+    def _update_user_stats(self, cursor, user_id, category, price, active_delta=0, cancelled_delta=0):
+        """Применение изменения подписки к агрегатам пользователя в текущей транзакции"""
+        cursor.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
+        cursor.execute('SELECT category_totals FROM user_stats WHERE user_id = ?', (user_id,))
+        category_totals = json.loads(cursor.fetchone()[0])
+        
+        price_delta = price * active_delta
+        category_total = category_totals.get(category, 0) + price_delta
+        if category_total > 0:
+            category_totals[category] = category_total
+        else:
+            category_totals.pop(category, None)
+        
+        cursor.execute('''
+            UPDATE user_stats SET
+                active_count = active_count + ?,
+                monthly_total = monthly_total + ?,
+                cancelled_count = cancelled_count + ?,
+                subscriptions_cancelled = subscriptions_cancelled + ?,
+                category_totals = ?,
+                last_active = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        ''', (
+            active_delta, price_delta, cancelled_delta, max(cancelled_delta, 0),
+            json.dumps(category_totals, ensure_ascii=False), user_id
+        ))
+    
+    @timed('delete_subscription')
     def delete_subscription(self, user_id, service_name):
         """Удаление подписки с сохранением истории"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                UPDATE subscriptions 
-                SET is_active = FALSE, updated_date = CURRENT_TIMESTAMP
-                WHERE user_id = ? AND service_name = ? AND is_active = TRUE
-            ''', (user_id, service_name))
-            
-            affected = cursor.rowcount
-            
-            # Обновляем статистику отмен
-            if affected > 0:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO user_stats (user_id, subscriptions_cancelled, last_active)
-                    VALUES (?, COALESCE((SELECT subscriptions_cancelled FROM user_stats WHERE user_id = ?), 0) + 1, CURRENT_TIMESTAMP)
-                ''', (user_id, user_id))
-            
-            conn.commit()
-            conn.close()
+            return self.writer.execute(self._deactivate_subscriptions, user_id, 'service_name = ?', service_name)
+        except Exception as e:
+            log_error('Ошибка удаления подписки', e)
+            return False, "Ошибка при удалении подписки"
+        finally:
+            self.cache.invalidate(user_id)
+    
+    @timed('delete_subscription_by_id')
+    def delete_subscription_by_id(self, user_id, subscription_id):
+        """Удаление подписки по первичному ключу (кнопки inline-клавиатуры)"""
+        try:
+            return self.writer.execute(self._deactivate_subscriptions, user_id, 'id = ?', subscription_id)
+        except Exception as e:
+            log_error('Ошибка удаления подписки', e)
+            return False, "Ошибка при удалении подписки"
+        finally:
+            self.cache.invalidate(user_id)
+    
+    def _deactivate_subscriptions(self, user_id, condition, value):
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(f'''
+                    SELECT id, price, category, service_name FROM subscriptions
+                    WHERE {condition} AND user_id = ? AND is_active = TRUE
+                ''', (value, user_id))
+                
+                rows = cursor.fetchall()
+                
+                for sub_id, price, category, service_name in rows:
+                    cursor.execute('''
+                        UPDATE subscriptions 
+                        SET is_active = FALSE, updated_date = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (sub_id,))
+                    
+                    # Обновляем статистику отмен и агрегаты
+                    self._update_user_stats(cursor, user_id, category, price, active_delta=-1, cancelled_delta=1)
+                    record_subscription_event(cursor, sub_id, user_id, EVENT_CANCEL, service_name, category, price)
             
-            return affected > 0, "Подписка удалена"
+            return len(rows) > 0, "Подписка удалена"
             
         except Exception as e:
-            print(f"Ошибка удаления подписки: {e}")
+            log_error('Ошибка удаления подписки', e)
             return False, "Ошибка при удалении подписки"
 
-class SubscriptionManager:
-    """Улучшенный менеджер подписок"""
+    def iter_due_subscriptions(self, charge_days, end_from, end_to, batch_size=1000):
+        """Потоковая выборка активных подписок по дням списания и датам окончания.
+        
+        Возвращает пары (вид, строка), где вид - 'charge' или 'expire'.
+        Даты окончания выбираются диапазоном [end_from, end_to] по индексу.
+        Читает через отдельное соединение: в режиме WAL это не блокирует
+        обработку запросов на общем соединении.
+        """
+        # Схема применяется при первом открытии общего соединения
+        self._get_connection()
+        placeholders = ','.join('?' * len(charge_days))
+        queries = (
+            ('charge', f'charge_day IN ({placeholders})', tuple(charge_days)),
+            ('expire', 'end_date BETWEEN ? AND ?', (end_from.isoformat(), end_to.isoformat())),
+        )
+        
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for kind, condition, params in queries:
+                if not params:
+                    continue
+                cursor = conn.execute(f'''
+                    SELECT id, user_id, service_name, price, charge_day, end_date
+                    FROM subscriptions
+                    WHERE is_active = TRUE AND {condition}
+                ''', params)
+                
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield kind, row
+        finally:
+            conn.close()
     
-    POPULAR_SUBSCRIPTIONS = {
-        'Яндекс Плюс': {'price': 399, 'description': 'Кино, музыка, доставка', 'category': 'развлечения'},
-        'СберПрайм': {'price': 299, 'description': 'Okko, музыка, доставка', 'category': 'развлечения'},
-        'Ozon Premium': {'price': 199, 'description': 'Бесплатная доставка', 'category': 'покупки'},
-        'ВБ Клуб': {'price': 199, 'description': 'Бесплатная доставка', 'category': 'покупки'},
-        'VK Музыка': {'price': 199, 'description': 'Музыка без ограничений', 'category': 'развлечения'},
-        'Яндекс Музыка': {'price': 169, 'description': 'Каталог музыки', 'category': 'развлечения'},
-        'IVI': {'price': 399, 'description': 'Фильмы и сериалы', 'category': 'развлечения'},
-        'START': {'price': 299, 'description': 'Русские сериалы', 'category': 'развлечения'},
-        'Кинопоиск': {'price': 399, 'description': 'Фильмы и сериалы', 'category': 'развлечения'},
-        'Магнит Премиум': {'price': 199, 'description': 'Скидки в магазинах', 'category': 'покупки'},
-        'Alfa Only': {'price': 199, 'description': 'Премиум банк', 'category': 'финансы'},
-        'Т-Банк Pro': {'price': 299, 'description': 'Премиум банк', 'category': 'финансы'},
-        'Пакет X5': {'price': 149, 'description': 'Скидки в Пятерочке', 'category': 'покупки'},
-        'Сотовые услуги': {'price': 300, 'description': 'Ежемесячная связь', 'category': 'связь'},
-        'Домашний интернет': {'price': 500, 'description': 'Доступ в интернет', 'category': 'связь'}
-    }
+    def subscription_change_mark(self):
+        """Номер последнего события журнала - отметка для iter_subscription_changes.
+        
+        id событий растут в порядке фиксации (запись в SQLite однопоточная),
+        поэтому, в отличие от времени updated_date, строка долгой транзакции
+        не окажется раньше уже прочитанной отметки.
+        """
+        with self.read() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM subscription_events')
+            return cursor.fetchone()[0]
+    
+    def iter_subscription_changes(self, since=None, batch_size=5000):
+        """Порции строк (id, service_name, category, price, is_active).
+        
+        Без since - вся таблица, иначе строки с событиями журнала после
+        отметки since (subscription_change_mark). Читает через отдельное
+        соединение.
+        """
+        self._get_connection()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            query = 'SELECT id, service_name, category, price, is_active FROM subscriptions'
+            if since is None:
+                cursor = conn.execute(query)
+            else:
+                cursor = conn.execute(
+                    f'{query} WHERE id IN (SELECT subscription_id FROM subscription_events WHERE id > ?)', (since,)
+                )
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+    
+    def iter_export_rows(self, user_id=None, batch_size=1000):
+        """Строки подписок в порядке EXPORT_FIELDS: все или одного пользователя.
+        
+        Читает через отдельное соединение, которое можно продолжать из
+        другого потока (ASGI отдает выгрузку порциями из пула).
+        """
+        self._get_connection()
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            query = f'SELECT {", ".join(EXPORT_FIELDS)} FROM subscriptions'
+            if user_id is None:
+                cursor = conn.execute(f'{query} ORDER BY id')
+            else:
+                cursor = conn.execute(f'{query} WHERE user_id = ? ORDER BY id', (user_id,))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+    
+    @property
+    def shards(self):
+        """Список шардов; несегментированная БД - один шард"""
+        return [self]
+    
+    def shard_for(self, user_id):
+        """Шард пользователя или чата; несегментированная БД - она сама"""
+        return self
+    
+    def map_shards(self, func):
+        """Выполнение func(шард) на каждом шарде; список результатов"""
+        return [func(self)]
+
+class ShardedDatabaseManager(SubscriptionStorage):
+    """Данные пользователей, разнесенные по N файлам SQLite по user_id.
+    
+    У каждого шарда свое соединение, миграции, кэш и группировщик записей,
+    поэтому записи разных пользователей не ждут общей блокировки БД.
+    Сессии мастера и отметки update_id хранятся в шарде чата (shard_for),
+    поэтому каждое обновление пишет только в шард своего чата. В шарде 0
+    остается только bot_state: offset long polling и отметка напоминаний
+    меняются раз в пакет или запуск крона, а не на каждое обновление.
+    Запросы по всей базе выполняются параллельно на всех шардах.
+    """
+    
+    def __init__(self, db_path=DB_PATH, shard_count=2, snapshots=None):
+        root, ext = os.path.splitext(db_path)
+        # Шард 0 - исходный файл, чтобы служебное состояние не терялось
+        self._shards = [DatabaseManager(db_path, snapshots=snapshots)] + [
+            DatabaseManager(f'{root}.shard{index}{ext}', snapshots=snapshots) for index in range(1, shard_count)
+        ]
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=shard_count, thread_name_prefix='podpis-shard')
+    
+    @property
+    def shards(self):
+        return list(self._shards)
+    
+    def shard_for(self, user_id):
+        return self._shards[user_id % len(self._shards)]
+    
+    def map_shards(self, func):
+        """Параллельное выполнение func(шард) на всех шардах"""
+        return list(self._executor.map(func, self._shards))
+    
+    # Операции пользователя выполняются в его шарде
+    
+    def add_subscription(self, user_id, *args, **kwargs):
+        return self.shard_for(user_id).add_subscription(user_id, *args, **kwargs)
+    
+    def get_user_subscriptions(self, user_id):
+        return self.shard_for(user_id).get_user_subscriptions(user_id)
+    
+    def get_user_stats(self, user_id):
+        return self.shard_for(user_id).get_user_stats(user_id)
+    
+    def get_spend_history(self, user_id, months=12):
+        return self.shard_for(user_id).get_spend_history(user_id, months)
+    
+    def delete_subscription(self, user_id, service_name):
+        return self.shard_for(user_id).delete_subscription(user_id, service_name)
+    
+    def delete_subscription_by_id(self, user_id, subscription_id):
+        return self.shard_for(user_id).delete_subscription_by_id(user_id, subscription_id)
+    
+    def invalidate(self, user_id=None):
+        if user_id is not None:
+            self.shard_for(user_id).invalidate(user_id)
+            return
+        for shard in self._shards:
+            shard.invalidate()
+    
+    # Общее служебное состояние (bot_state) - в шарде 0
+    
+    @property
+    def control(self):
+        return self._shards[0]
+    
+    @property
+    def writer(self):
+        return self.control.writer
+    
+    def read(self):
+        return self.control.read()
+    
+    def transaction(self):
+        return self.control.transaction()
+    
+    def in_transaction(self):
+        return self.control.in_transaction()
+    
+    def get_state(self, key, default=None):
+        return self.control.get_state(key, default)
+    
+    def set_state(self, key, value):
+        self.control.set_state(key, value)
+    
+    # Запросы по всей базе
+    
+    def iter_due_subscriptions(self, charge_days, end_from, end_to, batch_size=1000):
+        """Выборка напоминаний со всех шардов параллельно.
+        
+        Шарды читаются в пуле и передают порции по batch_size строк через
+        очередь ограниченной длины: в памяти не больше двух порций на шард,
+        как бы много подписок ни пришлось на день.
+        """
+        results = Queue(maxsize=2 * len(self._shards))
+        stop = threading.Event()
+        done = object()
+        
+        def put(item):
+            # Потребитель мог прекратить чтение - тогда не ждем места в очереди
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+        
+        def produce(shard):
+            rows = shard.iter_due_subscriptions(charge_days, end_from, end_to, batch_size)
+            try:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+                if batch:
+                    put(batch)
+            except Exception as e:
+                put(e)
+            finally:
+                rows.close()
+                put(done)
+        
+        for shard in self._shards:
+            self._executor.submit(produce, shard)
+        remaining = len(self._shards)
+        try:
+            while remaining:
+                item = results.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+        finally:
+            stop.set()
+    
+    def iter_export_rows(self, user_id=None, batch_size=1000):
+        """Выгрузка шарда пользователя или всех шардов по очереди"""
+        if user_id is not None:
+            yield from self.shard_for(user_id).iter_export_rows(user_id, batch_size)
+            return
+        for shard in self._shards:
+            yield from shard.iter_export_rows(None, batch_size)
+    
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for shard in self._shards:
+            shard.close()
+
+class SubscriptionRow:
+    """Подписка в памяти MemoryStorage"""
+    
+    __slots__ = ('id', 'service_name', 'price', 'charge_day', 'end_date', 'category', 'is_active', 'created_date')
+    
+    def __init__(self, id, service_name, price, charge_day, end_date, category, is_active, created_date):
+        self.id = id
+        self.service_name = service_name
+        self.price = price
+        self.charge_day = charge_day
+        self.end_date = end_date
+        self.category = category
+        self.is_active = is_active
+        self.created_date = created_date
+
+class UserSubscriptions:
+    """Все подписки пользователя и состояние экономии; ответы чтения кэшируются до записи"""
+    
+    __slots__ = (
+        'rows', 'total_saved', 'cancelled_monthly', 'saved_through', 'pending', 'stale', 'aliases',
+        'subscriptions', 'stats'
+    )
+    
+    def __init__(self, rows, total_saved=0, cancelled_monthly=0, saved_through=None):
+        self.rows = rows
+        self.total_saved = total_saved
+        self.cancelled_monthly = cancelled_monthly
+        self.saved_through = saved_through
+        # Изменения пользователя, еще не записанные в SQLite
+        self.pending = 0
+        # Память разошлась с SQLite: перечитать, когда записи закончатся
+        self.stale = False
+        # Временный id записанной строки -> ее id в SQLite (для старых кнопок)
+        self.aliases = {}
+        self.subscriptions = None
+        self.stats = None
+    
+    def latest(self, service_name):
+        """Последняя по дате создания строка с названием, как в _add_subscription"""
+        found = None
+        for row in self.rows:
+            if row.service_name == service_name and (found is None or row.created_date >= found.created_date):
+                found = row
+        return found
+    
+    def roll(self, cancelled_delta):
+        """Начисление экономии до текущего месяца, как roll_spend_month"""
+        month = current_month()
+        if self.saved_through:
+            self.total_saved += self.cancelled_monthly * max(_month_number(month) - _month_number(self.saved_through), 0)
+        self.saved_through = month
+        self.cancelled_monthly += cancelled_delta
+        self.subscriptions = self.stats = None
+
+class MemoryStorage(SubscriptionStorage):
+    """Хранилище в памяти с отложенной записью (write-behind) в SQLite.
+    
+    Подписки пользователя загружаются из SQLite при первом обращении, после
+    чего чтения и записи выполняются в памяти по тем же правилам, что и в
+    DatabaseManager. Изменения копятся в очереди и записываются в SQLite
+    фоновым потоком раз в flush_interval секунд или при max_pending
+    изменениях, одной транзакцией на шард. Если итог записи в SQLite
+    разошелся с ответом из памяти, пользователь перечитывается из SQLite.
+    
+    Неудачная запись откатывается целиком, и пакет возвращается в начало
+    очереди; повтор идет с удваивающейся паузой. Только после MAX_ATTEMPTS
+    неудач подряд изменения считаются потерянными, и пользователи
+    перечитываются из SQLite. Строки получают временные отрицательные id,
+    которые после записи заменяются id из SQLite.
+    
+    Между записями в SQLite остается окно потери данных не больше
+    flush_interval; запросы по всей базе (напоминания, аналитика) видят
+    изменения после записи. Остальные методы (служебные таблицы, шарды)
+    делегируются SQLite-движку.
+    """
+    
+    # Попыток записи пакета до признания изменений потерянными
+    MAX_ATTEMPTS = 5
+    # Предел паузы между повторами, секунд
+    RETRY_MAX_DELAY = 30.0
+    # Ответы SQLite-движка об ошибке записи (а не об ином итоге операции)
+    WRITE_ERRORS = frozenset(("Ошибка при сохранении подписки", "Ошибка при удалении подписки"))
+    
+    def __init__(self, backing, flush_interval=1.0, max_pending=256, capacity=65536):
+        self.backing = backing
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.capacity = capacity
+        self._users = OrderedDict()
+        self._pending = deque()
+        # Порядок блокировок: соединения шардов, затем self._lock
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._closed = False
+        # Временные id строк до записи в SQLite - отрицательные
+        self._next_id = -1
+        # Неудачные попытки записи подряд и время следующего повтора
+        self._attempts = 0
+        self._retry_at = 0.0
+        self.flushes = 0
+        self.flushed = 0
+        self.mismatches = 0
+        self.retries = 0
+        self.lost = 0
+    
+    def __getattr__(self, name):
+        return getattr(self.backing, name)
+    
+    def _shard(self, user_id):
+        shard_for = getattr(self.backing, 'shard_for', None)
+        return shard_for(user_id) if shard_for else self.backing
+    
+    def _load(self, user_id):
+        with self._shard(user_id).read() as cursor:
+            cursor.execute('''
+                SELECT id, service_name, price, charge_day, end_date, category, is_active, created_date
+                FROM subscriptions WHERE user_id = ? ORDER BY id
+            ''', (user_id,))
+            rows = [SubscriptionRow(*row) for row in cursor.fetchall()]
+            cursor.execute(
+                'SELECT total_saved, cancelled_monthly, saved_through FROM user_stats WHERE user_id = ?', (user_id,)
+            )
+            return UserSubscriptions(rows, *(cursor.fetchone() or ()))
+    
+    @contextmanager
+    def _user(self, user_id):
+        """Состояние пользователя под self._lock.
+        
+        Чтение из SQLite идет без self._lock: иначе поток, держащий
+        соединение, и поток, ждущий его под self._lock, заблокируют друг друга.
+        """
+        while True:
+            with self._lock:
+                user = self._users.get(user_id)
+                if user is not None:
+                    self._users.move_to_end(user_id)
+                    yield user
+                    return
+            loaded = self._load(user_id)
+            with self._lock:
+                # Пока шло чтение, пользователя мог загрузить другой поток
+                self._users.setdefault(user_id, loaded)
+                if len(self._users) > self.capacity:
+                    self._evict(user_id)
+    
+    def _evict(self, keep):
+        """Вытеснение давно не используемых пользователей без отложенных записей"""
+        for candidate in list(self._users):
+            if len(self._users) <= self.capacity:
+                break
+            if candidate != keep and self._users[candidate].pending == 0:
+                del self._users[candidate]
+    
+    def _enqueue(self, user_id, user, method, args, expected, provisional_id=None):
+        """Постановка записи в SQLite; вызывается под self._lock"""
+        user.pending += 1
+        self._pending.append((user_id, method, args, expected, provisional_id))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='podpis-write-behind', daemon=True)
+            self._thread.start()
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.notify()
+    
+    @timed('add_subscription')
+    def add_subscription(self, user_id, service_name, price, charge_day, end_date=None, category=DEFAULT_CATEGORY):
+        """Добавление подписки в памяти; запись в SQLite - отложенная"""
+        with self._user(user_id) as user:
+            existing = user.latest(service_name)
+            message = "Подписка успешно сохранена"
+            provisional_id = None
+            if existing is not None and existing.is_active:
+                if existing.price == price:
+                    return False, "Эта подписка уже активна"
+                existing.price = price
+                user.roll(0)
+                message = "Цена подписки обновлена"
+            elif existing is not None:
+                old_price = existing.price
+                existing.price, existing.charge_day, existing.end_date = price, charge_day, end_date
+                existing.category, existing.is_active = category, True
+                user.roll(-old_price)
+            else:
+                provisional_id = self._next_id
+                self._next_id -= 1
+                user.rows.append(SubscriptionRow(
+                    provisional_id, service_name, price, charge_day, end_date, category, True,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+                ))
+                user.roll(0)
+            self._enqueue(
+                user_id, user, '_add_subscription',
+                (user_id, service_name, price, charge_day, end_date, category), True, provisional_id
+            )
+            return True, message
+    
+    @timed('get_user_subscriptions')
+    def get_user_subscriptions(self, user_id):
+        with self._user(user_id) as user:
+            if user.subscriptions is None:
+                active = sorted((row for row in user.rows if row.is_active), key=lambda row: row.service_name)
+                user.subscriptions = [
+                    (row.id, row.service_name, row.price, row.charge_day, row.end_date, row.created_date)
+                    for row in active
+                ]
+            return user.subscriptions
+    
+    @timed('get_user_stats')
+    def get_user_stats(self, user_id):
+        with self._user(user_id) as user:
+            if user.stats is None:
+                count = total = cancelled = 0
+                categories = {}
+                for row in user.rows:
+                    if row.is_active:
+                        count += 1
+                        total += row.price
+                        categories[row.category] = categories.get(row.category, 0) + row.price
+                    else:
+                        cancelled += 1
+                user.stats = {
+                    'active_count': count,
+                    'monthly_total': total,
+                    'cancelled_count': cancelled,
+                    'yearly_total': total * 12,
+                    'categories': categories,
+                    'total_saved': user.total_saved
+                }
+            stats = user.stats
+            if user.saved_through:
+                # Экономия за месяцы без событий досчитывается при чтении
+                months = max(_month_number(current_month()) - _month_number(user.saved_through), 0)
+                if months and user.cancelled_monthly:
+                    stats = dict(stats, total_saved=user.total_saved + user.cancelled_monthly * months)
+            return stats
+    
+    def get_spend_history(self, user_id, months=12):
+        """Помесячная сводка ведется в SQLite: сначала записываются изменения пользователя"""
+        with self._lock:
+            user = self._users.get(user_id)
+            pending = user is not None and user.pending
+        if pending:
+            self.flush()
+        return self.backing.get_spend_history(user_id, months)
+    
+    @timed('delete_subscription')
+    def delete_subscription(self, user_id, service_name):
+        with self._user(user_id) as user:
+            rows = [row for row in user.rows if row.is_active and row.service_name == service_name]
+            return self._deactivate(user_id, user, rows, 'service_name = ?', service_name)
+    
+    @timed('delete_subscription_by_id')
+    def delete_subscription_by_id(self, user_id, subscription_id):
+        with self._user(user_id) as user:
+            # Кнопка могла быть отправлена до записи строки в SQLite
+            subscription_id = user.aliases.get(subscription_id, subscription_id)
+            rows = [row for row in user.rows if row.is_active and row.id == subscription_id]
+            # Строка, еще не записанная в SQLite, удаляется по названию
+            if rows and subscription_id < 0:
+                return self._deactivate(user_id, user, rows, 'service_name = ?', rows[0].service_name)
+            return self._deactivate(user_id, user, rows, 'id = ?', subscription_id)
+    
+    def _deactivate(self, user_id, user, rows, condition, value):
+        for row in rows:
+            row.is_active = False
+            user.roll(row.price)
+        if rows:
+            self._enqueue(user_id, user, '_deactivate_subscriptions', (user_id, condition, value), True)
+        return len(rows) > 0, "Подписка удалена"
+    
+    def iter_export_rows(self, user_id=None, batch_size=1000):
+        self.flush()
+        return self.backing.iter_export_rows(user_id, batch_size)
+    
+    def flush(self):
+        """Запись всех отложенных изменений; возвращает число записанных.
+        
+        Очередь забирается под транзакциями всех шардов: параллельные вызовы
+        выполняются по очереди, и записи одного пользователя не меняются местами.
+        """
+        if not self._pending:
+            return 0
+        shards = self.backing.shards
+        batch, results, created = (), [], []
+        try:
+            with ExitStack() as stack:
+                for shard in shards:
+                    stack.enter_context(shard.transaction())
+                with self._lock:
+                    batch, self._pending = self._pending, deque()
+                for user_id, method, args, expected, provisional_id in batch:
+                    shard = self._shard(user_id)
+                    success, message = getattr(shard, method)(*args)
+                    if message in self.WRITE_ERRORS:
+                        # Откат всего пакета: записи пользователя идут по порядку
+                        raise RuntimeError(f'{method}: {message}')
+                    results.append((shard, user_id, success == expected))
+                    if provisional_id is not None:
+                        created.append((user_id, provisional_id, self._stored_id(shard, user_id, args[1])))
+        except Exception as e:
+            self._retry(batch, e)
+            return 0
+        
+        with self._lock:
+            self._attempts = 0
+            for user_id, provisional_id, stored_id in created:
+                user = self._users.get(user_id)
+                if user is None or stored_id is None:
+                    continue
+                for row in user.rows:
+                    if row.id == provisional_id:
+                        row.id = stored_id
+                user.aliases[provisional_id] = stored_id
+                user.subscriptions = None
+            for shard, user_id, matched in results:
+                shard.invalidate(user_id)
+                if not matched:
+                    # Итог в SQLite разошелся с памятью - перечитаем при следующем обращении
+                    self.mismatches += 1
+                self._written(user_id, matched)
+            self.flushes += 1
+            self.flushed += len(results)
+        return len(results)
+    
+    @staticmethod
+    def _stored_id(shard, user_id, service_name):
+        """id строки в SQLite, как ее выбирает _add_subscription (в той же транзакции)"""
+        with shard.read() as cursor:
+            row = cursor.execute(
+                'SELECT id FROM subscriptions WHERE user_id = ? AND service_name = ? ORDER BY created_date DESC, id DESC LIMIT 1',
+                (user_id, service_name)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def _written(self, user_id, matched):
+        """Учет завершенной записи пользователя; вызывается под self._lock"""
+        user = self._users.get(user_id)
+        if user is None:
+            return
+        user.pending -= 1
+        user.stale = user.stale or not matched
+        if user.stale and user.pending == 0:
+            del self._users[user_id]
+    
+    def _retry(self, batch, error):
+        """Возврат пакета в начало очереди после отката записи.
+        
+        Изменения уже подтверждены пользователю, поэтому отбрасываются только
+        после MAX_ATTEMPTS неудач подряд; тогда пользователи перечитываются
+        из SQLite.
+        """
+        with self._lock:
+            self._attempts += 1
+            if self._attempts < self.MAX_ATTEMPTS:
+                self._pending.extendleft(reversed(batch))
+                delay = min(self.flush_interval * 2 ** self._attempts, self.RETRY_MAX_DELAY)
+                self._retry_at = time.monotonic() + delay
+                self.retries += 1
+                lost = 0
+            else:
+                self._attempts = 0
+                for user_id, *_ in batch:
+                    self._written(user_id, False)
+                lost = len(batch)
+                self.lost += lost
+        if lost:
+            log_error('Отложенные записи потеряны', f'{lost} изменений: {error}')
+        else:
+            log_error('Ошибка отложенной записи', f'{error}; повтор через {delay:.1f} с')
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._closed and len(self._pending) < self.max_pending:
+                    self._wakeup.wait(self.flush_interval)
+                # После отката записи повтор - не раньше назначенного времени
+                while not self._closed and time.monotonic() < self._retry_at:
+                    self._wakeup.wait(self._retry_at - time.monotonic())
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception as e:
+                log_error('Ошибка отложенной записи', e)
+            if closed:
+                return
+    
+    def invalidate(self, user_id=None):
+        self.flush()
+        with self._lock:
+            if user_id is None:
+                self._users = OrderedDict((uid, user) for uid, user in self._users.items() if user.pending)
+            else:
+                user = self._users.get(user_id)
+                if user is not None and not user.pending:
+                    del self._users[user_id]
+        self.backing.invalidate(user_id)
+    
+    def stats(self):
+        return {
+            'users': len(self._users),
+            'pending': len(self._pending),
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'mismatches': self.mismatches,
+            'retries': self.retries,
+            'lost': self.lost,
+        }
+    
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        # Повторы с паузами, пока очередь не запишется или не будет признана потерянной
+        while self._pending:
+            time.sleep(max(self._retry_at - time.monotonic(), 0))
+            self.flush()
+        self.backing.close()
+
+def create_database(db_path=DB_PATH, shard_count=None, snapshots=None, storage=None):
+    """Хранилище процесса; число шардов задается PODPISCONTROL_SHARDS.
+    
+    Смена числа шардов меняет распределение пользователей, поэтому на
+    существующей базе ее нужно сопровождать переносом данных.
+    PODPISCONTROL_STORAGE=memory включает MemoryStorage поверх SQLite;
+    окно отложенной записи задает PODPISCONTROL_FLUSH_INTERVAL (секунды).
+    """
+    if shard_count is None:
+        shard_count = int(os.environ.get('PODPISCONTROL_SHARDS', 1))
+    if storage is None:
+        storage = os.environ.get('PODPISCONTROL_STORAGE', 'sqlite')
+    if shard_count <= 1:
+        engine = DatabaseManager(db_path, snapshots=snapshots)
+    else:
+        engine = ShardedDatabaseManager(db_path, shard_count, snapshots)
+    if storage == 'memory':
+        return MemoryStorage(engine, flush_interval=float(os.environ.get('PODPISCONTROL_FLUSH_INTERVAL', 1.0)))
+    if storage != 'sqlite':
+        raise ValueError(f'Неизвестное хранилище: {storage}')
+    return engine
+
+# Поля выгрузки подписок: одинаковые для CSV и JSON Lines
+EXPORT_FIELDS = ('user_id', 'service_name', 'price', 'charge_day', 'end_date', 'category', 'is_active', 'created_date')
+
+def export_format(name):
+    """Формат 'csv' или 'jsonl' по названию или имени файла; ValueError для прочих"""
+    suffix = (name or '').rsplit('.', 1)[-1].strip().lower()
+    if suffix == 'csv':
+        return 'csv'
+    if suffix in ('jsonl', 'ndjson', 'json'):
+        return 'jsonl'
+    raise ValueError(f'Неподдерживаемый формат: {name}')
+
+EXPORT_CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson'}
+
+def parse_transfer_query(query):
+    """(формат, user_id или None) из строки запроса админской выгрузки или загрузки"""
+    params = urllib.parse.parse_qs(query)
+    fmt = export_format(params.get('format', ['csv'])[0])
+    user_id = params.get('user_id', [''])[0]
+    return fmt, int(user_id) if user_id else None
+
+def iter_export(rows, fmt, chunk_size=1 << 16):
+    """Порции байтов выгрузки строк в порядке EXPORT_FIELDS.
+    
+    Цены выводятся в рублях, как их вводит пользователь. Память не зависит
+    от числа строк: буфер отдается, как только набирает chunk_size.
+    """
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(EXPORT_FIELDS)
+    for user_id, name, price, day, end_date, category, is_active, created in rows:
+        if fmt == 'csv':
+            writer.writerow((user_id, name, format_rub(price), day, end_date or '', category, int(bool(is_active)), created or ''))
+        else:
+            buffer.write(json.dumps({
+                'user_id': user_id, 'service_name': name,
+                'price': price / 100 if price % 100 else price // 100,
+                'charge_day': day, 'end_date': end_date, 'category': category,
+                'is_active': bool(is_active), 'created_date': created
+            }, ensure_ascii=False))
+            buffer.write('\n')
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def iter_import_records(stream, fmt):
+    """Пары (номер строки, словарь полей) из бинарного потока CSV или JSON Lines.
+    
+    Поток читается по мере разбора. Для строки JSONL, которую не удалось
+    разобрать, вместо словаря возвращается текст ошибки.
+    """
+    # utf-8-sig: Excel сохраняет CSV с BOM
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    try:
+        if fmt == 'csv':
+            reader = csv.DictReader(text)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for line_num, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_num, f'неверный JSON: {e}'
+                continue
+            yield line_num, record if isinstance(record, dict) else 'ожидался объект JSON'
+    finally:
+        # Поток принадлежит вызывающему коду и не закрывается вместе с оберткой
+        text.detach()
+
+class ChunkStream(io.RawIOBase):
+    """Бинарный поток поверх функции, возвращающей очередную порцию (b'' - конец)"""
+    
+    def __init__(self, next_chunk):
+        self._next_chunk = next_chunk
+        self._pending = b''
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, target):
+        while not self._pending:
+            self._pending = self._next_chunk()
+            if not self._pending:
+                return 0
+        size = min(len(target), len(self._pending))
+        target[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+class SubscriptionImporter:
+    """Пакетная загрузка подписок в одной транзакции на шард.
+    
+    Строки проверяются по мере чтения и копятся во временном файле (до
+    SPOOL_SIZE - в памяти); транзакции открываются, когда весь ввод прочитан.
+    Вставка - пачками через executemany; подписка, уже активная у
+    пользователя, пропускается.
+    События журнала, помесячная сводка и агрегаты user_stats пересчитываются
+    один раз в конце по вставленным строкам. В сводке импорт учитывается
+    месяцем загрузки, неактивные строки - только в журнале и счетчиках.
+    При ошибке SQLite откатывается весь импорт.
+    """
+    
+    BATCH_SIZE = 1000
+    SPOOL_SIZE = 1 << 20
+    # Сколько ошибок проверки сохраняется для отчета
+    MAX_ERRORS = 20
+    # Длина названия как в подписи кнопки удаления
+    MAX_NAME_LENGTH = 100
+    
+    FLAGS = {
+        '1': True, 'true': True, 'yes': True, 'да': True, '': True,
+        '0': False, 'false': False, 'no': False, 'нет': False,
+    }
+    
+    INSERT_SQL = '''
+        INSERT INTO subscriptions (user_id, service_name, price, charge_day, end_date, category, is_active, created_date)
+        SELECT ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM subscriptions
+            WHERE user_id = ?1 AND service_name = ?2 AND (is_active = TRUE OR ?7 = FALSE)
+        )
+    '''
+    
+    def __init__(self, db, user_id=None, catalog=None):
+        """user_id задан - все строки загружаются этому пользователю (загрузка из чата)"""
+        self.db = db
+        self.user_id = user_id
+        self.catalog = catalog or CATALOG
+        self.imported = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.errors = []
+    
+    def _shards(self):
+        if self.user_id is not None and hasattr(self.db, 'shard_for'):
+            return [self.db.shard_for(self.user_id)]
+        return self.db.shards
+    
+    def run(self, records):
+        """Загрузка пар (номер строки, запись); возвращает отчет"""
+        started = time.perf_counter()
+        shards = self._shards()
+        
+        with ExitStack() as stack:
+            # Источник (загрузка файла из Telegram, тело HTTP) может быть
+            # медленным, а транзакция держит соединение шарда для всех
+            # пользователей: проверенные строки сначала сохраняются локально
+            spools = [
+                stack.enter_context(tempfile.SpooledTemporaryFile(self.SPOOL_SIZE, 'w+', encoding='utf-8'))
+                for _ in shards
+            ]
+            for line_num, record in records:
+                try:
+                    row = self._validate(record)
+                except ValueError as e:
+                    self._reject(line_num, e)
+                    continue
+                index = row[0] % len(shards) if len(shards) > 1 else 0
+                spools[index].write(json.dumps(row, ensure_ascii=False) + '\n')
+            
+            # Отложенные записи MemoryStorage должны попасть в SQLite до импорта
+            self.db.flush()
+            cursors = [stack.enter_context(shard.transaction()) for shard in shards]
+            for cursor, spool in zip(cursors, spools):
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM subscriptions')
+                mark = cursor.fetchone()[0]
+                spool.seek(0)
+                batch = []
+                for line in spool:
+                    batch.append(tuple(json.loads(line)))
+                    if len(batch) >= self.BATCH_SIZE:
+                        self._flush(cursor, batch)
+                self._flush(cursor, batch)
+                self._finish(cursor, mark)
+        
+        self.db.invalidate(self.user_id)
+        metrics.observe_db('import_subscriptions', time.perf_counter() - started, self.imported)
+        return {
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'invalid': self.invalid,
+            'errors': self.errors
+        }
+    
+    def _reject(self, line_num, reason):
+        self.invalid += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append(f'строка {line_num}: {reason}')
+    
+    def _validate(self, record):
+        """Строка для вставки из записи файла; ValueError с причиной"""
+        if not isinstance(record, dict):
+            raise ValueError(record)
+        
+        if self.user_id is not None:
+            user_id = self.user_id
+        else:
+            try:
+                user_id = int(record.get('user_id'))
+            except (TypeError, ValueError):
+                raise ValueError('неверный user_id')
+        
+        name = str(record.get('service_name') or '').strip()
+        if not name or len(name) > self.MAX_NAME_LENGTH:
+            raise ValueError('пустое или слишком длинное название')
+        
+        price = record.get('price')
+        if price is None or price == '':
+            raise ValueError('не указана цена')
+        price = to_kopecks(price)
+        if price <= 0:
+            raise ValueError('цена должна быть положительной')
+        
+        charge_day = record.get('charge_day')
+        try:
+            charge_day = int(charge_day) if charge_day not in (None, '') else 1
+        except (TypeError, ValueError):
+            raise ValueError('неверный день списания')
+        if not 1 <= charge_day <= 31:
+            raise ValueError('день списания должен быть от 1 до 31')
+        
+        end_date = self._parse_date(record.get('end_date'))
+        
+        is_active = self.FLAGS.get(str(record.get('is_active', '')).strip().lower())
+        if is_active is None:
+            raise ValueError('неверный признак is_active')
+        
+        created = record.get('created_date') or None
+        if created is not None:
+            try:
+                created = datetime.fromisoformat(str(created).strip()).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                raise ValueError('неверная дата created_date')
+        
+        # Нечеткий поиск по каталогу на каждую строку слишком дорог для
+        # больших файлов: категория - из файла или по точному названию
+        category = str(record.get('category') or '').strip()
+        if not category:
+            entry = self.catalog.get(name)
+            category = entry['category'] if entry else DEFAULT_CATEGORY
+        
+        return (user_id, name, price, charge_day, end_date, category, is_active, created)
+    
+    @staticmethod
+    def _parse_date(value):
+        """Дата окончания в ISO: принимает ISO, ДД.ММ.ГГГГ и ДД.ММ.ГГ"""
+        value = str(value or '').strip()
+        if not value:
+            return None
+        try:
+            return date.fromisoformat(value).isoformat()
+        except ValueError:
+            pass
+        try:
+            return datetime.strptime(value, '%d.%m.%Y').date().isoformat()
+        except ValueError:
+            pass
+        parsed = parse_end_date(value, datetime.now().year) if FULL_DATE_RE.match(value) else None
+        if parsed is None:
+            raise ValueError('неверная дата окончания')
+        return parsed.isoformat()
+    
+    def _flush(self, cursor, batch):
+        if not batch:
+            return
+        cursor.executemany(self.INSERT_SQL, batch)
+        self.imported += cursor.rowcount
+        self.skipped += len(batch) - cursor.rowcount
+        batch.clear()
+    
+    def _finish(self, cursor, mark):
+        """Журнал, сводка и агрегаты по строкам с id больше mark"""
+        created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        cursor.execute('''
+            INSERT INTO subscription_events (subscription_id, user_id, kind, service_name, category, price, created_at)
+            SELECT id, user_id, ?, service_name, category, price, ? FROM subscriptions WHERE id > ?
+        ''', (EVENT_ADD, created_at, mark))
+        cursor.execute('''
+            INSERT INTO subscription_events (subscription_id, user_id, kind, service_name, category, price, created_at)
+            SELECT id, user_id, ?, service_name, category, price, ? FROM subscriptions WHERE id > ? AND is_active = FALSE
+        ''', (EVENT_CANCEL, created_at, mark))
+        
+        # Неактивная строка отменена до загрузки (когда - неизвестно): в
+        # подключенные за месяц и в экономию от отмен она не попадает
+        cursor.execute('''
+            SELECT user_id, SUM(price) FROM subscriptions
+            WHERE id > ? AND is_active = TRUE GROUP BY user_id
+        ''', (mark,))
+        month = created_at[:7]
+        for user_id, active in cursor.fetchall():
+            roll_spend_month(cursor, user_id, month, active, active, 0)
+        
+        _recompute_user_stats(cursor, 'id > ?', (mark,))
+
+class SessionStore:
+    """Хранилище сессий мастера: LRU в памяти поверх таблицы user_sessions"""
+    
+    def __init__(self, db, ttl=1800, capacity=4096, front_ttl=5.0, purge_interval=300):
+        self.db = db
+        # Время жизни сессии без активности
+        self.ttl = ttl
+        self.capacity = capacity
+        # Сколько секунд запись в памяти считается актуальной без чтения с диска:
+        # другой инстанс мог продвинуть мастер, поэтому кэшируем ненадолго
+        self.front_ttl = front_ttl
+        self.purge_interval = purge_interval
+        self._front = OrderedDict()
+        # Сброшенные без обращения к SQLite сессии: chat_id -> время сброса
+        self._discarded = {}
+        self._lock = threading.Lock()
+        self._next_purge = time.monotonic() + purge_interval
+    
+    def _remember(self, chat_id, session):
+        with self._lock:
+            self._front[chat_id] = (time.monotonic() + self.front_ttl, session)
+            self._front.move_to_end(chat_id)
+            while len(self._front) > self.capacity:
+                self._front.popitem(last=False)
+    
+    def get(self, chat_id):
+        """Текущая сессия чата или None"""
+        with self._lock:
+            entry = self._front.get(chat_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._front.move_to_end(chat_id)
+                return entry[1]
+        
+        with self._lock:
+            discarded_at = self._discarded.get(chat_id, 0)
+        
+        session = None
+        try:
+            # Сессия, сохраненная до сброса, считается удаленной; сохраненная
+            # позже (другим инстансом) - действует
+            with self.db.shard_for(chat_id).read() as cursor:
+                cursor.execute(
+                    'SELECT data FROM user_sessions WHERE chat_id = ? AND updated_at > ?',
+                    (chat_id, max(time.time() - self.ttl, discarded_at))
+                )
+                row = cursor.fetchone()
+            if row:
+                session = json.loads(row[0])
+        except Exception as e:
+            log_error('Ошибка чтения сессии', e)
+        # SQLite уже открыт: заодно удаляем накопленные сброшенные сессии
+        self._apply_discards()
+        
+        # Отсутствие сессии тоже кэшируем, чтобы обычные команды не читали диск
+        self._remember(chat_id, session)
+        return session
+    
+    def set(self, chat_id, session):
+        """Сохранение сессии (write-through в SQLite)"""
+        self._remember(chat_id, session)
+        with self._lock:
+            self._discarded.pop(chat_id, None)
+        shard = self.db.shard_for(chat_id)
+        try:
+            shard.writer.execute(self._save, shard, chat_id, json.dumps(session, ensure_ascii=False))
+        except Exception as e:
+            log_error('Ошибка сохранения сессии', e)
+        self._maybe_purge()
+    
+    def delete(self, chat_id):
+        """Завершение сессии"""
+        self._remember(chat_id, None)
+        with self._lock:
+            self._discarded.pop(chat_id, None)
+        shard = self.db.shard_for(chat_id)
+        try:
+            shard.writer.execute(self._delete, shard, chat_id)
+        except Exception as e:
+            log_error('Ошибка удаления сессии', e)
+    
+    def discard(self, chat_id):
+        """Сброс сессии без обращения к SQLite.
+        
+        Время сброса запоминается в памяти: get не вернет сессию, сохраненную
+        раньше, а строки удаляются при следующем чтении сессии с диска. Так
+        статическая команда (/start) не открывает SQLite на холодном старте.
+        """
+        with self._lock:
+            entry = self._front.get(chat_id)
+            if entry is not None and entry[1] is None and chat_id not in self._discarded:
+                return
+            self._discarded[chat_id] = time.time()
+            overflow = len(self._discarded) > self.capacity
+        self._remember(chat_id, None)
+        if overflow:
+            self._apply_discards()
+    
+    def _apply_discards(self):
+        """Удаление сброшенных сессий через группировщик записей"""
+        with self._lock:
+            if not self._discarded:
+                return
+            discarded, self._discarded = self._discarded, {}
+        by_shard = {}
+        for chat_id, discarded_at in discarded.items():
+            by_shard.setdefault(self.db.shard_for(chat_id), []).append((chat_id, discarded_at))
+        for shard, items in by_shard.items():
+            try:
+                shard.writer.submit(self._delete_discarded, shard, items)
+            except Exception as e:
+                log_error('Ошибка удаления сессии', e)
+    
+    @staticmethod
+    def _save(shard, chat_id, data):
+        with shard.transaction() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO user_sessions (chat_id, data, updated_at) VALUES (?, ?, ?)',
+                (chat_id, data, time.time())
+            )
+    
+    @staticmethod
+    def _delete(shard, chat_id):
+        with shard.transaction() as cursor:
+            cursor.execute('DELETE FROM user_sessions WHERE chat_id = ?', (chat_id,))
+    
+    @staticmethod
+    def _delete_discarded(shard, discarded):
+        with shard.transaction() as cursor:
+            cursor.executemany(
+                'DELETE FROM user_sessions WHERE chat_id = ? AND updated_at <= ?',
+                discarded
+            )
+    
+    def _maybe_purge(self):
+        if time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + self.purge_interval
+            self.purge_expired()
+    
+    def purge_expired(self):
+        """Массовое удаление устаревших сессий во всех шардах; возвращает число удаленных"""
+        removed = 0
+        for shard in self.db.shards:
+            try:
+                with shard.transaction() as cursor:
+                    cursor.execute('DELETE FROM user_sessions WHERE updated_at <= ?', (time.time() - self.ttl,))
+                    removed += cursor.rowcount
+            except Exception as e:
+                log_error('Ошибка очистки сессий', e)
+        return removed
+
+class UpdateDeduplicator:
+    """Индекс уже обработанных update_id: кольцо в памяти и таблица в SQLite"""
+    
+    def __init__(self, db, capacity=4096, ttl=86400, purge_interval=600):
+        self.db = db
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._ring = deque(maxlen=capacity)
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._next_purge = time.monotonic() + purge_interval
+        self.duplicates = 0
+    
+    def _remember(self, update_id):
+        with self._lock:
+            if len(self._ring) == self._ring.maxlen:
+                self._seen.discard(self._ring[0])
+            self._ring.append(update_id)
+            self._seen.add(update_id)
+    
+    def check_and_mark(self, update_id, chat_id=None):
+        """True, если обновление пришло впервые; сразу отмечает его обработанным.
+        
+        Отметка пишется в шард чата: повторная доставка приходит от того же
+        чата, а обновления разных чатов не пишут в общий файл.
+        """
+        if update_id in self._seen:
+            self.duplicates += 1
+            return False
+        
+        shard = self.db.shard_for(chat_id) if chat_id is not None else self.db.shards[0]
+        try:
+            is_new = shard.writer.execute(self._mark, shard, update_id)
+        except Exception as e:
+            # Без индекса лучше обработать повтор, чем потерять обновление
+            log_error('Ошибка проверки update_id', e)
+            is_new = True
+        
+        self._remember(update_id)
+        if not is_new:
+            self.duplicates += 1
+        self._maybe_purge()
+        return is_new
+    
+    def check_recent(self, update_id):
+        """Проверка только по кольцу в памяти, без SQLite.
+        
+        Для идемпотентных ответов: повтор, вытесненный из кольца, просто
+        получит тот же ответ еще раз.
+        """
+        if update_id in self._seen:
+            self.duplicates += 1
+            return False
+        self._remember(update_id)
+        return True
+    
+    @staticmethod
+    def _mark(shard, update_id):
+        with shard.transaction() as cursor:
+            cursor.execute(
+                'INSERT OR IGNORE INTO processed_updates (update_id, seen_at) VALUES (?, ?)',
+                (update_id, time.time())
+            )
+            return cursor.rowcount > 0
+    
+    def _maybe_purge(self):
+        if time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + self.purge_interval
+            self.purge_expired()
+    
+    def purge_expired(self):
+        """Удаление записей старше ttl во всех шардах; возвращает число удаленных"""
+        removed = 0
+        for shard in self.db.shards:
+            try:
+                with shard.transaction() as cursor:
+                    cursor.execute('DELETE FROM processed_updates WHERE seen_at <= ?', (time.time() - self.ttl,))
+                    removed += cursor.rowcount
+            except Exception as e:
+                log_error('Ошибка очистки update_id', e)
+        return removed
+
+class RateLimiter:
+    """Ограничение нагрузки: token bucket на чат и общий лимит параллельности.
+    
+    Корзины хранятся компактно (список [токены, время, уведомлен]) и
+    периодически удаляются, если чат давно молчит и корзина уже полная.
+    Частота считается по времени отправки сообщения (поле date), а не по
+    времени обработки: сообщения, накопленные у Telegram за простой бота,
+    приходят пачкой, но отправлены были с обычной частотой.
+    """
+    
+    def __init__(self, rate=1.0, burst=8, max_concurrent=64, evict_interval=60):
+        self.rate = rate
+        self.burst = burst
+        self.evict_interval = evict_interval
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._next_evict = time.time() + evict_interval
+        self.rejected_rate = 0
+        self.rejected_overload = 0
+    
+    def allow(self, chat_id, sent_at=None):
+        """Возвращает 'ok', 'notify' (первый отказ - ответить) или 'drop'.
+        
+        sent_at - время отправки (Unix-время из Update); без него, например
+        для нажатий кнопок, используется текущее время.
+        """
+        now = time.time()
+        at = now if sent_at is None else sent_at
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                self._buckets[chat_id] = [self.burst - 1.0, at, False]
+                verdict = 'ok'
+            else:
+                # Нажатие кнопки могло сдвинуть время корзины позже даты
+                # сообщений из очереди: время не идет назад
+                tokens = min(self.burst, bucket[0] + max(0.0, at - bucket[1]) * self.rate)
+                bucket[1] = max(bucket[1], at)
+                if tokens >= 1:
+                    bucket[0] = tokens - 1
+                    bucket[2] = False
+                    verdict = 'ok'
+                else:
+                    bucket[0] = tokens
+                    self.rejected_rate += 1
+                    # Предупреждаем один раз, дальше молча отбрасываем
+                    verdict = 'drop' if bucket[2] else 'notify'
+                    bucket[2] = True
+            
+            if now >= self._next_evict:
+                self._evict(now)
+        return verdict
+    
+    def _evict(self, now):
+        # Через burst / rate секунд тишины корзина полная - ее можно забыть
+        idle = self.burst / self.rate
+        stale = [chat_id for chat_id, bucket in self._buckets.items() if now - bucket[1] >= idle]
+        for chat_id in stale:
+            del self._buckets[chat_id]
+        self._next_evict = now + self.evict_interval
+    
+    def acquire(self):
+        """Слот общей параллельности без ожидания; False - перегрузка"""
+        if self._slots.acquire(blocking=False):
+            return True
+        self.rejected_overload += 1
+        return False
+    
+    def release(self):
+        self._slots.release()
+    
+    def stats(self):
+        return {
+            'buckets': len(self._buckets),
+            'rejected_rate': self.rejected_rate,
+            'rejected_overload': self.rejected_overload
+        }
+
+def markup_key(markup):
+    """Каноническая JSON-строка разметки для сравнения отпечатков"""
+    return json.dumps(markup, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
+def is_persistent_keyboard(markup):
+    """Reply-клавиатура, которая остается у пользователя до замены"""
+    return markup is not None and 'keyboard' in markup and not markup.get('one_time_keyboard')
+
+class PreparedReply:
+    """Ответ sendMessage, заранее сериализованный в JSON.
+    
+    При отправке в готовые байты подставляется только chat_id. Для ответа
+    с reply-клавиатурой заранее собран вариант без нее (bare) и отпечаток
+    клавиатуры: если чат уже показывает ее, отправляется bare.
+    """
+    
+    __slots__ = ('payload', '_tail', 'fingerprint', 'bare', 'markup_size')
+    
+    _HEAD = b'{"method":"sendMessage","chat_id":'
+    
+    def __init__(self, text, reply_markup=None, parse_mode='Markdown'):
+        payload = {'text': text}
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        if reply_markup is not None:
+            payload['reply_markup'] = reply_markup
+        self.payload = payload
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        # Отрезаем открывающую скобку: она уже есть в _HEAD
+        self._tail = b',' + body[1:]
+        
+        if is_persistent_keyboard(reply_markup):
+            self.bare = PreparedReply(text, None, parse_mode)
+            self.fingerprint = hash(markup_key(reply_markup))
+            self.markup_size = len(self._tail) - len(self.bare._tail)
+        else:
+            self.bare = self
+            self.fingerprint = None
+            self.markup_size = 0
+    
+    def render(self, chat_id):
+        """Готовое тело ответа вебхука для чата"""
+        return b''.join((self._HEAD, str(int(chat_id)).encode('ascii'), self._tail))
+    
+    def as_dict(self, chat_id):
+        """Ответ в виде словаря (для отладки и сравнения)"""
+        return {'method': 'sendMessage', 'chat_id': chat_id, **self.payload}
+
+class KeyboardTracker:
+    """Отпечатки reply-клавиатур, показанных в чатах, с вытеснением LRU.
+    
+    Reply-клавиатура остается у пользователя до замены, поэтому ответ с той
+    же клавиатурой отправляется без reply_markup. Отпечаток живет ttl секунд
+    и не продлевается при совпадении: если пользователь скрыл клавиатуру или
+    очистил историю, она вернется не позже чем через ttl (или по /start).
+    Для правок сообщений хранится отпечаток последней правки: повтор той же
+    правки не отправляется, Telegram все равно ответил бы ошибкой
+    "message is not modified".
+    
+    Отпечатки хранятся в памяти процесса, как и передний кэш сессий, и
+    живут столько же: на Vercel чат обслуживают несколько инстансов, и
+    другой инстанс мог сменить клавиатуру чата. Больший ttl безопасен, только
+    если все чаты обслуживает один процесс (long polling, встроенный сервер).
+    """
+    
+    DEFAULT_TTL = 5.0
+    
+    def __init__(self, capacity=8192, ttl=None):
+        self.capacity = capacity
+        # 0 отключает пропуск клавиатур
+        if ttl is None:
+            ttl = float(os.environ.get('PODPISCONTROL_KEYBOARD_TTL', self.DEFAULT_TTL))
+        self.ttl = ttl
+        self._keyboards = OrderedDict()
+        self._edits = OrderedDict()
+        self._lock = threading.Lock()
+        self.omitted = 0
+        self.skipped_edits = 0
+        self.saved_bytes = 0
+    
+    def _shown(self, chat_id, fingerprint):
+        """True, если чат уже показывает клавиатуру; иначе запоминает ее"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._keyboards.get(chat_id)
+            if entry is not None and entry[0] == fingerprint and entry[1] > now:
+                self._keyboards.move_to_end(chat_id)
+                return True
+            self._keyboards[chat_id] = (fingerprint, now + self.ttl)
+            self._keyboards.move_to_end(chat_id)
+            if len(self._keyboards) > self.capacity:
+                self._keyboards.popitem(last=False)
+            return False
+    
+    def _same_edit(self, chat_id, message_id, fingerprint):
+        with self._lock:
+            if self._edits.get(chat_id) == (message_id, fingerprint):
+                return True
+            self._edits[chat_id] = (message_id, fingerprint)
+            self._edits.move_to_end(chat_id)
+            if len(self._edits) > self.capacity:
+                self._edits.popitem(last=False)
+            return False
+    
+    def forget(self, chat_id):
+        """Следующий ответ чату отправит клавиатуру заново"""
+        with self._lock:
+            self._keyboards.pop(chat_id, None)
+    
+    def apply(self, response, chat_id):
+        """Ответ без неизменившейся клавиатуры; None, если отправлять нечего"""
+        if not self.ttl:
+            return response
+        
+        if isinstance(response, PreparedReply):
+            if response.fingerprint is not None and self._shown(chat_id, response.fingerprint):
+                self.omitted += 1
+                self.saved_bytes += response.markup_size
+                return response.bare
+            return response
+        
+        markup = response.get('reply_markup')
+        if response.get('method') == 'editMessageText':
+            fingerprint = hash((response.get('text'), markup_key(markup)))
+            if self._same_edit(chat_id, response.get('message_id'), fingerprint):
+                self.skipped_edits += 1
+                return None
+            return response
+        
+        if is_persistent_keyboard(markup):
+            key = markup_key(markup)
+            if self._shown(chat_id, hash(key)):
+                self.omitted += 1
+                self.saved_bytes += len(key.encode('utf-8'))
+                return {name: value for name, value in response.items() if name != 'reply_markup'}
+        elif markup is not None and 'inline_keyboard' not in markup:
+            # Одноразовая клавиатура или remove_keyboard меняют то, что видит чат
+            self.forget(chat_id)
+        return response
+    
+    def stats(self):
+        return {
+            'chats': len(self._keyboards),
+            'omitted': self.omitted,
+            'skipped_edits': self.skipped_edits,
+            'saved_bytes': self.saved_bytes,
+        }
+
+def encode_response(response, chat_id):
+    """Сериализация ответа обработчика в тело HTTP-ответа"""
+    if isinstance(response, PreparedReply):
+        return response.render(chat_id)
+    return json.dumps(response, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# Клавиатуры не меняются во время работы, поэтому собираются один раз.
+# Эти объекты общие для всех ответов и не должны изменяться
+MAIN_KEYBOARD = {
+    'keyboard': [
+        [{'text': 'Управление подписками'}],
+        [{'text': 'Мои подписки'}, {'text': 'Статистика'}],
+        [{'text': 'Поддержать проект'}, {'text': 'О законе'}],
+        [{'text': 'Помощь'}, {'text': 'Финансовая аналитика'}]
+    ],
+    'resize_keyboard': True
+}
+
+CANCEL_KEYBOARD = {
+    'keyboard': [[{'text': '❌ Отмена'}]],
+    'resize_keyboard': True
+}
+
+DATE_KEYBOARD = {
+    'keyboard': [
+        [{'text': '⏩ Пропустить'}],
+        [{'text': '❌ Отмена'}]
+    ],
+    'resize_keyboard': True
+}
+
+# Каталог сервисов; путь можно переопределить для своего набора данных
+CATALOG_PATH = os.environ.get(
+    'PODPISCONTROL_CATALOG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json')
+)
+
+NORMALIZE_RE = re.compile(r'[^0-9a-zа-я+]+')
+
+def normalize_service_name(text):
+    """Ключ поиска: нижний регистр, ё -> е, без знаков препинания"""
+    return NORMALIZE_RE.sub(' ', text.lower().replace('ё', 'е')).strip()
+
+def _trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _edit_distance(a, b, limit):
+    """Расстояние Левенштейна с отсечением: limit + 1, если больше limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class ServiceCatalog:
+    """Каталог сервисов с индексами по категории, префиксу и триграммам.
+    
+    Записи - словари name/price/category/description, цена в копейках.
+    Индексы поиска строятся при первом поиске, а не при импорте.
+    """
+    
+    # Сервисов на странице inline-клавиатуры категории
+    PAGE_SIZE = 10
+    # Минимальное сходство по триграммам (коэффициент Дайса). При 0.5
+    # одно общее слово ("Банк", "Яндекс Такси") давало чужой сервис
+    MIN_SIMILARITY = 0.75
+    
+    def __init__(self, services):
+        self.services = {}
+        self._aliases = {}
+        for service in services:
+            entry = {
+                'name': service['name'],
+                'price': to_kopecks(service['price']),
+                'category': service.get('category', DEFAULT_CATEGORY),
+                'description': service.get('description', '')
+            }
+            self.services[entry['name']] = entry
+            self._aliases[entry['name']] = service.get('aliases', ())
+        
+        # Индексы для клавиатур: порядок стабилен между инстансами
+        self.names = sorted(self.services)
+        self._name_index = {name: index for index, name in enumerate(self.names)}
+        by_category = {}
+        for name in self.names:
+            by_category.setdefault(self.services[name]['category'], []).append(name)
+        self.categories = sorted(by_category)
+        self._by_category = by_category
+        
+        self._lock = threading.Lock()
+        self._keys = None
+        self._sorted_keys = None
+        self._trigram_index = None
+        self._cards = {}
+        self._pages = {}
+    
+    @classmethod
+    def load(cls, path=CATALOG_PATH):
+        """Загрузка каталога из JSON; без файла - пустой каталог"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                return cls(json.load(f)['services'])
+        except (OSError, ValueError, KeyError) as e:
+            log_error('Ошибка загрузки каталога', e)
+            return cls([])
+    
+    def _ensure_index(self):
+        if self._keys is not None:
+            return
+        with self._lock:
+            if self._keys is not None:
+                return
+            keys = {}
+            for name in self.names:
+                for key in (name, *self._aliases[name]):
+                    key = normalize_service_name(key)
+                    if key:
+                        keys.setdefault(key, name)
+            trigram_index = {}
+            sorted_keys = sorted(keys)
+            for position, key in enumerate(sorted_keys):
+                for trigram in _trigrams(key):
+                    trigram_index.setdefault(trigram, []).append(position)
+            self._sorted_keys = sorted_keys
+            self._trigram_index = trigram_index
+            self._keys = keys
+    
+    def get(self, name):
+        """Запись по точному названию или None"""
+        return self.services.get(name)
+    
+    def lookup(self, text):
+        """Запись по названию или синониму без учета регистра и знаков; иначе None"""
+        key = normalize_service_name(text)
+        if not key:
+            return None
+        self._ensure_index()
+        name = self._keys.get(key)
+        return self.services[name] if name is not None else None
+    
+    def category_of(self, name):
+        """Категория сервиса по названию или синониму.
+        
+        Нечеткий поиск здесь не используется: своя подписка ("Старая")
+        не должна получать категорию похожего сервиса ("START").
+        """
+        entry = self.services.get(name) or self.lookup(name)
+        return entry['category'] if entry else DEFAULT_CATEGORY
+    
+    def match(self, text):
+        """Похожая запись каталога для пользовательского ввода или None.
+        
+        Порядок: точный ключ (название или синоним), продолжение префикса
+        (только однозначное), затем кандидаты по общим триграммам с
+        проверкой расстоянием редактирования. Результат - только подсказка:
+        точное совпадение дает lookup.
+        """
+        entry = self.lookup(text)
+        if entry is not None:
+            return entry
+        key = normalize_service_name(text)
+        if not key:
+            return None
+        
+        if len(key) >= 3:
+            found = set()
+            for position in range(bisect_left(self._sorted_keys, key), len(self._sorted_keys)):
+                candidate = self._sorted_keys[position]
+                if not candidate.startswith(key):
+                    break
+                found.add(self._keys[candidate])
+                if len(found) > 1:
+                    break
+            if len(found) == 1:
+                return self.services[found.pop()]
+            if found:
+                # Начало нескольких названий ("сбер") - не угадываем
+                return None
+        
+        query = _trigrams(key)
+        shared = {}
+        for trigram in query:
+            for position in self._trigram_index.get(trigram, ()):
+                shared[position] = shared.get(position, 0) + 1
+        if not shared:
+            return None
+        
+        best, best_score = None, 0.0
+        for position, count in heapq.nlargest(5, shared.items(), key=lambda item: item[1]):
+            candidate = self._sorted_keys[position]
+            score = 2 * count / (len(query) + len(_trigrams(candidate)))
+            if score < self.MIN_SIMILARITY:
+                # Одна опечатка в слове ("кинопоск") мало пересекается по
+                # триграммам; больший допуск сводил "Ютуб премиум" к "МТС Premium"
+                if len(key) < 5 or _edit_distance(key, candidate, 1) > 1:
+                    continue
+                score = self.MIN_SIMILARITY
+            if score > best_score:
+                best, best_score = candidate, score
+        return self.services[self._keys[best]] if best is not None else None
+    
+    def card(self, name):
+        """Карточка сервиса с кнопкой добавления (собирается при первом показе)"""
+        card = self._cards.get(name)
+        if card is None:
+            info = self.services[name]
+            card = self._cards[name] = PreparedReply(
+                f'*{name}*\n\n*Стоимость:* {format_rub(info["price"])} руб/мес\n*Категория:* {info["category"]}\n*Описание:* {info["description"]}\n\nДобавить для отслеживания?',
+                {
+                    'keyboard': [
+                        [{'text': f'✅ Добавить {name}'}],
+                        [{'text': '📋 К подпискам'}, {'text': '🔙 Главное меню'}]
+                    ],
+                    'resize_keyboard': True
+                }
+            )
+        return card
+    
+    def category_index(self, title):
+        """Номер категории по тексту кнопки или None"""
+        category = title.lower()
+        return self.categories.index(category) if category in self._by_category else None
+    
+    def service_by_index(self, index):
+        return self.names[index] if 0 <= index < len(self.names) else None
+    
+    def page(self, category_index, page):
+        """(текст, inline-клавиатура) страницы категории или None"""
+        key = (category_index, page)
+        cached = self._pages.get(key)
+        if cached is not None:
+            return cached
+        if not 0 <= category_index < len(self.categories):
+            return None
+        
+        category = self.categories[category_index]
+        services = self._by_category[category]
+        pages = max(1, -(-len(services) // self.PAGE_SIZE))
+        if not 0 <= page < pages:
+            return None
+        
+        chunk = services[page * self.PAGE_SIZE:(page + 1) * self.PAGE_SIZE]
+        buttons = [
+            {'text': name, 'callback_data': f'{CALLBACK_SERVICE}:{self._name_index[name]}'}
+            for name in chunk
+        ]
+        keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        navigation = []
+        if page > 0:
+            navigation.append({'text': '◀️ Назад', 'callback_data': f'{CALLBACK_CATEGORY}:{category_index}:{page - 1}'})
+        if page + 1 < pages:
+            navigation.append({'text': 'Далее ▶️', 'callback_data': f'{CALLBACK_CATEGORY}:{category_index}:{page + 1}'})
+        if navigation:
+            keyboard.append(navigation)
+        
+        text = f'*{category.capitalize()}*'
+        if pages > 1:
+            text += f' (стр. {page + 1} из {pages})'
+        text += '\n\nВыберите сервис:'
+        result = self._pages[key] = (text, {'inline_keyboard': keyboard})
+        return result
+
+CATALOG = ServiceCatalog.load()
+
+class SubscriptionManager:
+    """Улучшенный менеджер подписок"""
+    
+    catalog = CATALOG
+    
+    DONATION_LINK = "https://tbank.ru/cf/1pxGD5puRV3"
+    
+    @classmethod
+    def get_main_keyboard(cls):
+        """Главная клавиатура с улучшенными кнопками (общий неизменяемый объект)"""
+        return MAIN_KEYBOARD
+    
+    @classmethod
+    def get_subscriptions_keyboard(cls):
+        """Улучшенная клавиатура подписок по категориям (собирается один раз)"""
+        return SUBSCRIPTIONS_KEYBOARD
+    
+    @classmethod
+    def get_cancel_keyboard(cls):
+        """Клавиатура для отмены"""
+        return CANCEL_KEYBOARD
     
-    DONATION_LINK = "https://tbank.ru/cf/1pxGD5puRV3"
+    @classmethod
+    def get_subscription_info(cls, service_name):
+        """Карточка сервиса из каталога или None"""
+        return cls.catalog.get(service_name)
     
     @classmethod
-    def get_main_keyboard(cls):
-        """Главная клавиатура с улучшенными кнопками"""
-        return {
-            'keyboard': [
-                [{'text': 'Управление подписками'}],
-                [{'text': 'Мои подписки'}, {'text': 'Статистика'}],
-                [{'text': 'Поддержать проект'}, {'text': 'О законе'}],
-                [{'text': 'Помощь'}, {'text': 'Финансовая аналитика'}]
-            ],
-            'resize_keyboard': True
-        }
+    def get_category(cls, service_name):
+        """Категория сервиса для аналитики (по названию или синониму из каталога)"""
+        return cls.catalog.category_of(service_name)
     
     @classmethod
-    def get_subscriptions_keyboard(cls):
-        """Улучшенная клавиатура подписок по категориям"""
-        categories = {}
-        for name, info in cls.POPULAR_SUBSCRIPTIONS.items():
-            category = info['category']
-            if category not in categories:
-                categories[category] = []
-            categories[category].append(name)
-        
-        keyboard = []
-        
-        # Добавляем подписки по категориям
-        for category, services in categories.items():
-            keyboard.append([{'text': f'📁 {category.capitalize()}'}])
-            for i in range(0, len(services), 2):
-                row = [
-                    {'text': services[i]}, 
-                    {'text': services[i+1]} if i+1 < len(services) else {'text': '⋯'}
-                ]
-                keyboard.append(row)
+    def _build_subscriptions_keyboard(cls):
+        # Только категории: сервисы показываются постранично по нажатию,
+        # поэтому размер ответа не зависит от размера каталога
+        buttons = [{'text': f'📁 {category.capitalize()}'} for category in cls.catalog.categories]
+        keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
         
         # Сервисные кнопки
         keyboard.extend([
             [{'text': '➕ Своя подписка'}, {'text': '📊 Статистика'}],
+            [{'text': '📥 Импорт'}, {'text': '📤 Экспорт'}],
             [{'text': '💳 Поддержать проект'}, {'text': '🔙 Главное меню'}]
         ])
         
@@ -250,14 +3170,6 @@ class SubscriptionManager:
             'resize_keyboard': True
         }
     
-    @classmethod
-    def get_cancel_keyboard(cls):
-        """Клавиатура для отмены"""
-        return {
-            'keyboard': [[{'text': '❌ Отмена'}]],
-            'resize_keyboard': True
-        }
-    
     @classmethod
     def get_donation_message(cls):
         """Сообщение для поддержки проекта"""
@@ -276,369 +3188,1227 @@ class SubscriptionManager:
 
 *Проект осуществляется при поддержке бизнес-сообщества*'''
 
-class BotHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.db = DatabaseManager()
-        self.sub_manager = SubscriptionManager()
-        self.user_sessions = {}
-        super().__init__(*args, **kwargs)
+SUBSCRIPTIONS_KEYBOARD = SubscriptionManager._build_subscriptions_keyboard()
+
+class StaticReplies:
+    """Кэш статических ответов, собранный один раз при импорте"""
     
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write('Bot is running with persistent storage!'.encode('utf-8'))
+    START = PreparedReply(
+        '*Единый центр контроля подписок*\n\n*Официальный информационный партнер* в рамках реализации инициативы о защите прав потребителей\n\n*Проект реализуется при поддержке бизнес-сообщества*\n\n*Выберите действие:*',
+        MAIN_KEYBOARD
+    )
     
-    def do_POST(self):
+    SUBSCRIPTIONS = PreparedReply(
+        '*Управление подписками*\n\nВыберите категорию или воспользуйтесь сервисными кнопками:',
+        SUBSCRIPTIONS_KEYBOARD
+    )
+    
+    DONATION = PreparedReply(SubscriptionManager.get_donation_message(), MAIN_KEYBOARD)
+    
+    LAWS = PreparedReply(
+        '*Федеральный закон № 376-ФЗ*\n\n*С 15 октября 2025 года:*\n\n• Сервисы обязаны получать ваше прямое согласие на каждое списание\n• Запрещено автоматическое продление без подтверждения\n• Отмена подписки должна быть не сложнее, чем оформление\n\n*Проект реализуется при поддержке бизнес-сообщества*',
+        MAIN_KEYBOARD
+    )
+    
+    HELP = PreparedReply(
+        '*Помощь и поддержка*\n\n*Проект существует на средства пользователей*\n\n*Частые вопросы:*\n\n• Как добавить подписку? - Используйте меню "Управление подписками"\n• Как отменить подписку? - Используйте функцию удаления\n• Как перенести подписки? - Команды /export и /import\n• Поддержите развитие - используйте кнопку "Поддержать проект"\n\n*Напишите ваш вопрос - помогу разобраться!*',
+        MAIN_KEYBOARD
+    )
+    
+    WIZARD_NAME = PreparedReply(
+        '*Добавление своей подписки*\n\n*Шаг 1 из 3*\nВведите название подписки:',
+        CANCEL_KEYBOARD
+    )
+    
+    WIZARD_PRICE = PreparedReply(
+        '*Добавление своей подписки*\n\n*Шаг 2 из 3*\nВведите стоимость подписки в рублях:',
+        CANCEL_KEYBOARD
+    )
+    
+    INVALID_PRICE = PreparedReply(
+        'Неверный формат цены. Введите положительное число:',
+        CANCEL_KEYBOARD
+    )
+    
+    INVALID_DATE = PreparedReply(
+        'Неверный формат даты. Используйте:\n• 19.10 - для этого года\n• 19.10.26 - для следующего года\n• Или "Пропустить"',
+        CANCEL_KEYBOARD
+    )
+    
+    IMPORT_HELP = PreparedReply(
+        '*Импорт подписок*\n\nПришлите файл CSV или JSON Lines (.csv, .jsonl): каждая строка станет подпиской.\n\n*Поля:*\n• `service_name` - название\n• `price` - стоимость в рублях\n• `charge_day` - день списания (по умолчанию 1)\n• `end_date` - дата окончания ДД.ММ.ГГГГ (необязательно)\n• `category`, `is_active` - необязательно\n\nФайл из /export загружается без изменений.',
+        MAIN_KEYBOARD
+    )
+    
+    IMPORT_TOO_LARGE = PreparedReply('Файл слишком большой: Telegram отдает ботам файлы до 20 МБ.', MAIN_KEYBOARD, parse_mode=None)
+    
+    IMPORT_FAILED = PreparedReply(
+        'Не удалось прочитать файл. Проверьте, что это CSV или JSON Lines в кодировке UTF-8.',
+        MAIN_KEYBOARD, parse_mode=None
+    )
+    
+    EXPORT_DONE = PreparedReply(
+        '*Выгрузка готова*\n\nФайл можно отредактировать и загрузить обратно - просто пришлите его боту.',
+        MAIN_KEYBOARD
+    )
+    
+    NOTHING_TO_EXPORT = PreparedReply('У вас нет подписок для выгрузки.', MAIN_KEYBOARD, parse_mode=None)
+    
+    NOTHING_TO_DELETE = PreparedReply('У вас нет подписок для удаления.', MAIN_KEYBOARD, parse_mode=None)
+    
+    REQUEST_ERROR = PreparedReply('Ошибка при обработке запроса', MAIN_KEYBOARD)
+    
+    SLOW_DOWN = PreparedReply('Слишком много сообщений. Подождите немного и попробуйте снова.', parse_mode=None)
+
+# Один менеджер БД на процесс: соединение переиспользуется между запросами
+snapshot_store = SnapshotStore.from_env()
+db_manager = create_database(snapshots=snapshot_store)
+session_store = SessionStore(db_manager)
+update_deduplicator = UpdateDeduplicator(db_manager)
+rate_limiter = RateLimiter()
+
+class TelegramClient:
+    """Клиент Bot API с пулом keep-alive соединений.
+    
+    Адрес API задается TELEGRAM_API_URL, что позволяет подменить Telegram
+    локальным тестовым сервером.
+    """
+    
+    def __init__(self, token=None, api_url=None, timeout=10, pool_size=4):
+        self.token = token or os.environ.get('TELEGRAM_BOT_TOKEN', '')
+        parsed = urllib.parse.urlsplit(api_url or os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org'))
+        self._connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self._host = parsed.netloc
+        self._base_path = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool = []
+        self._lock = threading.Lock()
+    
+    def _acquire(self):
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+        return self._connection_class(self._host, timeout=self.timeout)
+    
+    def _release(self, conn):
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn)
+                return
+        conn.close()
+    
+    def call(self, method, payload, timeout=None, content_type='application/json'):
+        """Вызов метода Bot API; payload - словарь или готовые байты JSON"""
+        body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        path = f'{self._base_path}/bot{self.token}/{method}'
+        
+        # Одна повторная попытка: сервер мог закрыть простаивающее соединение
+        for attempt in range(2):
+            conn = self._acquire()
+            if timeout is not None:
+                conn.timeout = timeout
+            try:
+                conn.request('POST', path, body, {'Content-Type': content_type})
+                data = conn.getresponse().read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            conn.timeout = self.timeout
+            self._release(conn)
+            return json.loads(data) if data else {}
+    
+    def send_document(self, chat_id, filename, data, caption=None):
+        """Отправка файла (sendDocument) формой multipart/form-data"""
+        boundary = f'podpis{random.getrandbits(64):016x}'
+        fields = {'chat_id': str(chat_id)}
+        if caption:
+            fields['caption'] = caption
+        parts = [
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+            for name, value in fields.items()
+        ]
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="document"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8')
+        )
+        parts.append(data)
+        parts.append(f'\r\n--{boundary}--\r\n'.encode('ascii'))
+        return self.call('sendDocument', b''.join(parts), content_type=f'multipart/form-data; boundary={boundary}')
+    
+    @contextmanager
+    def open_file(self, file_id):
+        """Поток содержимого файла, присланного боту (getFile + скачивание).
+        
+        Файл читается по мере разбора на отдельном соединении, не из пула.
+        """
+        result = self.call('getFile', {'file_id': file_id})
+        if not result.get('ok'):
+            raise RuntimeError(result.get('description', 'getFile failed'))
+        conn = self._connection_class(self._host, timeout=self.timeout)
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            update = json.loads(post_data)
+            conn.request('GET', f'{self._base_path}/file/bot{self.token}/{result["result"]["file_path"]}')
+            response = conn.getresponse()
+            if response.status != 200:
+                raise RuntimeError(f'Ошибка загрузки файла: HTTP {response.status}')
+            yield response
+        finally:
+            conn.close()
+    
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for conn in pool:
+            conn.close()
+
+class SendQueue:
+    """Очередь исходящих сообщений с ограничением скорости (token bucket)"""
+    
+    def __init__(self, client, rate=25.0, burst=5):
+        self.client = client
+        # Telegram допускает около 30 сообщений в секунду на бота
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._items = []
+        self.sent = 0
+        self.failed = 0
+    
+    def put(self, payload, method=None):
+        """Добавление сообщения: словарь с полем method или готовые байты JSON"""
+        self._items.append((method or payload['method'], payload))
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def _wait_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.rate)
+    
+    def drain(self):
+        """Отправка всех сообщений очереди; возвращает число отправленных"""
+        items, self._items = self._items, []
+        for method, payload in items:
+            self._wait_token()
+            try:
+                result = self.client.call(method, payload)
+                if not result.get('ok', True):
+                    # 429: Telegram сообщает, сколько подождать перед повтором
+                    retry_after = result.get('parameters', {}).get('retry_after')
+                    if retry_after is None:
+                        raise RuntimeError(result.get('description', 'Bot API error'))
+                    time.sleep(retry_after)
+                    result = self.client.call(method, payload)
+                    if not result.get('ok', True):
+                        raise RuntimeError(result.get('description', 'Bot API error'))
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                log_error('Ошибка отправки сообщения', e)
+        return self.sent
+
+class ReminderScheduler:
+    """Поиск ближайших списаний и окончаний подписок с рассылкой дайджестов.
+    
+    О каждой дате напоминание приходит один раз: последняя дата, о которой
+    уже напомнили, хранится в bot_state. Ежедневный запуск напоминает о дате
+    за days_ahead дней, пропущенные запуски догоняются, а повторный запуск
+    в тот же день ничего не отправляет.
+    """
+    
+    STATE_KEY = 'reminders_through'
+    
+    def __init__(self, db, days_ahead=3):
+        self.db = db
+        self.days_ahead = days_ahead
+    
+    def _window(self, today):
+        """Даты от today до today + days_ahead, о которых еще не напоминали"""
+        first, last = today, today + timedelta(days=self.days_ahead)
+        through = self.db.get_state(self.STATE_KEY)
+        if through:
+            first = max(first, date.fromisoformat(through) + timedelta(days=1))
+        return [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+    
+    @staticmethod
+    def _charge_days(window):
+        """День списания -> ближайшая дата списания в окне"""
+        charge_days = {}
+        for day in window:
+            last_day = calendar.monthrange(day.year, day.month)[1]
+            # Подписки с 31 числом списываются в последний день короткого месяца
+            days = range(day.day, 32) if day.day == last_day else (day.day,)
+            for charge_day in days:
+                charge_days.setdefault(charge_day, day)
+        return charge_days
+    
+    def collect(self, today=None):
+        """Подписки к напоминанию, сгруппированные по чату (без отметки об отправке)"""
+        return self._collect(self._window(today or date.today()))
+    
+    def _collect(self, window):
+        if not window:
+            return {}
+        charge_days = self._charge_days(window)
+        
+        digests = {}
+        for kind, (_, user_id, service_name, price, charge_day, end_date) in self.db.iter_due_subscriptions(
+            list(charge_days), window[0], window[-1]
+        ):
+            digest = digests.setdefault(user_id, {'charge': [], 'expire': []})
+            if kind == 'charge':
+                digest['charge'].append((charge_days[charge_day], service_name, price))
+            else:
+                digest['expire'].append((date.fromisoformat(end_date), service_name, price))
+        return digests
+    
+    @staticmethod
+    def build_digest(chat_id, digest):
+        """Одно сообщение-дайджест на чат"""
+        lines = ['*Напоминание о подписках*']
+        if digest['charge']:
+            lines.append('\n*Скоро списание:*')
+            lines.extend(
+                f'• {name}: {format_rub(price)} руб - {day:%d.%m}'
+                for day, name, price in sorted(digest['charge'])
+            )
+        if digest['expire']:
+            lines.append('\n*Заканчиваются:*')
+            lines.extend(
+                f'• {name} - до {day:%d.%m.%Y}'
+                for day, name, _ in sorted(digest['expire'])
+            )
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': '\n'.join(lines),
+            'parse_mode': 'Markdown'
+        }
+    
+    def run(self, queue, today=None):
+        """Постановка дайджестов в очередь отправки; возвращает число чатов"""
+        # Окно отмечается до выборки: параллельный или повторный запуск
+        # крона не продублирует дайджесты. Выборка идет вне транзакции
+        with self.db.transaction():
+            window = self._window(today or date.today())
+            if window:
+                self.db.set_state(self.STATE_KEY, window[-1].isoformat())
+        digests = self._collect(window)
+        for chat_id, digest in digests.items():
+            queue.put(self.build_digest(chat_id, digest))
+        return len(digests)
+
+def send_reminders(db, client=None, days_ahead=None):
+    """Полный цикл рассылки напоминаний; возвращает счетчики"""
+    if days_ahead is None:
+        days_ahead = int(os.environ.get('REMINDER_DAYS', 3))
+    queue = SendQueue(client or TelegramClient())
+    chats = ReminderScheduler(db, days_ahead=days_ahead).run(queue)
+    queue.drain()
+    return {'chats': chats, 'sent': queue.sent, 'failed': queue.failed}
+
+class SubscriptionColumns:
+    """Столбцовая копия таблицы subscriptions одного шарда.
+    
+    Строка хранится по своему id в массивах фиксированной ширины, поэтому
+    память растет на ~17 байт на подписку, а повторно прочитанная строка
+    заменяет свой прежний вклад в агрегаты.
+    """
+    
+    def __init__(self):
+        # Номер названия и категории в словарях ниже; -1 - строки нет
+        self.service = array('i')
+        self.category = array('i')
+        self.price = array('q')
+        self.active = bytearray()
+        self.service_names = []
+        self.category_names = []
+        self._service_ids = {}
+        self._category_ids = {}
+        # Агрегаты по номеру: [активных, расход в месяц (коп.), отмененных]
+        self.by_service = []
+        self.by_category = []
+        # Цена (коп.) -> число активных подписок
+        self.prices = {}
+        # Переходы is_active, замеченные при инкрементальных обновлениях
+        self.cancellations = 0
+        self.reactivations = 0
+        self.watermark = None
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def _intern(value, ids, names, aggregates):
+        index = ids.get(value)
+        if index is None:
+            index = ids[value] = len(names)
+            names.append(value)
+            aggregates.append([0, 0, 0])
+        return index
+    
+    def _contribute(self, service, category, price, active, sign):
+        by_service = self.by_service[service]
+        by_category = self.by_category[category]
+        if active:
+            by_service[0] += sign
+            by_service[1] += sign * price
+            by_category[0] += sign
+            by_category[1] += sign * price
+            count = self.prices.get(price, 0) + sign
+            if count:
+                self.prices[price] = count
+            else:
+                self.prices.pop(price, None)
+        else:
+            by_service[2] += sign
+            by_category[2] += sign
+    
+    def apply(self, rows):
+        """Применение порции строк (id, service_name, category, price, is_active)"""
+        ids, names, categories, prices, actives = zip(*rows)
+        
+        grow = max(ids) + 1 - len(self.service)
+        if grow > 0:
+            self.service.extend(array('i', [-1]) * grow)
+            self.category.extend(array('i', [0]) * grow)
+            self.price.extend(array('q', [0]) * grow)
+            self.active.extend(bytes(grow))
+        
+        for row_id, name, category, price, active in zip(ids, names, categories, prices, actives):
+            active = 1 if active else 0
+            price = int(price)
+            previous = self.service[row_id]
+            if previous >= 0:
+                was_active = self.active[row_id]
+                if was_active and not active:
+                    self.cancellations += 1
+                elif active and not was_active:
+                    self.reactivations += 1
+                self._contribute(previous, self.category[row_id], self.price[row_id], was_active, -1)
             
-            if 'message' in update:
+            service = self._intern(name, self._service_ids, self.service_names, self.by_service)
+            category = self._intern(category, self._category_ids, self.category_names, self.by_category)
+            self.service[row_id] = service
+            self.category[row_id] = category
+            self.price[row_id] = price
+            self.active[row_id] = active
+            self._contribute(service, category, price, active, 1)
+    
+    def snapshot(self):
+        """Копия агрегатов для слияния шардов"""
+        return {
+            'services': {name: list(self.by_service[index]) for index, name in enumerate(self.service_names)},
+            'categories': {name: list(self.by_category[index]) for index, name in enumerate(self.category_names)},
+            'prices': dict(self.prices),
+            'cancellations': self.cancellations,
+            'reactivations': self.reactivations
+        }
+
+class FleetAnalytics:
+    """Аналитика расходов по всей базе для администратора.
+    
+    Подписки читаются потоково, порциями, в SubscriptionColumns каждого
+    шарда (шарды - параллельно). Первый отчет читает таблицу целиком,
+    следующие - только строки с событиями журнала после отметки прошлого
+    чтения, поэтому повторный расчет на большой базе почти бесплатен.
+    """
+    
+    CHUNK_SIZE = 5000
+    # Границы корзин распределения цен, копейки
+    PRICE_BUCKETS = (10000, 20000, 30000, 50000, 100000, 200000)
+    
+    def __init__(self, db):
+        self.db = db
+        self._columns = {}
+        self._lock = threading.Lock()
+    
+    def _refresh(self, shard):
+        with self._lock:
+            columns = self._columns.get(shard.db_path)
+            if columns is None:
+                columns = self._columns[shard.db_path] = SubscriptionColumns()
+        
+        with columns.lock:
+            # Отметка берется до чтения строк: изменения после нее попадут и
+            # в это чтение, и в следующее, а повторное применение строки
+            # заменяет ее прежний вклад
+            mark = shard.subscription_change_mark()
+            for rows in shard.iter_subscription_changes(columns.watermark, self.CHUNK_SIZE):
+                columns.apply(rows)
+            columns.watermark = mark
+            return columns.snapshot()
+    
+    def report(self, top=20):
+        """Сводный отчет по всем шардам; деньги - в копейках"""
+        services, categories, prices = {}, {}, {}
+        cancellations = reactivations = 0
+        for snapshot in self.db.map_shards(self._refresh):
+            for target, source in ((services, snapshot['services']), (categories, snapshot['categories'])):
+                for name, values in source.items():
+                    total = target.setdefault(name, [0, 0, 0])
+                    for index, value in enumerate(values):
+                        total[index] += value
+            for price, count in snapshot['prices'].items():
+                prices[price] = prices.get(price, 0) + count
+            cancellations += snapshot['cancellations']
+            reactivations += snapshot['reactivations']
+        
+        active = sum(values[0] for values in services.values())
+        cancelled = sum(values[2] for values in services.values())
+        
+        def rows(aggregates, limit=None):
+            ordered = sorted(aggregates.items(), key=lambda item: (-item[1][1], item[0]))
+            return [
+                {'name': name, 'active': values[0], 'cancelled': values[2], 'monthly_spend_kopecks': values[1]}
+                for name, values in ordered[:limit]
+            ]
+        
+        return {
+            'active': active,
+            'cancelled': cancelled,
+            'churn_rate': round(cancelled / (active + cancelled), 4) if active + cancelled else 0,
+            'transitions': {'cancelled': cancellations, 'reactivated': reactivations},
+            'monthly_spend_kopecks': sum(values[1] for values in services.values()),
+            'services': rows(services, top),
+            'categories': rows(categories),
+            'price_distribution': self._price_distribution(prices)
+        }
+    
+    def _price_distribution(self, prices):
+        buckets = [0] * (len(self.PRICE_BUCKETS) + 1)
+        for price, count in prices.items():
+            buckets[bisect_left(self.PRICE_BUCKETS, price)] += count
+        
+        total = sum(prices.values())
+        result = {
+            'buckets': [
+                {'le_kopecks': bound, 'count': count}
+                for bound, count in zip(self.PRICE_BUCKETS + (None,), buckets)
+            ],
+            'mean_kopecks': round(sum(price * count for price, count in prices.items()) / total) if total else 0
+        }
+        
+        # Перцентили по отсортированным ценам с накопленными счетчиками
+        ordered = sorted(prices.items())
+        for key, quantile in (('p50_kopecks', 0.5), ('p90_kopecks', 0.9), ('p99_kopecks', 0.99)):
+            result[key] = 0
+            cumulative = 0
+            for price, count in ordered:
+                cumulative += count
+                if cumulative >= quantile * total:
+                    result[key] = price
+                    break
+        return result
+
+fleet_analytics = FleetAnalytics(db_manager)
+
+# Разбор текста кнопок и дат мастера
+DELETE_BUTTON_RE = re.compile(r'(.+) \((\d+(?:[.,]\d+)?) руб\)')
+SHORT_DATE_RE = re.compile(r'^\d{1,2}\.\d{1,2}$')
+FULL_DATE_RE = re.compile(r'^\d{1,2}\.\d{1,2}\.\d{2}$')
+ISO_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+# Кнопка подсказки каталога: добавить введенный текст как свою подписку
+CUSTOM_SUBSCRIPTION_PREFIX = '✍️ Своя: '
+
+def route(*commands, prefix=None, static=False):
+    """Декларативная регистрация обработчика команды.
+    
+    Точные команды перечисляются позиционно, prefix задает префиксную
+    команду: обработчик получает текст после префикса. static=True помечает
+    команды, ответ на которые не зависит от БД и сессии: они отвечают до
+    чтения сессии и проверки update_id в SQLite. Статическая команда
+    показывает меню и поэтому прерывает мастер добавления подписки.
+    """
+    def decorator(func):
+        func.route_commands = commands
+        func.route_prefix = prefix
+        func.route_static = static
+        return func
+    return decorator
+
+def callback(action):
+    """Регистрация обработчика inline-кнопки по коду действия"""
+    def decorator(func):
+        func.callback_action = action
+        return func
+    return decorator
+
+# Коды действий в callback_data (лимит Telegram - 64 байта)
+CALLBACK_DELETE = 'd'
+CALLBACK_CATEGORY = 'c'
+CALLBACK_SERVICE = 's'
+
+class CommandRouter:
+    """Маршрутизатор команд: словарь точных команд и префиксное дерево"""
+    
+    # Ключ в узле дерева, под которым хранится маршрут
+    _END = ''
+    
+    def __init__(self):
+        self._exact = {}
+        self._static = {}
+        self._trie = {}
+        self.hits = {}
+    
+    def add(self, command, handler, name, static=False):
+        """Маршрут с точным совпадением текста"""
+        self._exact[command] = (handler, name)
+        if static:
+            self._static[command] = (handler, name)
+        self.hits.setdefault(name, 0)
+        metrics.route_histogram(name)
+    
+    def add_prefix(self, prefix, handler, name):
+        """Маршрут по префиксу текста"""
+        node = self._trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[self._END] = (handler, name, len(prefix))
+        self.hits.setdefault(name, 0)
+        metrics.route_histogram(name)
+    
+    def resolve(self, text):
+        """(обработчик, имя маршрута, аргумент) или None.
+        
+        Стоимость поиска зависит от длины текста, а не от числа маршрутов.
+        """
+        route = self._exact.get(text)
+        if route is not None:
+            self.hits[route[1]] += 1
+            return route[0], route[1], text
+        
+        node = self._trie
+        match = None
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            if self._END in node:
+                match = node[self._END]
+        
+        if match is not None:
+            handler, name, length = match
+            self.hits[name] += 1
+            return handler, name, text[length:]
+        return None
+    
+    def resolve_static(self, text):
+        """(обработчик, имя маршрута) статической команды или None"""
+        route = self._static.get(text)
+        if route is not None:
+            self.hits[route[1]] += 1
+        return route
+    
+    def record(self, name):
+        """Учет обращения к маршруту вне таблицы (например, мастер или свободный текст)"""
+        self.hits[name] = self.hits.get(name, 0) + 1
+
+class MessageProcessor:
+    """Обработка входящих сообщений бота независимо от HTTP-обвязки"""
+    
+    # Bot API отдает через getFile файлы до 20 МБ
+    MAX_IMPORT_SIZE = 20 * 1024 * 1024
+    
+    def __init__(self, db=None, sessions=None, deduplicator=None, limiter=None, catalog=None, client=None,
+                 keyboards=None):
+        self.db = db or db_manager
+        self.sessions = sessions or session_store
+        self.deduplicator = deduplicator or update_deduplicator
+        self.limiter = limiter or rate_limiter
+        self.catalog = catalog or CATALOG
+        # Файлы (выгрузка и загрузка) идут через Bot API, а не ответом вебхука
+        self.client = client or TelegramClient()
+        self.keyboards = keyboards or KeyboardTracker()
+        self.profiler = SlowUpdateProfiler()
+        self.sub_manager = SubscriptionManager()
+        self.router = self._build_router()
+        self.callbacks = {
+            handler.callback_action: handler
+            for handler in (getattr(self, attr) for attr in dir(type(self)))
+            if getattr(handler, 'callback_action', None)
+        }
+    
+    def _build_router(self):
+        router = CommandRouter()
+        for attr in dir(type(self)):
+            handler = getattr(self, attr)
+            commands = getattr(handler, 'route_commands', None)
+            if commands is None:
+                continue
+            name = attr.lstrip('_')
+            for command in commands:
+                router.add(command, handler, name, handler.route_static)
+            if handler.route_prefix:
+                router.add_prefix(handler.route_prefix, handler, name)
+        return router
+    
+    def handle_update(self, update):
+        """Обработка объекта Update; возвращает тело ответа вебхука или None"""
+        try:
+            result = self.dispatch_update(update)
+        finally:
+            # Ответ вебхука - одно действие (правка сообщения), поэтому
+            # нажатие кнопки подтверждается отдельным вызовом Bot API
+            answer = self.callback_answer(update)
+            if answer is not None:
+                try:
+                    self.client.call('answerCallbackQuery', answer)
+                except Exception as e:
+                    log_error('Ошибка ответа на нажатие кнопки', e)
+        if result is None:
+            return None
+        response, chat_id = result
+        return encode_response(response, chat_id)
+    
+    @staticmethod
+    def callback_answer(update):
+        """Вызов answerCallbackQuery для нажатия inline-кнопки или None.
+        
+        Пока бот не ответит, Telegram показывает на кнопке индикатор
+        загрузки. Отвечать нужно на любое нажатие, в том числе на кнопку
+        с устаревшими или неверными данными.
+        """
+        query = update.get('callback_query')
+        if query is None or 'id' not in query:
+            return None
+        return {'method': 'answerCallbackQuery', 'callback_query_id': query['id']}
+    
+    def dispatch_update(self, update):
+        """Обработка объекта Update; возвращает (ответ, chat_id) или None"""
+        chat_id = self._update_chat_id(update)
+        if chat_id is None:
+            return None
+        
+        # Ограничение частоты проверяется в памяти, до любой работы с БД
+        verdict = self.limiter.allow(chat_id, update.get('message', {}).get('date'))
+        if verdict != 'ok':
+            self.router.record('rate_limited')
+            return (StaticReplies.SLOW_DOWN, chat_id) if verdict == 'notify' else None
+        
+        if not self.limiter.acquire():
+            self.router.record('overloaded')
+            return StaticReplies.SLOW_DOWN, chat_id
+        started = time.perf_counter()
+        try:
+            result = self.profiler.run(self._dispatch_update, update)
+        finally:
+            self.limiter.release()
+            metrics.observe_update(time.perf_counter() - started)
+        if result is None:
+            return None
+        
+        # Клавиатура, которую чат уже показывает, не отправляется повторно
+        response = self.keyboards.apply(*result)
+        return (response, chat_id) if response is not None else None
+    
+    @staticmethod
+    def _update_chat_id(update):
+        if 'message' in update:
+            return update['message']['chat']['id']
+        message = update.get('callback_query', {}).get('message')
+        return message['chat']['id'] if message else None
+    
+    def _dispatch_update(self, update):
+        update_id = update.get('update_id')
+        
+        # Статические команды отвечают без обращения к SQLite; повторы
+        # отсекаются по кольцу update_id в памяти
+        if 'message' in update:
+            text = update['message'].get('text', '').strip()
+            static = self.router.resolve_static(text)
+            if static is not None:
+                if update_id is not None and not self.deduplicator.check_recent(update_id):
+                    self.router.record('duplicate')
+                    return None
+                started = time.perf_counter()
+                handler, name = static
                 chat_id = update['message']['chat']['id']
-                text = update['message'].get('text', '').strip()
-                
-                response = self.process_message(chat_id, text)
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(response).encode('utf-8'))
-                return
-                
-        except Exception as e:
-            print(f'Error: {e}')
+                # Меню прерывает мастер, иначе следующая кнопка стала бы
+                # ответом на его шаг; сброс сессии не обращается к SQLite
+                self.sessions.discard(chat_id)
+                response = handler(chat_id, text)
+                metrics.observe_route(name, time.perf_counter() - started)
+                return response, chat_id
         
-        self.send_response(200)
-        self.end_headers()
+        # Повторная доставка отсекается до маршрутизации и работы с БД
+        if update_id is not None and not self.deduplicator.check_and_mark(update_id, self._update_chat_id(update)):
+            self.router.record('duplicate')
+            return None
+        
+        if 'message' in update:
+            chat_id = update['message']['chat']['id']
+            if 'document' in update['message']:
+                return self.process_document(chat_id, update['message']['document']), chat_id
+            text = update['message'].get('text', '').strip()
+            return self.process_message(chat_id, text), chat_id
+        
+        if 'callback_query' in update:
+            query = update['callback_query']
+            message = query.get('message')
+            if message:
+                chat_id = message['chat']['id']
+                response = self.process_callback(chat_id, message['message_id'], query.get('data', ''))
+                if response is not None:
+                    return response, chat_id
+        return None
     
     def process_message(self, chat_id, text):
+        started = time.perf_counter()
+        
         # Проверяем активные сессии
-        if chat_id in self.user_sessions and self.user_sessions[chat_id].get('adding_subscription'):
-            return self._handle_subscription_flow(chat_id, text)
+        session = self.sessions.get(chat_id)
+        if session and session.get('adding_subscription'):
+            name = 'subscription_flow'
+            self.router.record(name)
+            response = self._handle_subscription_flow(chat_id, text, session)
+        else:
+            resolved = self.router.resolve(text)
+            if resolved is not None:
+                handler, name, argument = resolved
+                response = handler(chat_id, argument)
+            else:
+                # Название сервиса - карточка каталога; похожее название -
+                # подсказка с выбором; иначе текст - название своей подписки
+                entry = self.catalog.lookup(text)
+                suggestion = self.catalog.match(text) if entry is None else None
+                if entry is not None:
+                    name = 'service_card'
+                    response = self.catalog.card(entry['name'])
+                elif suggestion is not None:
+                    name = 'service_suggestion'
+                    response = self._suggest_service(chat_id, text, suggestion)
+                else:
+                    name = 'free_text'
+                    response = self._start_free_text_subscription(chat_id, text)
+                self.router.record(name)
         
-        # Обработка команды отмены
-        if text == '❌ Отмена':
-            if chat_id in self.user_sessions:
-                del self.user_sessions[chat_id]
-            return self.process_message(chat_id, 'Главное меню')
+        metrics.observe_route(name, time.perf_counter() - started)
+        return response
+    
+    def process_document(self, chat_id, document):
+        """Загрузка подписок из присланного файла CSV или JSON Lines"""
+        started = time.perf_counter()
+        self.router.record('import_file')
+        try:
+            fmt = export_format(document.get('file_name'))
+        except ValueError:
+            response = StaticReplies.IMPORT_HELP
+        else:
+            if document.get('file_size', 0) > self.MAX_IMPORT_SIZE:
+                response = StaticReplies.IMPORT_TOO_LARGE
+            else:
+                response = self._import_file(chat_id, document['file_id'], fmt)
+        metrics.observe_route('import_file', time.perf_counter() - started)
+        return response
+    
+    def _import_file(self, chat_id, file_id, fmt):
+        try:
+            with self.client.open_file(file_id) as stream:
+                report = SubscriptionImporter(self.db, chat_id, self.catalog).run(iter_import_records(stream, fmt))
+        except Exception as e:
+            log_error('Ошибка импорта подписок', e)
+            return StaticReplies.IMPORT_FAILED
         
-        if text == '/start' or text == '🔙 Главное меню':
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': '*Единый центр контроля подписок*\n\n*Официальный информационный партнер* в рамках реализации инициативы о защите прав потребителей\n\n*Проект реализуется при поддержке бизнес-сообщества*\n\n*Выберите действие:*',
-                'reply_markup': self.sub_manager.get_main_keyboard(),
-                'parse_mode': 'Markdown'
-            }
+        message = f"""*Импорт завершен*
+
+*Добавлено:* {report['imported']}
+*Уже были в списке:* {report['skipped']}
+*С ошибками:* {report['invalid']}"""
+        if report['errors']:
+            message += '\n\n```\n' + '\n'.join(report['errors'][:5]) + '\n```'
         
-        elif text == 'Управление подписками' or text == '/subs':
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': '*Управление подписками*\n\nВыберите категорию или воспользуйтесь сервисными кнопками:',
-                'reply_markup': self.sub_manager.get_subscriptions_keyboard(),
-                'parse_mode': 'Markdown'
-            }
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': message,
+            'parse_mode': 'Markdown',
+            'reply_markup': self.sub_manager.get_main_keyboard()
+        }
+    
+    @route('❌ Отмена')
+    def _cancel(self, chat_id, text):
+        if self.sessions.get(chat_id) is not None:
+            self.sessions.delete(chat_id)
+        return StaticReplies.START
+    
+    @route('/start', '🔙 Главное меню', static=True)
+    def _main_menu(self, chat_id, text):
+        # Сессию мастера сбрасывает _dispatch_update, как для любой
+        # статической команды. /start всегда возвращает клавиатуру, даже если
+        # чат ее уже видел
+        self.keyboards.forget(chat_id)
+        return StaticReplies.START
+    
+    @route('Управление подписками', '/subs', '📋 К подпискам', '⋯', static=True)
+    def _subscriptions_menu(self, chat_id, text):
+        return StaticReplies.SUBSCRIPTIONS
+    
+    @route(prefix='📁 ')
+    def _category(self, chat_id, title):
+        category_index = self.catalog.category_index(title)
+        if category_index is None:
+            return StaticReplies.SUBSCRIPTIONS
         
-        elif text == 'Мои подписки':
-            subscriptions = self.db.get_user_subscriptions(chat_id)
-            stats = self.db.get_user_stats(chat_id)
-            
-            if subscriptions:
-                total = sum(price for _, price, _, _, _ in subscriptions)
-                sub_list = "\n".join([
-                    f"• {name}: {price} руб ({day} число)" + 
-                    (f" - до {end_date}" if end_date else "")
-                    for name, price, day, end_date, _ in subscriptions
-                ])
-                
-                message = f"""*Ваши подписки*
+        text, keyboard = self.catalog.page(category_index, 0)
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': text,
+            'parse_mode': 'Markdown',
+            'reply_markup': keyboard
+        }
+    
+    @route('Мои подписки')
+    def _my_subscriptions(self, chat_id, text):
+        subscriptions = self.db.get_user_subscriptions(chat_id)
+        stats = self.db.get_user_stats(chat_id)
+        
+        if subscriptions:
+            total = stats['monthly_total']
+            sub_list = "\n".join([
+                f"• {name}: {format_rub(price)} руб ({day} число)" + 
+                (f" - до {format_end_date(end_date)}" if end_date else "")
+                for _, name, price, day, end_date, _ in subscriptions
+            ])
+            
+            message = f"""*Ваши подписки*
 
 {sub_list}
 
-*Итого в месяц:* {total} руб
-*Итого в год:* {total * 12} руб
+*Итого в месяц:* {format_rub(total)} руб
+*Итого в год:* {format_rub(stats['yearly_total'])} руб
 *Активных подписок:* {stats['active_count']}"""
-            else:
-                message = "*У вас пока нет активных подписок*\n\nДобавьте первую подписку через меню управления!"
-            
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': message,
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_main_keyboard()
-            }
+        else:
+            message = "*У вас пока нет активных подписок*\n\nДобавьте первую подписку через меню управления!"
+        
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': message,
+            'parse_mode': 'Markdown',
+            'reply_markup': self.sub_manager.get_main_keyboard()
+        }
+    
+    @route('Статистика', '📊 Статистика', 'Финансовая аналитика')
+    def _statistics(self, chat_id, text):
+        stats = self.db.get_user_stats(chat_id)
+        history = self.db.get_spend_history(chat_id)
         
-        elif text == 'Статистика' or text == '📊 Статистика' or text == 'Финансовая аналитика':
-            stats = self.db.get_user_stats(chat_id)
-            subscriptions = self.db.get_user_subscriptions(chat_id)
+        if stats['active_count']:
+            total_monthly = stats['monthly_total']
+            total_yearly = stats['yearly_total']
             
-            if subscriptions:
-                total_monthly = stats['monthly_total']
-                total_yearly = stats['yearly_total']
-                
-                # Аналитика по категориям
-                categories = {}
-                for name, price, _, _, _ in subscriptions:
-                    info = self.sub_manager.POPULAR_SUBSCRIPTIONS.get(name, {'category': 'другое'})
-                    category = info['category']
-                    if category not in categories:
-                        categories[category] = 0
-                    categories[category] += price
-                
-                category_analysis = "\n".join([f"• {cat}: {price} руб" for cat, price in categories.items()])
-                
-                message = f"""*Финансовая аналитика*
+            # Аналитика по категориям из агрегатов пользователя
+            category_analysis = "\n".join([f"• {cat}: {format_rub(price)} руб" for cat, price in stats['categories'].items()])
+            
+            message = f"""*Финансовая аналитика*
 
-*Ежемесячные расходы:* {total_monthly} руб
-*Годовые расходы:* {total_yearly} руб
+*Ежемесячные расходы:* {format_rub(total_monthly)} руб
+*Годовые расходы:* {format_rub(total_yearly)} руб
 
 *Распределение по категориям:*
 {category_analysis}
 
 *Отменено подписок:* {stats['cancelled_count']}
+*Сэкономлено отменами:* {format_rub(stats['total_saved'])} руб
+
+*За последние 12 месяцев:*
+Потрачено {format_rub(history['total_spend'])} руб, сэкономлено {format_rub(history['total_saved'])} руб
 
 *Проект поддерживается пользователями*"""
-            else:
-                message = "*Статистика*\n\nУ вас пока нет активных подписок для анализа."
-            
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': message,
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_main_keyboard()
-            }
-        
-        elif text == '➕ Своя подписка' or text == 'Быстро добавить':
-            self.user_sessions[chat_id] = {
-                'adding_subscription': True,
-                'step': 'name'
-            }
-            
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': '*Добавление своей подписки*\n\n*Шаг 1 из 3*\nВведите название подписки:',
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_cancel_keyboard()
-            }
+        else:
+            message = "*Статистика*\n\nУ вас пока нет активных подписок для анализа."
         
-        elif text == '💳 Поддержать проект' or text == 'Поддержать проект':
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': self.sub_manager.get_donation_message(),
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_main_keyboard()
-            }
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': message,
+            'parse_mode': 'Markdown',
+            'reply_markup': self.sub_manager.get_main_keyboard()
+        }
+    
+    @route('➕ Своя подписка', 'Быстро добавить')
+    def _custom_subscription(self, chat_id, text):
+        self.sessions.set(chat_id, {
+            'adding_subscription': True,
+            'step': 'name'
+        })
         
-        elif text in self.sub_manager.POPULAR_SUBSCRIPTIONS:
-            info = self.sub_manager.get_subscription_info(text)
-            keyboard = {
-                'keyboard': [
-                    [{'text': f'✅ Добавить {text}'}],
-                    [{'text': '📋 К подпискам'}, {'text': '🔙 Главное меню'}]
-                ],
-                'resize_keyboard': True
-            }
-            
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': f'*{text}*\n\n*Стоимость:* {info["price"]} руб/мес\n*Категория:* {info["category"]}\n*Описание:* {info["description"]}\n\nДобавить для отслеживания?',
-                'reply_markup': keyboard,
-                'parse_mode': 'Markdown'
-            }
+        return StaticReplies.WIZARD_NAME
+    
+    @route('💳 Поддержать проект', 'Поддержать проект', static=True)
+    def _donation(self, chat_id, text):
+        return StaticReplies.DONATION
+    
+    @route('О законе', '/laws', static=True)
+    def _laws(self, chat_id, text):
+        return StaticReplies.LAWS
+    
+    @route('Помощь', '/help', static=True)
+    def _help(self, chat_id, text):
+        return StaticReplies.HELP
+    
+    @route('/import', '📥 Импорт', static=True)
+    def _import_help(self, chat_id, text):
+        return StaticReplies.IMPORT_HELP
+    
+    @route('/export', '📤 Экспорт')
+    def _export(self, chat_id, text):
+        data = b''.join(iter_export(self.db.iter_export_rows(chat_id), 'csv'))
+        # Только строка заголовков - выгружать нечего
+        if data.count(b'\n') < 2:
+            return StaticReplies.NOTHING_TO_EXPORT
+        try:
+            result = self.client.send_document(chat_id, 'podpiscontrol.csv', data, 'Ваши подписки')
+            if not result.get('ok'):
+                raise RuntimeError(result.get('description', 'sendDocument failed'))
+        except Exception as e:
+            log_error('Ошибка выгрузки подписок', e)
+            return StaticReplies.REQUEST_ERROR
+        return StaticReplies.EXPORT_DONE
+    
+    @route(prefix='✅ Добавить ')
+    def _add_popular(self, chat_id, service_name):
+        info = self.sub_manager.get_subscription_info(service_name)
+        if info is None:
+            return StaticReplies.REQUEST_ERROR
         
-        elif text.startswith('✅ Добавить '):
-            service_name = text.replace('✅ Добавить ', '')
-            info = self.sub_manager.get_subscription_info(service_name)
-            
-            success, message = self.db.add_subscription(chat_id, service_name, info['price'], 1)
-            
-            response_text = f'*{message}*\n\n*Подписка:* {service_name}\n*Стоимость:* {info["price"]} руб/мес\n*Категория:* {info["category"]}'
-            
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': response_text,
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_main_keyboard()
-            }
+        success, message = self.db.add_subscription(chat_id, service_name, info['price'], 1, category=info['category'])
         
-        elif text == '🗑️ Удалить подписку':
-            subscriptions = self.db.get_user_subscriptions(chat_id)
-            
-            if subscriptions:
-                keyboard = []
-                for name, price, day, end_date, _ in subscriptions:
-                    display_name = f"{name} ({price} руб)"
-                    keyboard.append([{'text': f'❌ Удалить {display_name}'}])
-                keyboard.append([{'text': '📋 К подпискам'}, {'text': '🔙 Главное меню'}])
-                
-                return {
-                    'method': 'sendMessage',
-                    'chat_id': chat_id,
-                    'text': '*Удаление подписки*\n\nВыберите подписку для удаления:',
-                    'reply_markup': {'keyboard': keyboard, 'resize_keyboard': True},
-                    'parse_mode': 'Markdown'
-                }
-            else:
-                return {
-                    'method': 'sendMessage',
-                    'chat_id': chat_id,
-                    'text': 'У вас нет подписок для удаления.',
-                    'reply_markup': self.sub_manager.get_main_keyboard()
-                }
+        response_text = f'*{message}*\n\n*Подписка:* {service_name}\n*Стоимость:* {format_rub(info["price"])} руб/мес\n*Категория:* {info["category"]}'
         
-        elif text.startswith('❌ Удалить '):
-            # Извлекаем название подписки из текста
-            import re
-            match = re.match(r'❌ Удалить (.+) \(\d+ руб\)', text)
-            if match:
-                service_name = match.group(1).strip()
-                success, message = self.db.delete_subscription(chat_id, service_name)
-                
-                response_text = f'*{message}*\n\nПодписка: {service_name}'
-            else:
-                response_text = 'Ошибка при обработке запроса'
-            
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': response_text,
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_main_keyboard()
-            }
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': response_text,
+            'parse_mode': 'Markdown',
+            'reply_markup': self.sub_manager.get_main_keyboard()
+        }
+    
+    @route('🗑️ Удалить подписку')
+    def _delete_menu(self, chat_id, text):
+        subscriptions = self.db.get_user_subscriptions(chat_id)
         
-        elif text in ['📋 К подпискам', '⋯', '📁 ']:
-            return self.process_message(chat_id, 'Управление подписками')
+        if not subscriptions:
+            return StaticReplies.NOTHING_TO_DELETE
         
-        elif text == 'О законе' or text == '/laws':
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': '*Федеральный закон № 376-ФЗ*\n\n*С 15 октября 2025 года:*\n\n• Сервисы обязаны получать ваше прямое согласие на каждое списание\n• Запрещено автоматическое продление без подтверждения\n• Отмена подписки должна быть не сложнее, чем оформление\n\n*Проект реализуется при поддержке бизнес-сообщества*',
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_main_keyboard()
-            }
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': '*Удаление подписки*\n\nВыберите подписку для удаления:',
+            'reply_markup': self._delete_keyboard(subscriptions),
+            'parse_mode': 'Markdown'
+        }
+    
+    @staticmethod
+    def _delete_keyboard(subscriptions):
+        """Inline-кнопки удаления: callback_data содержит код действия и id подписки"""
+        return {
+            'inline_keyboard': [
+                [{'text': f'❌ {name} ({format_rub(price)} руб)', 'callback_data': f'{CALLBACK_DELETE}:{sub_id}'}]
+                for sub_id, name, price, _, _, _ in subscriptions
+            ]
+        }
+    
+    def process_callback(self, chat_id, message_id, data):
+        """Обработка нажатия inline-кнопки; ответ редактирует исходное сообщение"""
+        action, _, argument = data.partition(':')
+        handler = self.callbacks.get(action)
+        if handler is None:
+            self.router.record('callback_unknown')
+            return None
         
-        elif text == 'Помощь' or text == '/help':
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': '*Помощь и поддержка*\n\n*Проект существует на средства пользователей*\n\n*Частые вопросы:*\n\n• Как добавить подписку? - Используйте меню "Управление подписками"\n• Как отменить подписку? - Используйте функцию удаления\n• Поддержите развитие - используйте кнопку "Поддержать проект"\n\n*Напишите ваш вопрос - помогу разобраться!*',
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_main_keyboard()
-            }
+        self.router.record(f'callback_{action}')
+        return handler(chat_id, message_id, argument)
+    
+    @callback(CALLBACK_DELETE)
+    def _callback_delete(self, chat_id, message_id, argument):
+        try:
+            subscription_id = int(argument)
+        except ValueError:
+            return None
         
+        # Название берем до удаления: список, скорее всего, уже в кэше
+        names = {sub_id: name for sub_id, name, *_ in self.db.get_user_subscriptions(chat_id)}
+        success, message = self.db.delete_subscription_by_id(chat_id, subscription_id)
+        
+        if success:
+            text = f'*{message}*\n\nПодписка: {names.get(subscription_id, "")}'
         else:
-            # Автоматическое добавление произвольного текста как подписки
-            self.user_sessions[chat_id] = {
-                'adding_subscription': True,
-                'step': 'name',
-                'name': text
-            }
-            
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': f'*Добавление подписки*\n\nВы ввели: *{text}*\n\n*Шаг 2 из 3*\nВведите стоимость подписки в рублях:',
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_cancel_keyboard()
+            text = '*Подписка уже удалена*'
+        
+        remaining = self.db.get_user_subscriptions(chat_id)
+        response = {
+            'method': 'editMessageText',
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text + ('\n\nВыберите подписку для удаления:' if remaining else ''),
+            'parse_mode': 'Markdown'
+        }
+        if remaining:
+            response['reply_markup'] = self._delete_keyboard(remaining)
+        return response
+    
+    @callback(CALLBACK_CATEGORY)
+    def _callback_category(self, chat_id, message_id, argument):
+        try:
+            category_index, page = map(int, argument.split(':'))
+        except ValueError:
+            return None
+        
+        page = self.catalog.page(category_index, page)
+        if page is None:
+            return None
+        text, keyboard = page
+        return {
+            'method': 'editMessageText',
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text,
+            'parse_mode': 'Markdown',
+            'reply_markup': keyboard
+        }
+    
+    @callback(CALLBACK_SERVICE)
+    def _callback_service(self, chat_id, message_id, argument):
+        try:
+            name = self.catalog.service_by_index(int(argument))
+        except ValueError:
+            return None
+        # Карточка - новым сообщением: ей нужна reply-клавиатура с кнопкой добавления
+        return self.catalog.card(name) if name is not None else None
+    
+    @route(prefix='❌ Удалить ')
+    def _delete_subscription(self, chat_id, argument):
+        # Кнопки старой reply-клавиатуры, которые еще остались у пользователей:
+        # извлекаем название подписки из текста кнопки
+        match = DELETE_BUTTON_RE.match(argument)
+        if not match:
+            return StaticReplies.REQUEST_ERROR
+        
+        service_name = match.group(1).strip()
+        success, message = self.db.delete_subscription(chat_id, service_name)
+        
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': f'*{message}*\n\nПодписка: {service_name}',
+            'parse_mode': 'Markdown',
+            'reply_markup': self.sub_manager.get_main_keyboard()
+        }
+    
+    @route(prefix=CUSTOM_SUBSCRIPTION_PREFIX)
+    def _add_custom(self, chat_id, text):
+        return self._start_free_text_subscription(chat_id, text)
+    
+    def _suggest_service(self, chat_id, text, entry):
+        """Похожий сервис каталога: карточка по кнопке или своя подписка с введенным названием"""
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': f'Вы имели в виду *{entry["name"]}*?\n\nИли добавьте *{text}* как свою подписку.',
+            'parse_mode': 'Markdown',
+            'reply_markup': {
+                'keyboard': [
+                    [{'text': entry['name']}],
+                    [{'text': f'{CUSTOM_SUBSCRIPTION_PREFIX}{text}'}],
+                    [{'text': '🔙 Главное меню'}]
+                ],
+                'resize_keyboard': True,
+                'one_time_keyboard': True
             }
+        }
     
-    def _handle_subscription_flow(self, chat_id, text):
-        """Обработка многошагового добавления подписки"""
-        session = self.user_sessions[chat_id]
+    def _start_free_text_subscription(self, chat_id, text):
+        # Автоматическое добавление произвольного текста как подписки:
+        # название уже известно, поэтому мастер сразу ждет стоимость
+        self.sessions.set(chat_id, {
+            'adding_subscription': True,
+            'step': 'price',
+            'name': text
+        })
         
+        return {
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': f'*Добавление подписки*\n\nВы ввели: *{text}*\n\n*Шаг 2 из 3*\nВведите стоимость подписки в рублях:',
+            'parse_mode': 'Markdown',
+            'reply_markup': self.sub_manager.get_cancel_keyboard()
+        }
+    
+    def _handle_subscription_flow(self, chat_id, text, session):
+        """Обработка многошагового добавления подписки"""
         if text == '❌ Отмена':
-            del self.user_sessions[chat_id]
-            return self.process_message(chat_id, 'Главное меню')
+            return self._cancel(chat_id, text)
         
         if session['step'] == 'name':
             session['name'] = text
             session['step'] = 'price'
+            self.sessions.set(chat_id, session)
             
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': '*Добавление своей подписки*\n\n*Шаг 2 из 3*\nВведите стоимость подписки в рублях:',
-                'parse_mode': 'Markdown',
-                'reply_markup': self.sub_manager.get_cancel_keyboard()
-            }
+            return StaticReplies.WIZARD_PRICE
         
         elif session['step'] == 'price':
             try:
-                price = float(text)
+                price = to_kopecks(text)
                 if price <= 0:
                     raise ValueError("Цена должна быть положительной")
                     
-                session['price'] = price
+                session['price_kopecks'] = price
                 session['step'] = 'date'
+                self.sessions.set(chat_id, session)
                 
                 current_year = datetime.now().year
                 next_year = current_year + 1
                 
-                date_keyboard = {
-                    'keyboard': [
-                        [{'text': '⏩ Пропустить'}],
-                        [{'text': '❌ Отмена'}]
-                    ],
-                    'resize_keyboard': True
-                }
-                
                 return {
                     'method': 'sendMessage',
                     'chat_id': chat_id,
                     'text': f'*Добавление своей подписки*\n\n*Шаг 3 из 3*\nВведите дату окончания подписки:\n\n*Формат:*\n• 19.10 - если окончание в {current_year} году\n• 19.10.{str(next_year)[-2:]} - если в {next_year} году\n• Или нажмите "Пропустить" для бессрочной',
                     'parse_mode': 'Markdown',
-                    'reply_markup': date_keyboard
+                    'reply_markup': DATE_KEYBOARD
                 }
             except ValueError:
-                return {
-                    'method': 'sendMessage',
-                    'chat_id': chat_id,
-                    'text': 'Неверный формат цены. Введите положительное число:',
-                    'parse_mode': 'Markdown',
-                    'reply_markup': self.sub_manager.get_cancel_keyboard()
-                }
+                return StaticReplies.INVALID_PRICE
         
         elif session['step'] == 'date':
             end_date = None
             if text != '⏩ Пропустить':
-                if re.match(r'^\d{1,2}\.\d{1,2}$', text):
-                    day, month = text.split('.')
-                    end_date = f"{int(day):02d}.{int(month):02d}"
-                elif re.match(r'^\d{1,2}\.\d{1,2}\.\d{2}$', text):
-                    day, month, year = text.split('.')
-                    end_date = f"{int(day):02d}.{int(month):02d}.{year}"
-                else:
-                    return {
-                        'method': 'sendMessage',
-                        'chat_id': chat_id,
-                        'text': 'Неверный формат даты. Используйте:\n• 19.10 - для этого года\n• 19.10.26 - для следующего года\n• Или "Пропустить"',
-                        'parse_mode': 'Markdown',
-                        'reply_markup': self.sub_manager.get_cancel_keyboard()
-                    }
+                parsed = None
+                if SHORT_DATE_RE.match(text) or FULL_DATE_RE.match(text):
+                    parsed = parse_end_date(text, datetime.now().year)
+                if parsed is None:
+                    return StaticReplies.INVALID_DATE
+                end_date = parsed.isoformat()
+            
+            # Сессии, начатые до перехода на копейки, хранят цену в рублях
+            price = session.get('price_kopecks')
+            if price is None:
+                price = to_kopecks(session['price'])
             
             success, message = self.db.add_subscription(
                 chat_id, 
                 session['name'], 
-                session['price'], 
+                price, 
                 1,
-                end_date
+                end_date,
+                category=self.sub_manager.get_category(session['name'])
             )
             
-            del self.user_sessions[chat_id]
+            self.sessions.delete(chat_id)
             
             if success:
-                response_text = f'*✅ Подписка добавлена!*\n\n*Название:* {session["name"]}\n*Стоимость:* {session["price"]} руб/мес\n*Списание:* 1 число каждого месяца'
+                response_text = f'*✅ Подписка добавлена!*\n\n*Название:* {session["name"]}\n*Стоимость:* {format_rub(price)} руб/мес\n*Списание:* 1 число каждого месяца'
                 if end_date:
-                    response_text += f'\n*Окончание:* {end_date}'
+                    response_text += f'\n*Окончание:* {format_end_date(end_date)}'
                 response_text += '\n\n*Проект поддерживается пользователями*'
             else:
                 response_text = f'*❌ Ошибка:* {message}'
@@ -651,4 +4421,737 @@ class BotHandler(BaseHTTPRequestHandler):
                 'reply_markup': self.sub_manager.get_main_keyboard()
             }
 
-handler = BotHandler
\ No newline at end of file
+# Общий обработчик сообщений процесса
+message_processor = MessageProcessor()
+
+class BotHandler(BaseHTTPRequestHandler):
+    processor = message_processor
+    
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/cron/reminders':
+            return self._run_reminders()
+        if path == '/metrics':
+            return self._send_metrics()
+        if path == '/admin/analytics':
+            return self._send_analytics()
+        if path == '/admin/export':
+            return self._send_export()
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        self.wfile.write('Bot is running with persistent storage!'.encode('utf-8'))
+    
+    def do_POST(self):
+        if self.path.split('?', 1)[0] == '/admin/import':
+            return self._run_import()
+        
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            update = json.loads(post_data)
+            
+            body = self.processor.handle_update(update)
+            if body is not None:
+                self._send_json(body)
+                return
+                
+        except Exception as e:
+            log_error('Error', e)
+        
+        self.send_response(200)
+        self.end_headers()
+    
+    def _run_reminders(self):
+        """Запуск рассылки напоминаний по расписанию (Vercel Cron)"""
+        # Без CRON_SECRET рассылку по всем пользователям мог бы запустить кто угодно
+        secret = os.environ.get('CRON_SECRET')
+        if not secret or self.headers.get('Authorization') != f'Bearer {secret}':
+            self.send_response(401)
+            self.end_headers()
+            return
+        
+        try:
+            body = json.dumps(send_reminders(self.processor.db)).encode('utf-8')
+        except Exception as e:
+            log_error('Ошибка рассылки напоминаний', e)
+            self.send_response(500)
+            self.end_headers()
+            return
+        self._send_json(body)
+    
+    def _send_metrics(self):
+        token = os.environ.get('METRICS_TOKEN')
+        if token and self.headers.get('Authorization') != f'Bearer {token}':
+            self.send_response(401)
+            self.end_headers()
+            return
+        
+        body = metrics.render(self.processor).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _authorize_admin(self):
+        """Проверка ADMIN_TOKEN; без заданного токена админские запросы отклоняются"""
+        token = os.environ.get('ADMIN_TOKEN')
+        if token and self.headers.get('Authorization') == f'Bearer {token}':
+            return True
+        self.send_response(401)
+        self.end_headers()
+        return False
+    
+    def _send_analytics(self):
+        """Отчет по всей базе; доступен только с ADMIN_TOKEN"""
+        if not self._authorize_admin():
+            return
+        
+        try:
+            body = json.dumps(fleet_analytics.report(), ensure_ascii=False).encode('utf-8')
+        except Exception as e:
+            log_error('Ошибка расчета аналитики', e)
+            self.send_response(500)
+            self.end_headers()
+            return
+        self._send_json(body)
+    
+    def _send_export(self):
+        """Потоковая выгрузка подписок: ?format=csv|jsonl&user_id=N"""
+        if not self._authorize_admin():
+            return
+        try:
+            fmt, user_id = parse_transfer_query(urllib.parse.urlsplit(self.path).query)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        
+        # Без Content-Length: ответ по HTTP/1.0 заканчивается закрытием соединения
+        self.send_response(200)
+        self.send_header('Content-type', EXPORT_CONTENT_TYPES[fmt])
+        self.send_header('Content-Disposition', f'attachment; filename="subscriptions.{fmt}"')
+        self.end_headers()
+        for chunk in iter_export(self.processor.db.iter_export_rows(user_id), fmt):
+            self.wfile.write(chunk)
+    
+    def _run_import(self):
+        """Загрузка подписок из тела запроса: ?format=csv|jsonl&user_id=N"""
+        if not self._authorize_admin():
+            return
+        try:
+            fmt, user_id = parse_transfer_query(urllib.parse.urlsplit(self.path).query)
+            remaining = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        
+        # Тело читается порциями по мере разбора, не целиком
+        def next_chunk():
+            nonlocal remaining
+            chunk = self.rfile.read(min(remaining, 1 << 16)) if remaining > 0 else b''
+            remaining -= len(chunk)
+            return chunk
+        
+        importer = SubscriptionImporter(self.processor.db, user_id)
+        try:
+            report = importer.run(iter_import_records(io.BufferedReader(ChunkStream(next_chunk)), fmt))
+        except (UnicodeDecodeError, csv.Error) as e:
+            log_error('Ошибка импорта подписок', e)
+            self.send_response(400)
+            self.end_headers()
+            return
+        except Exception as e:
+            log_error('Ошибка импорта подписок', e)
+            self.send_response(500)
+            self.end_headers()
+            return
+        self._send_json(json.dumps(report, ensure_ascii=False).encode('utf-8'))
+    
+    def _send_json(self, body):
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def process_message(self, chat_id, text):
+        return self.processor.process_message(chat_id, text)
+
+handler = BotHandler
+
+class AsgiApp:
+    """ASGI-приложение для самостоятельного хостинга.
+    
+    Использует ту же обработку команд, что и BotHandler. Синхронная работа
+    с SQLite выполняется в ограниченном пуле потоков, а семафор ограничивает
+    число обновлений в обработке, чтобы очередь пула не росла без предела.
+    """
+    
+    STATUS_TEXT = b'Bot is running with persistent storage!'
+    
+    def __init__(self, processor, max_workers=4, max_pending=256, max_body=1 << 20):
+        self.processor = processor
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self._executor = None
+        self._slots = None
+    
+    def _ensure_started(self):
+        import asyncio
+        
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='podpis-db')
+            self._slots = asyncio.Semaphore(self.max_pending)
+    
+    async def shutdown(self):
+        """Ожидание обновлений в обработке и остановка пула"""
+        import asyncio
+        
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown, True)
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        
+        self._ensure_started()
+        method, path = scope['method'], scope['path']
+        
+        if method == 'GET' and path == '/cron/reminders':
+            secret = os.environ.get('CRON_SECRET')
+            headers = dict(scope.get('headers') or ())
+            if not secret or headers.get(b'authorization') != f'Bearer {secret}'.encode('utf-8'):
+                return await self._respond(send, 401, b'')
+            result = await self._run_blocking(send_reminders, self.processor.db)
+            return await self._respond(send, 200, json.dumps(result).encode('utf-8'), b'application/json')
+        
+        if method == 'GET' and path == '/metrics':
+            token = os.environ.get('METRICS_TOKEN')
+            headers = dict(scope.get('headers') or ())
+            if token and headers.get(b'authorization') != f'Bearer {token}'.encode('utf-8'):
+                return await self._respond(send, 401, b'')
+            body = metrics.render(self.processor).encode('utf-8')
+            return await self._respond(send, 200, body, b'text/plain; version=0.0.4')
+        
+        if method == 'GET' and path == '/admin/analytics':
+            if not self._is_admin(scope):
+                return await self._respond(send, 401, b'')
+            result = await self._run_blocking(fleet_analytics.report)
+            return await self._respond(send, 200, json.dumps(result, ensure_ascii=False).encode('utf-8'), b'application/json')
+        
+        if (method, path) in (('GET', '/admin/export'), ('POST', '/admin/import')):
+            if not self._is_admin(scope):
+                return await self._respond(send, 401, b'')
+            try:
+                fmt, user_id = parse_transfer_query(scope.get('query_string', b'').decode('latin-1'))
+            except ValueError:
+                return await self._respond(send, 400, b'')
+            if method == 'GET':
+                return await self._stream_export(send, fmt, user_id)
+            return await self._import(receive, send, fmt, user_id)
+        
+        if method == 'GET':
+            return await self._respond(send, 200, self.STATUS_TEXT, b'text/plain')
+        
+        if method != 'POST':
+            return await self._respond(send, 405, b'')
+        
+        body = await self._read_body(receive)
+        if body is None:
+            return await self._respond(send, 413, b'')
+        
+        response = None
+        try:
+            response = await self._run_blocking(self.processor.handle_update, json.loads(body))
+        except Exception as e:
+            log_error('Error', e)
+        
+        # Telegram ждет 200 даже при ошибке, иначе будет повторять доставку
+        if response is None:
+            return await self._respond(send, 200, b'')
+        await self._respond(send, 200, response, b'application/json')
+    
+    @staticmethod
+    def _is_admin(scope):
+        token = os.environ.get('ADMIN_TOKEN')
+        headers = dict(scope.get('headers') or ())
+        return bool(token) and headers.get(b'authorization') == f'Bearer {token}'.encode('utf-8')
+    
+    async def _stream_export(self, send, fmt, user_id):
+        """Выгрузка порциями: каждая читается из SQLite в пуле потоков"""
+        chunks = iter_export(self.processor.db.iter_export_rows(user_id), fmt)
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', EXPORT_CONTENT_TYPES[fmt].encode('ascii')),
+                (b'content-disposition', f'attachment; filename="subscriptions.{fmt}"'.encode('ascii')),
+            ]})
+            while True:
+                chunk = await self._run_blocking(next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            chunks.close()
+    
+    async def _import(self, receive, send, fmt, user_id):
+        """Загрузка из тела запроса: поток пула получает порции тела из цикла событий"""
+        import asyncio
+        
+        loop = asyncio.get_running_loop()
+        more_body = True
+        
+        def next_chunk():
+            nonlocal more_body
+            while more_body:
+                message = asyncio.run_coroutine_threadsafe(receive(), loop).result()
+                more_body = message.get('more_body', False)
+                if message.get('body'):
+                    return message['body']
+            return b''
+        
+        importer = SubscriptionImporter(self.processor.db, user_id)
+        records = iter_import_records(io.BufferedReader(ChunkStream(next_chunk)), fmt)
+        try:
+            report = await self._run_blocking(importer.run, records)
+        except (UnicodeDecodeError, csv.Error) as e:
+            log_error('Ошибка импорта подписок', e)
+            return await self._respond(send, 400, b'')
+        except Exception as e:
+            log_error('Ошибка импорта подписок', e)
+            return await self._respond(send, 500, b'')
+        await self._respond(send, 200, json.dumps(report, ensure_ascii=False).encode('utf-8'), b'application/json')
+    
+    async def _run_blocking(self, func, *args):
+        import asyncio
+        
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+    
+    async def _read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+    
+    @staticmethod
+    async def _respond(send, status, body, content_type=None):
+        headers = [(b'content-length', str(len(body)).encode('ascii'))]
+        if content_type:
+            headers.append((b'content-type', content_type))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+    
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._ensure_started()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+# ASGI-точка входа: uvicorn --app-dir api index:app
+app = AsgiApp(message_processor)
+
+class PollingWorker:
+    """Режим long polling: пакетное получение обновлений через getUpdates.
+    
+    Offset хранится в bot_state и фиксируется в одной транзакции с записями
+    пакета, поэтому после перезапуска обновления не обрабатываются повторно.
+    Каждое обновление выполняется в своей точке сохранения: ошибка откатывает
+    только его записи. Следующий пакет запрашивается только после отправки
+    ответов на текущий.
+    
+    При PODPISCONTROL_SHARDS > 1 записи обновления (подписки, сессия,
+    update_id) идут в шард его чата. На время пакета открывается транзакция
+    каждого затронутого шарда, и обновление откатывается в точках сохранения
+    своего шарда и шарда 0. Шарды чатов фиксируются раньше шарда 0 с offset:
+    если сбой случится между фиксациями, Telegram доставит пакет повторно,
+    а уже записанные обновления будут отсеяны по update_id.
+    """
+    
+    OFFSET_KEY = 'updates_offset'
+    
+    def __init__(self, processor, client=None, batch_size=100, poll_timeout=30, send_rate=25.0):
+        self.processor = processor
+        self.db = processor.db
+        self.client = client or TelegramClient()
+        self.batch_size = batch_size
+        self.poll_timeout = poll_timeout
+        self.queue = SendQueue(self.client, rate=send_rate)
+        self._running = False
+        self.processed = 0
+    
+    def fetch(self):
+        """Получение очередного пакета обновлений"""
+        result = self.client.call('getUpdates', {
+            'offset': int(self.db.get_state(self.OFFSET_KEY, 0)),
+            'limit': self.batch_size,
+            'timeout': self.poll_timeout,
+            'allowed_updates': ['message', 'callback_query']
+        }, timeout=self.poll_timeout + 10)
+        if not result.get('ok'):
+            raise RuntimeError(result.get('description', 'getUpdates failed'))
+        return result['result']
+    
+    def process_batch(self, updates):
+        """Обработка пакета в одной транзакции и постановка ответов в очередь"""
+        if not updates:
+            return 0
+        
+        control = self.db.shards[0]
+        with ExitStack() as batch:
+            # Выходы выполняются в обратном порядке: шард 0 с offset - последним
+            batch.enter_context(self.db.transaction())
+            opened = {control}
+            for update in updates:
+                # Подтверждение нажатия кнопки уходит первым, даже если
+                # обработка обновления упадет
+                answer = self.processor.callback_answer(update)
+                if answer is not None:
+                    self.queue.put(answer)
+                chat_id = self.processor._update_chat_id(update)
+                shard = self.db.shard_for(chat_id) if chat_id is not None else control
+                if shard not in opened:
+                    batch.enter_context(shard.transaction())
+                    opened.add(shard)
+                try:
+                    with ExitStack() as savepoints:
+                        savepoints.enter_context(self.db.transaction())
+                        if shard is not control:
+                            savepoints.enter_context(shard.transaction())
+                        result = self.processor.dispatch_update(update)
+                except Exception as e:
+                    log_error('Error', e)
+                    continue
+                if result is None:
+                    continue
+                response, chat_id = result
+                if isinstance(response, PreparedReply):
+                    self.queue.put(response.render(chat_id), 'sendMessage')
+                else:
+                    self.queue.put(response)
+            self.db.set_state(self.OFFSET_KEY, updates[-1]['update_id'] + 1)
+        
+        self.queue.drain()
+        self.processed += len(updates)
+        return len(updates)
+    
+    def run_once(self):
+        return self.process_batch(self.fetch())
+    
+    def run(self):
+        """Цикл опроса до вызова stop()"""
+        # getUpdates не работает, пока у бота установлен вебхук
+        self.client.call('deleteWebhook', {})
+        self._running = True
+        while self._running:
+            try:
+                self.run_once()
+            except Exception as e:
+                log_error('Ошибка получения обновлений', e)
+                time.sleep(1)
+    
+    def stop(self):
+        self._running = False
+
+class AsyncHttpServer:
+    """Встроенный HTTP/1.1-сервер на asyncio для запуска app без зависимостей.
+    
+    Поддерживает keep-alive и плавную остановку: после сигнала новые
+    соединения не принимаются, текущие запросы дорабатывают. Тело запроса
+    принимается только с одним десятичным Content-Length; запросы с
+    Transfer-Encoding или неоднозначной длиной отклоняются с закрытием
+    соединения. Где нужен полный HTTP/1.1 (chunked-запросы), app запускается
+    любым ASGI-сервером, например uvicorn api.index:app.
+    """
+    
+    # Порция тела запроса, передаваемая приложению за один receive
+    BODY_CHUNK = 1 << 16
+    
+    def __init__(self, asgi_app, host='0.0.0.0', port=8000, keepalive_timeout=75, shutdown_timeout=30):
+        self.app = asgi_app
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self._server = None
+        self._stopping = None
+        self._connections = set()
+        # Соединения, ожидающие следующего запроса: их можно закрыть сразу
+        self._idle = set()
+        self._lifespan_events = None
+        self._lifespan_task = None
+    
+    async def serve(self):
+        import asyncio
+        
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass
+        
+        await self._start_lifespan()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        print(f'Сервер запущен на {self.host}:{self.port}')
+        await self._stopping.wait()
+        
+        self._server.close()
+        for task in list(self._idle):
+            task.cancel()
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=self.shutdown_timeout)
+        await self._server.wait_closed()
+        await self._stop_lifespan()
+    
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+    
+    async def _start_lifespan(self):
+        """Запуск протокола lifespan приложения и ожидание startup.complete"""
+        import asyncio
+        
+        self._lifespan_events = asyncio.Queue()
+        started = asyncio.Event()
+        
+        async def send(message):
+            if message['type'] == 'lifespan.startup.complete':
+                started.set()
+        
+        self._lifespan_task = asyncio.create_task(
+            self.app({'type': 'lifespan'}, self._lifespan_events.get, send)
+        )
+        await self._lifespan_events.put({'type': 'lifespan.startup'})
+        await started.wait()
+    
+    async def _stop_lifespan(self):
+        await self._lifespan_events.put({'type': 'lifespan.shutdown'})
+        await self._lifespan_task
+    
+    async def _handle_connection(self, reader, writer):
+        import asyncio
+        
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while not self._stopping.is_set():
+                self._idle.add(task)
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    self._idle.discard(task)
+                if not request_line:
+                    break
+                
+                parts = request_line.decode('latin-1').split()
+                malformed = len(parts) != 3 or not parts[2].startswith('HTTP/1.')
+                headers = []
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, separator, value = line.decode('latin-1').partition(':')
+                    # Пробел перед двоеточием и продолжение строки запрещены RFC 9112
+                    if not separator or not name or name != name.strip():
+                        malformed = True
+                    headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+                length, error = (None, 400) if malformed else self._body_length(headers)
+                if error is not None:
+                    # Границу тела не определить: соединение не переиспользуется
+                    await self._reject(writer, error)
+                    break
+                
+                method, target, version = parts
+                header_map = dict(headers)
+                keep_alive = (
+                    version == 'HTTP/1.1' and header_map.get(b'connection', b'').lower() != b'close'
+                ) and not self._stopping.is_set()
+                keep_alive = await self._dispatch(reader, writer, method, target, headers, length, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._idle.discard(task)
+            self._connections.discard(task)
+            writer.close()
+    
+    @staticmethod
+    def _body_length(headers):
+        """(длина тела, None) или (None, код ошибки) по заголовкам запроса.
+        
+        Без однозначной длины остаток тела был бы разобран как следующий
+        запрос того же соединения.
+        """
+        encodings = [value.lower() for name, value in headers if name == b'transfer-encoding']
+        if encodings:
+            # Потоковое тело без длины не поддерживается
+            return None, 411 if any(b'chunked' in value for value in encodings) else 501
+        lengths = [value for name, value in headers if name == b'content-length']
+        if not lengths:
+            return 0, None
+        # isdigit у bytes - только ASCII-цифры: знак, пробелы и списки отклоняются
+        if len(lengths) > 1 or not lengths[0].isdigit():
+            return None, 400
+        return int(lengths[0]), None
+    
+    @staticmethod
+    async def _reject(writer, status):
+        """Ответ на неразборчивый запрос; после него соединение закрывается"""
+        reason = http.client.responses.get(status, '')
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.encode('latin-1'))
+        await writer.drain()
+    
+    async def _dispatch(self, reader, writer, method, target, headers, length, keep_alive):
+        """Передача запроса приложению; False, если соединение нужно закрыть"""
+        import asyncio
+        
+        path, _, query = target.partition('?')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': method, 'path': path, 'query_string': query.encode('latin-1'),
+            'headers': headers
+        }
+        
+        # Тело читается по мере запроса приложением: ограничение размера
+        # (413) срабатывает до чтения лишнего, а загрузка идет потоком
+        remaining = length
+        
+        async def receive():
+            nonlocal remaining
+            chunk = b''
+            if remaining:
+                # Сколько уже пришло, но не больше порции
+                chunk = await reader.read(min(remaining, self.BODY_CHUNK))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+            return {'type': 'http.request', 'body': chunk, 'more_body': remaining > 0}
+        
+        # Ответ без content-length (потоковая выгрузка) передается порциями
+        chunked = False
+        
+        async def send(message):
+            nonlocal chunked, keep_alive
+            if message['type'] == 'http.response.start':
+                # Непрочитанный остаток тела не дает разобрать следующий запрос
+                keep_alive = keep_alive and not remaining
+                chunked = all(name.lower() != b'content-length' for name, _ in message['headers'])
+                lines = [f'HTTP/1.1 {message["status"]} {http.client.responses.get(message["status"], "")}']
+                lines.extend(f'{name.decode("latin-1")}: {value.decode("latin-1")}' for name, value in message['headers'])
+                if chunked:
+                    lines.append('Transfer-Encoding: chunked')
+                lines.append(f'Connection: {"keep-alive" if keep_alive else "close"}')
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            else:
+                chunk = message.get('body', b'')
+                if not chunked:
+                    writer.write(chunk)
+                else:
+                    if chunk:
+                        writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    if not message.get('more_body'):
+                        writer.write(b'0\r\n\r\n')
+                await writer.drain()
+        
+        await self.app(scope, receive, send)
+        return keep_alive and not remaining
+
+def main(argv=None):
+    """Запуск вне Vercel: python api/index.py serve|poll|reminders"""
+    import argparse
+    import asyncio
+    
+    parser = argparse.ArgumentParser(description='Единый центр контроля подписок')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    serve_parser = commands.add_parser('serve', help='асинхронный HTTP-сервер вебхука')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--workers', type=int, default=4, help='потоков для работы с БД')
+    
+    poll_parser = commands.add_parser('poll', help='получение обновлений через getUpdates')
+    poll_parser.add_argument('--batch-size', type=int, default=100)
+    poll_parser.add_argument('--timeout', type=int, default=30, help='таймаут long polling, секунд')
+    
+    commands.add_parser('reminders', help='разослать напоминания')
+    commands.add_parser('analytics', help='отчет по расходам во всей базе (JSON)')
+    
+    export_parser = commands.add_parser('export', help='выгрузка подписок в CSV или JSON Lines')
+    export_parser.add_argument('--format', default='csv', choices=('csv', 'jsonl'))
+    export_parser.add_argument('--user-id', type=int, help='только подписки пользователя')
+    export_parser.add_argument('--output', help='файл; по умолчанию stdout')
+    
+    import_parser = commands.add_parser('import', help='загрузка подписок из CSV или JSON Lines')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', help='по умолчанию - по расширению файла')
+    import_parser.add_argument('--user-id', type=int, help='загрузить все строки этому пользователю')
+    
+    snapshot_parser = commands.add_parser('snapshot', help='сжатый снимок БД в каталог снимков')
+    snapshot_parser.add_argument('--dir', default=SNAPSHOT_DIR, help='по умолчанию PODPISCONTROL_SNAPSHOT_DIR')
+    snapshot_parser.add_argument('--keep', type=int, default=5)
+    
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        app.max_workers = args.workers
+        asyncio.run(AsyncHttpServer(app, args.host, args.port).serve())
+    elif args.command == 'poll':
+        worker = PollingWorker(message_processor, batch_size=args.batch_size, poll_timeout=args.timeout)
+        signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'reminders':
+        print(send_reminders(message_processor.db))
+    elif args.command == 'analytics':
+        print(json.dumps(fleet_analytics.report(), ensure_ascii=False, indent=2))
+    elif args.command == 'export':
+        import sys
+        
+        output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+        try:
+            for chunk in iter_export(db_manager.iter_export_rows(args.user_id), args.format):
+                output.write(chunk)
+        finally:
+            if args.output:
+                output.close()
+    elif args.command == 'import':
+        with open(args.path, 'rb') as f:
+            records = iter_import_records(f, export_format(args.format or args.path))
+            report = SubscriptionImporter(db_manager, args.user_id).run(records)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    elif args.command == 'snapshot':
+        if not args.dir:
+            parser.error('не задан каталог снимков: --dir или PODPISCONTROL_SNAPSHOT_DIR')
+        store = SnapshotStore(args.dir, keep=args.keep)
+        for shard in db_manager.shards:
+            store.save(shard)
+            print(json.dumps(store.last, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+"""Воспроизведение синтетических потоков обновлений Telegram.
+
+Генерирует реалистичную смесь действий пользователей (нажатия меню, выбор
+сервисов каталога, полный мастер добавления, удаления) и прогоняет ее:
+
+* processor - через MessageProcessor.handle_update;
+* http      - через BotHandler.do_POST на локальном HTTP-сервере;
+* db        - напрямую через хранилище (DatabaseManager или MemoryStorage).
+
+Примеры:
+    python benchmarks/replay.py --users 200 --actions 20 --save baseline.json
+    python benchmarks/replay.py --compare baseline.json --max-regression 0.2
+    python benchmarks/replay.py --storage memory --modes processor,db
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import http.client
+from http.server import ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_PATH = os.path.join(ROOT, 'api', 'index.py')
+
+MENU_TAPS = ['/start', 'Мои подписки', 'Статистика', 'Управление подписками', 'Помощь', '/laws']
+
+
+def load_bot(db_path):
+    """Загрузка api/index.py с отдельной базой.
+    
+    PODPISCONTROL_DB нужен модулю только при импорте, поэтому после загрузки
+    восстанавливается прежнее значение переменной окружения.
+    """
+    previous = os.environ.get('PODPISCONTROL_DB')
+    os.environ['PODPISCONTROL_DB'] = db_path
+    try:
+        spec = importlib.util.spec_from_file_location('podpiscontrol_bench', INDEX_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        if previous is None:
+            del os.environ['PODPISCONTROL_DB']
+        else:
+            os.environ['PODPISCONTROL_DB'] = previous
+    return module
+
+
+class NullClient:
+    """Bot API без сети: вызовы (answerCallbackQuery) только подсчитываются"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def call(self, method, payload, **kwargs):
+        self.calls += 1
+        return {'ok': True, 'result': True}
+
+
+def make_processor(bot):
+    """Обработчик без ограничения частоты: бенчмарк шлет сообщения подряд"""
+    limiter = bot.RateLimiter(rate=1e9, burst=1e9, max_concurrent=1 << 16)
+    return bot.MessageProcessor(limiter=limiter, client=NullClient())
+
+
+def generate_stream(bot, users, actions, seed):
+    """Список действий (user_id, вид, аргумент) с фиксированным seed"""
+    rng = random.Random(seed)
+    catalog = list(bot.CATALOG.names)
+    stream = []
+    for _ in range(users * actions):
+        user_id = 1_000_000 + rng.randrange(users)
+        roll = rng.random()
+        if roll < 0.5:
+            stream.append((user_id, 'tap', rng.choice(MENU_TAPS)))
+        elif roll < 0.7:
+            stream.append((user_id, 'catalog', rng.choice(catalog)))
+        elif roll < 0.85:
+            price = rng.choice(['99', '149.5', '300', '499'])
+            end = rng.choice(['⏩ Пропустить', '19.10', '01.03.27'])
+            stream.append((user_id, 'wizard', (f'Сервис {rng.randrange(1000)}', price, end)))
+        else:
+            stream.append((user_id, 'delete', None))
+    return stream
+
+
+def expand_action(kind, argument):
+    """Тексты сообщений, из которых состоит действие"""
+    if kind == 'tap':
+        return [argument]
+    if kind == 'catalog':
+        return [argument, f'✅ Добавить {argument}']
+    if kind == 'wizard':
+        name, price, end = argument
+        return ['➕ Своя подписка', name, price, end]
+    return ['🗑️ Удалить подписку']
+
+
+class SqlCounter:
+    """Подсчет SQL-выражений на всех соединениях шардов и записей по шардам"""
+
+    WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+    def __init__(self, db):
+        self.count = 0
+        self.shard_writes = [0] * len(db.shards)
+        for index, shard in enumerate(db.shards):
+            shard._get_connection().set_trace_callback(lambda statement, index=index: self._trace(index, statement))
+
+    def _trace(self, index, statement):
+        self.count += 1
+        if statement.lstrip().upper().startswith(self.WRITES):
+            self.shard_writes[index] += 1
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        'p50_ms': round(pick(0.50) * 1000, 3),
+        'p95_ms': round(pick(0.95) * 1000, 3),
+        'p99_ms': round(pick(0.99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+    }
+
+
+def summarize(latencies, elapsed, counter, allocated):
+    result = {
+        'updates': len(latencies),
+        'throughput_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'sql_per_update': round(counter.count / len(latencies), 2) if latencies else 0,
+        **percentiles(latencies),
+    }
+    if len(counter.shard_writes) > 1:
+        # Записи по шардам: при равномерном распределении доли близки к 1/N
+        result['shard_writes'] = counter.shard_writes
+    if allocated is not None:
+        result['alloc_peak_kb_per_update'] = round(statistics.fmean(allocated) / 1024, 2)
+    return result
+
+
+def replay_processor(bot, stream, track_allocations):
+    processor = make_processor(bot)
+    counter = SqlCounter(processor.db)
+    update_id = 0
+    latencies, allocated = [], [] if track_allocations else None
+    started = time.perf_counter()
+
+    for user_id, kind, argument in stream:
+        texts = expand_action(kind, argument)
+        for text in texts:
+            update_id += 1
+            update = {'update_id': update_id, 'message': {'chat': {'id': user_id}, 'text': text}}
+            if track_allocations:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            t0 = time.perf_counter()
+            body = processor.handle_update(update)
+            latencies.append(time.perf_counter() - t0)
+            if track_allocations:
+                allocated.append(tracemalloc.get_traced_memory()[1] - base)
+
+        # Удаление: нажимаем первую inline-кнопку из полученного меню
+        if kind == 'delete' and body:
+            markup = json.loads(body).get('reply_markup', {})
+            buttons = markup.get('inline_keyboard')
+            if buttons:
+                update_id += 1
+                update = {
+                    'update_id': update_id,
+                    'callback_query': {
+                        'id': str(update_id),
+                        'data': buttons[0][0]['callback_data'],
+                        'message': {'message_id': 1, 'chat': {'id': user_id}}
+                    }
+                }
+                t0 = time.perf_counter()
+                processor.handle_update(update)
+                latencies.append(time.perf_counter() - t0)
+
+    return summarize(latencies, time.perf_counter() - started, counter, allocated)
+
+
+def replay_http(bot, stream):
+    bot.BotHandler.processor = make_processor(bot)
+    bot.BotHandler.log_message = lambda *args: None
+    server = ThreadingHTTPServer(('127.0.0.1', 0), bot.handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    counter = SqlCounter(bot.BotHandler.processor.db)
+
+    update_id = 0
+    latencies = []
+    started = time.perf_counter()
+    try:
+        for user_id, kind, argument in stream:
+            for text in expand_action(kind, argument):
+                update_id += 1
+                payload = json.dumps({'update_id': update_id, 'message': {'chat': {'id': user_id}, 'text': text}})
+                t0 = time.perf_counter()
+                # BaseHTTPRequestHandler отвечает по HTTP/1.0: соединение на запрос
+                conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+                conn.request('POST', '/', payload, {'Content-Type': 'application/json'})
+                conn.getresponse().read()
+                conn.close()
+                latencies.append(time.perf_counter() - t0)
+    finally:
+        server.shutdown()
+    return summarize(latencies, time.perf_counter() - started, counter, None)
+
+
+def replay_db(bot, stream):
+    db = bot.db_manager
+    counter = SqlCounter(db)
+    latencies = []
+    started = time.perf_counter()
+    for user_id, kind, argument in stream:
+        t0 = time.perf_counter()
+        if kind == 'tap':
+            db.get_user_subscriptions(user_id)
+            db.get_user_stats(user_id)
+        elif kind == 'catalog':
+            info = bot.CATALOG.get(argument)
+            db.add_subscription(user_id, argument, info['price'], 1, category=info['category'])
+        elif kind == 'wizard':
+            db.add_subscription(user_id, argument[0], bot.to_kopecks(argument[1]), 1)
+        else:
+            subscriptions = db.get_user_subscriptions(user_id)
+            if subscriptions:
+                db.delete_subscription_by_id(user_id, subscriptions[0][0])
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - started, counter, None)
+
+
+def populate(bot, rows, seed):
+    """Фоновые данные: rows подписок у других пользователей"""
+    if not rows:
+        return
+    rng = random.Random(seed + 1)
+    catalog = list(bot.CATALOG.services.items())
+    for shard in bot.db_manager.shards:
+        with shard.transaction() as cursor:
+            batch = []
+            for index in range(rows // len(bot.db_manager.shards)):
+                name, info = rng.choice(catalog)
+                batch.append((
+                    rng.randrange(1, 10 * rows), f'{name} {index}', info['price'],
+                    rng.randint(1, 28), info['category'], rng.random() < 0.8
+                ))
+            cursor.executemany(
+                'INSERT INTO subscriptions (user_id, service_name, price, charge_day, category, is_active) '
+                'VALUES (?, ?, ?, ?, ?, ?)', batch
+            )
+            bot._backfill_user_stats(cursor)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, max_regression):
+    """Сравнение p95 и пропускной способности с базовой линией"""
+    failed = False
+    for mode, current in results.items():
+        previous = baseline.get('results', {}).get(mode)
+        if not previous:
+            continue
+        for metric, higher_is_worse in (('p95_ms', True), ('throughput_per_s', False), ('sql_per_update', True)):
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old if higher_is_worse else (old - new) / old
+            marker = 'REGRESSION' if change > max_regression else 'ok'
+            failed |= change > max_regression
+            print(f'{mode:10s} {metric:18s} {old:>10} -> {new:<10} {change:+.1%} {marker}')
+    return not failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='processor,http,db', help='через запятую: processor,http,db')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--actions', type=int, default=20, help='действий на пользователя')
+    parser.add_argument('--db-rows', type=int, default=0, help='фоновых подписок в базе')
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--storage', default='sqlite', choices=('sqlite', 'memory'),
+                        help='memory - чтения и записи в памяти с отложенной записью в SQLite')
+    parser.add_argument('--flush-interval', type=float, default=1.0, help='окно отложенной записи, секунд')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--allocations', action='store_true', help='замер памяти через tracemalloc (медленнее)')
+    parser.add_argument('--save', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON с базовой линией')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    os.environ['PODPISCONTROL_SHARDS'] = str(args.shards)
+    os.environ['PODPISCONTROL_STORAGE'] = args.storage
+    os.environ['PODPISCONTROL_FLUSH_INTERVAL'] = str(args.flush_interval)
+    results = {}
+    for mode in args.modes.split(','):
+        # Каждый режим - на чистой базе, чтобы результаты были сравнимы
+        with tempfile.TemporaryDirectory() as workdir:
+            bot = load_bot(os.path.join(workdir, 'bench.db'))
+            populate(bot, args.db_rows, args.seed)
+            stream = generate_stream(bot, args.users, args.actions, args.seed)
+            if mode == 'processor':
+                if args.allocations:
+                    tracemalloc.start()
+                results[mode] = replay_processor(bot, stream, args.allocations)
+                if args.allocations:
+                    tracemalloc.stop()
+            elif mode == 'http':
+                results[mode] = replay_http(bot, stream)
+            elif mode == 'db':
+                results[mode] = replay_db(bot, stream)
+            else:
+                parser.error(f'неизвестный режим: {mode}')
+            bot.db_manager.close()
+        print(mode, json.dumps(results[mode], ensure_ascii=False))
+
+    report = {
+        'revision': git_revision(),
+        'config': {
+            'users': args.users, 'actions': args.actions, 'db_rows': args.db_rows,
+            'shards': args.shards, 'storage': args.storage, 'seed': args.seed
+        },
+        'results': results
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
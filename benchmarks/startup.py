@@ -0,0 +1,125 @@
+"""Замер холодного старта обработчика.
+
+Каждый прогон - отдельный процесс интерпретатора с пустой базой, как
+новый инстанс Vercel. Замеряются:
+
+* import_ms       - загрузка api/index.py;
+* first_static_ms - ответ на /start (не должен открывать SQLite ни сразу,
+                    ни фоновой записью после ответа);
+* first_db_ms     - первый ответ, которому нужна БД (миграции схемы).
+
+Завершается с кодом 1, если медиана import_ms + first_static_ms
+превышает бюджет или регрессирует относительно базовой линии.
+
+Примеры:
+    python benchmarks/startup.py --runs 10 --save startup.json
+    python benchmarks/startup.py --budget-ms 150 --compare startup.json
+"""
+
+import argparse
+import compileall
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_PATH = os.path.join(ROOT, 'api', 'index.py')
+
+# Код одного холодного старта; печатает JSON с замерами
+CHILD = '''
+import importlib.util, json, sys, time
+
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('podpiscontrol_startup', sys.argv[1])
+bot = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bot)
+imported = time.perf_counter()
+
+bot.message_processor.handle_update({'update_id': 1, 'message': {'chat': {'id': 1}, 'text': '/start'}})
+static_done = time.perf_counter()
+# Фоновые записи после ответа тоже не должны открывать SQLite
+time.sleep(0.3)
+db_opened = any(shard.is_open for shard in bot.db_manager.shards)
+
+db_started = time.perf_counter()
+bot.message_processor.handle_update({'update_id': 2, 'message': {'chat': {'id': 1}, 'text': 'Мои подписки'}})
+db_done = time.perf_counter()
+
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_static_ms': (static_done - imported) * 1000,
+    'first_db_ms': (db_done - db_started) * 1000,
+    'static_opened_db': db_opened,
+    'modules': len(sys.modules),
+}))
+'''
+
+
+def run_once(workdir, index):
+    env = dict(os.environ, PODPISCONTROL_DB=os.path.join(workdir, f'startup{index}.db'))
+    output = subprocess.check_output([sys.executable, '-c', CHILD, INDEX_PATH], env=env, text=True)
+    # Последняя строка - JSON; выше может быть лог миграций
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(runs):
+    # Замеряем импорт с готовым байт-кодом: иначе в import_ms попадает
+    # компиляция исходника, и результат зависит от порядка запусков
+    compileall.compile_file(INDEX_PATH, quiet=1)
+    samples = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for index in range(runs):
+            samples.append(run_once(workdir, index))
+
+    result = {
+        metric: round(statistics.median(sample[metric] for sample in samples), 2)
+        for metric in ('import_ms', 'first_static_ms', 'first_db_ms')
+    }
+    result['cold_static_ms'] = round(result['import_ms'] + result['first_static_ms'], 2)
+    result['static_opened_db'] = any(sample['static_opened_db'] for sample in samples)
+    result['modules'] = samples[-1]['modules']
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--budget-ms', type=float, default=150.0, help='бюджет import + первый статический ответ')
+    parser.add_argument('--save', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON с базовой линией')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    result = measure(args.runs)
+    print(json.dumps(result, ensure_ascii=False))
+
+    failed = False
+    if result['cold_static_ms'] > args.budget_ms:
+        print(f'BUDGET cold_static_ms {result["cold_static_ms"]} > {args.budget_ms}')
+        failed = True
+    if result['static_opened_db']:
+        print('REGRESSION статическая команда открыла SQLite')
+        failed = True
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'results': {'startup': result}}, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f).get('results', {}).get('startup', {})
+        for metric in ('import_ms', 'cold_static_ms', 'first_db_ms'):
+            old, new = previous.get(metric), result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            marker = 'REGRESSION' if change > args.max_regression else 'ok'
+            failed |= change > args.max_regression
+            print(f'{metric:16s} {old:>10} -> {new:<10} {change:+.1%} {marker}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
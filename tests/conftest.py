@@ -0,0 +1,117 @@
+"""Общие фикстуры тестов: загрузка api/index.py с отдельной базой.
+
+Модуль бота читает настройки (PODPISCONTROL_DB и другие) из окружения при
+импорте, поэтому каждый тест импортирует его заново во временном каталоге.
+Переменные окружения выставляются через monkeypatch и восстанавливаются
+после теста. Telegram подменяется локальным сервером Bot API (bot_api).
+"""
+
+import importlib.util
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_PATH = os.path.join(ROOT, 'api', 'index.py')
+
+
+class FakeBotApi:
+    """Bot API в отдельном потоке: обновления задаются тестом, вызовы записываются"""
+
+    def __init__(self):
+        self.updates = []
+        # Отдавать обновления без учета offset - повторная доставка
+        self.ignore_offset = False
+        self.calls = []
+        # Файлы для getFile: file_id -> содержимое
+        self.files = {}
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                api.calls.append((method, payload))
+                result = True
+                if method == 'getUpdates':
+                    offset = 0 if api.ignore_offset else payload.get('offset', 0)
+                    result = [update for update in api.updates if update['update_id'] >= offset]
+                elif method == 'getFile':
+                    result = {'file_id': payload['file_id'], 'file_path': payload['file_id']}
+                self.reply('application/json', json.dumps({'ok': True, 'result': result}).encode('utf-8'))
+
+            def do_GET(self):
+                # Скачивание: /file/bot<token>/<file_path>
+                data = api.files.get(self.path.rsplit('/', 1)[-1])
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.reply('application/octet-stream', data)
+
+            def reply(self, content_type, body):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def sent(self, method='sendMessage'):
+        return [payload for name, payload in self.calls if name == method]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def load_bot(tmp_path, monkeypatch):
+    """Фабрика модулей бота; все загруженные модули закрываются после теста"""
+    modules = []
+
+    def load(db_path=None):
+        monkeypatch.setenv('PODPISCONTROL_DB', str(db_path or tmp_path / 'test.db'))
+        spec = importlib.util.spec_from_file_location('podpiscontrol_test', INDEX_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        modules.append(module)
+        return module
+
+    yield load
+    for module in modules:
+        module.db_manager.close()
+
+
+@pytest.fixture
+def bot(load_bot):
+    """Модуль бота с базой во временном каталоге теста"""
+    return load_bot()
+
+
+@pytest.fixture
+def bot_case(request, bot, load_bot, tmp_path, monkeypatch):
+    """Фикстуры для классов unittest.TestCase (подключается через usefixtures)"""
+    request.instance.bot = bot
+    request.instance.load_bot = load_bot
+    request.instance.workdir = str(tmp_path)
+    request.instance.monkeypatch = monkeypatch
+
+
+@pytest.fixture
+def bot_api(request):
+    """Локальный Bot API; в классах unittest.TestCase доступен как self.api"""
+    api = FakeBotApi()
+    if request.instance is not None:
+        request.instance.api = api
+    yield api
+    api.close()
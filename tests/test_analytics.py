@@ -0,0 +1,54 @@
+"""Инкрементальная аналитика по всей базе (FleetAnalytics)."""
+
+import threading
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class FleetAnalyticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = self.bot.db_manager
+        self.analytics = self.bot.FleetAnalytics(self.db)
+
+    def test_incremental_report_matches_full_rescan(self):
+        self.db.add_subscription(1, 'Кинопоиск', 39900, 1)
+        self.db.add_subscription(2, 'Кинопоиск', 39900, 1)
+        self.assertEqual(self.analytics.report()['active'], 2)
+
+        self.db.delete_subscription(1, 'Кинопоиск')
+        self.db.add_subscription(2, 'Кинопоиск', 49900, 1)
+        self.db.add_subscription(3, 'Okko', 29900, 1)
+        report = self.analytics.report()
+        # Переходы видны только инкрементальному чтению
+        self.assertEqual(report.pop('transitions'), {'cancelled': 1, 'reactivated': 0})
+        full = self.bot.FleetAnalytics(self.db).report()
+        full.pop('transitions')
+        self.assertEqual(report, full)
+        self.assertEqual(report['monthly_spend_kopecks'], 49900 + 29900)
+
+    def test_long_transaction_committed_after_report_is_counted(self):
+        self.db.add_subscription(1, 'Okko', 29900, 1)
+        self.analytics.report()
+
+        # Строка записана до отчета, но зафиксирована после него
+        written, release = threading.Event(), threading.Event()
+
+        def long_transaction():
+            with self.db.transaction():
+                self.db._add_subscription(2, 'Okko', 29900, 1, None, 'развлечения')
+                written.set()
+                release.wait()
+
+        writer = threading.Thread(target=long_transaction)
+        writer.start()
+        written.wait()
+        report = threading.Thread(target=self.analytics.report)
+        report.start()
+        release.set()
+        writer.join()
+        report.join()
+
+        self.assertEqual(self.analytics.report()['active'], 2)
@@ -0,0 +1,51 @@
+"""Кэш чтений по пользователю (UserCache) и его сброс при записи."""
+
+import threading
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class UserCacheTest(unittest.TestCase):
+
+    def test_put_after_invalidation_is_skipped(self):
+        cache = self.bot.UserCache()
+        mark = cache.mark()
+        cache.invalidate(1)
+        cache.put(1, 'stats', {'old': True}, mark)
+        self.assertIsNone(cache.get(1, 'stats'))
+        # Сброс другого пользователя не мешает
+        cache.put(2, 'stats', {'fresh': True}, mark)
+        self.assertEqual(cache.get(2, 'stats'), {'fresh': True})
+
+    def test_forgotten_invalidations_are_covered_by_floor(self):
+        cache = self.bot.UserCache(capacity=2)
+        mark = cache.mark()
+        for user_id in (1, 2, 3):
+            cache.invalidate(user_id)
+        # Номер сброса пользователя 1 вытеснен: put со старой меткой отклоняется
+        cache.put(1, 'stats', {}, mark)
+        self.assertIsNone(cache.get(1, 'stats'))
+        cache.put(1, 'stats', {}, cache.mark())
+        self.assertEqual(cache.get(1, 'stats'), {})
+
+    def test_write_between_select_and_put_is_not_cached(self):
+        db = self.bot.db_manager
+        db.add_subscription(1, 'Okko', 29900, 1)
+        db.invalidate(1)
+        put = db.cache.put
+
+        def racing_put(user_id, key, value, mark=None):
+            # Запись фиксируется и сбрасывает кэш после SELECT, но до put
+            writer = threading.Thread(target=db.add_subscription, args=(1, 'Кинопоиск', 39900, 1))
+            writer.start()
+            writer.join()
+            put(user_id, key, value, mark)
+
+        db.cache.put = racing_put
+        self.assertEqual(len(db.get_user_subscriptions(1)), 1)
+        self.assertEqual(db.get_user_stats(1)['active_count'], 2)
+        db.cache.put = put
+        self.assertEqual(len(db.get_user_subscriptions(1)), 2)
+        self.assertEqual(db.get_user_stats(1)['active_count'], 2)
@@ -0,0 +1,82 @@
+"""Нажатия inline-кнопок (callback_query) в режимах вебхука и long polling."""
+
+import json
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case', 'bot_api')
+class CallbackQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = self.bot.TelegramClient(token='TEST', api_url=self.api.url)
+        limiter = self.bot.RateLimiter(rate=1e9, burst=1e9)
+        self.processor = self.bot.MessageProcessor(limiter=limiter, client=self.client)
+        self.update_id = 0
+
+    def tearDown(self):
+        self.client.close()
+
+    def update(self, chat_id, **content):
+        self.update_id += 1
+        return dict(update_id=self.update_id, **content)
+
+    def tap(self, chat_id, data):
+        """Тело ответа вебхука на нажатие кнопки (dict или None)"""
+        query = {'id': f'q{self.update_id + 1}', 'data': data, 'message': {'message_id': 7, 'chat': {'id': chat_id}}}
+        body = self.processor.handle_update(self.update(chat_id, callback_query=query))
+        return json.loads(body) if body is not None else None
+
+    def delete_buttons(self, chat_id):
+        message = {'chat': {'id': chat_id}, 'text': '🗑️ Удалить подписку'}
+        body = json.loads(self.processor.handle_update(self.update(chat_id, message=message)))
+        return [row[0]['callback_data'] for row in body['reply_markup']['inline_keyboard']]
+
+    def test_delete_button_edits_message_and_answers_query(self):
+        self.bot.db_manager.add_subscription(1, 'Okko', 29900, 1)
+        self.bot.db_manager.add_subscription(1, 'Кинопоиск', 39900, 1)
+        data = self.delete_buttons(1)[0]
+
+        response = self.tap(1, data)
+        self.assertEqual(response['method'], 'editMessageText')
+        self.assertEqual(response['message_id'], 7)
+        self.assertEqual(len(response['reply_markup']['inline_keyboard']), 1)
+        self.assertEqual(len(self.bot.db_manager.get_user_subscriptions(1)), 1)
+        self.assertEqual([call['callback_query_id'] for call in self.api.sent('answerCallbackQuery')], [f'q{self.update_id}'])
+
+    def test_stale_delete_button_is_answered(self):
+        self.bot.db_manager.add_subscription(1, 'Okko', 29900, 1)
+        data = self.delete_buttons(1)[0]
+        self.tap(1, data)
+
+        response = self.tap(1, data)
+        self.assertIn('Подписка уже удалена', response['text'])
+        self.assertNotIn('reply_markup', response)
+        self.assertEqual(len(self.api.sent('answerCallbackQuery')), 2)
+
+    def test_bad_callback_data_is_answered_without_reply(self):
+        bad = ['d:abc', 'd:', 'zz:1', 'c:99:0', 'c:x', 's:99999', 's:-', '']
+        for data in bad:
+            self.assertIsNone(self.tap(1, data), data)
+        self.assertEqual(len(self.api.sent('answerCallbackQuery')), len(bad))
+
+    def test_catalog_buttons(self):
+        response = self.tap(1, f'{self.bot.CALLBACK_CATEGORY}:0:0')
+        self.assertEqual(response['method'], 'editMessageText')
+        service = response['reply_markup']['inline_keyboard'][0][0]
+        card = self.tap(1, service['callback_data'])
+        self.assertEqual(card['method'], 'sendMessage')
+        self.assertIn(service['text'], card['text'])
+
+    def test_polling_answers_query_before_edit(self):
+        self.bot.db_manager.add_subscription(1, 'Okko', 29900, 1)
+        data = self.delete_buttons(1)[0]
+        query = {'id': 'q-poll', 'data': data, 'message': {'message_id': 7, 'chat': {'id': 1}}}
+        self.api.updates = [self.update(1, callback_query=query)]
+        worker = self.bot.PollingWorker(self.processor, client=self.client, poll_timeout=0, send_rate=1e6)
+
+        self.assertEqual(worker.run_once(), 1)
+        methods = [name for name, _ in self.api.calls if name != 'getUpdates']
+        self.assertEqual(methods, ['answerCallbackQuery', 'editMessageText'])
+        self.assertEqual(self.api.sent('answerCallbackQuery'), [{'method': 'answerCallbackQuery', 'callback_query_id': 'q-poll'}])
@@ -0,0 +1,54 @@
+"""Отсев повторно доставленных обновлений (UpdateDeduplicator)."""
+
+import json
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class UpdateDeduplicatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = self.bot.db_manager
+
+    def dedup(self, **kwargs):
+        return self.bot.UpdateDeduplicator(self.db, **kwargs)
+
+    def test_ring_eviction_falls_back_to_sqlite(self):
+        dedup = self.dedup(capacity=2)
+        for update_id in (1, 2, 3):
+            self.assertTrue(dedup.check_and_mark(update_id, 1))
+        self.assertNotIn(1, dedup._seen)
+        self.assertFalse(dedup.check_and_mark(1, 1))
+        # Повтор из кольца не обращается к SQLite
+        self.assertFalse(dedup.check_and_mark(3, 1))
+        self.assertEqual(dedup.duplicates, 2)
+
+    def test_marks_survive_restart(self):
+        self.dedup().check_and_mark(10, 1)
+        self.assertFalse(self.dedup().check_and_mark(10, 1))
+        self.assertTrue(self.dedup().check_and_mark(11, 1))
+
+    def test_check_recent_does_not_write_sqlite(self):
+        dedup = self.dedup()
+        self.assertTrue(dedup.check_recent(5))
+        self.assertFalse(dedup.check_recent(5))
+        self.assertTrue(self.dedup().check_and_mark(5, 1))
+
+    def test_expired_marks_are_purged(self):
+        self.dedup().check_and_mark(1, 1)
+        self.assertEqual(self.dedup(ttl=0).purge_expired(), 1)
+        self.assertTrue(self.dedup().check_and_mark(1, 1))
+
+    def test_redelivered_update_is_handled_once(self):
+        limiter = self.bot.RateLimiter(rate=1e9, burst=1e9)
+        processor = self.bot.MessageProcessor(limiter=limiter, deduplicator=self.dedup())
+        processor.handle_update({'update_id': 1, 'message': {'chat': {'id': 1}, 'text': '➕ Своя подписка'}})
+        update = {'update_id': 2, 'message': {'chat': {'id': 1}, 'text': 'Сервис'}}
+        self.assertIn('Шаг 2 из 3', json.loads(processor.handle_update(update))['text'])
+        # Новый инстанс (пустое кольцо) получил тот же update_id от Telegram
+        other = self.bot.MessageProcessor(limiter=limiter, sessions=processor.sessions, deduplicator=self.dedup())
+        self.assertIsNone(other.handle_update(update))
+        self.assertIsNone(processor.handle_update(update))
+        self.assertEqual(processor.sessions.get(1)['name'], 'Сервис')
@@ -0,0 +1,51 @@
+"""Загрузка подписок из файла, присланного в чат (SubscriptionImporter)."""
+
+import unittest
+
+import pytest
+
+CSV = '''service_name,price,charge_day,is_active
+Okko,299,5,1
+Netflix,599,10,0
+,100,1,1
+'''
+
+
+@pytest.mark.usefixtures('bot_case', 'bot_api')
+class DocumentImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = self.bot.TelegramClient(token='TEST', api_url=self.api.url)
+        limiter = self.bot.RateLimiter(rate=1e9, burst=1e9)
+        self.processor = self.bot.MessageProcessor(limiter=limiter, client=self.client)
+
+    def tearDown(self):
+        self.client.close()
+
+    def upload(self, chat_id, file_name, data):
+        self.api.files['f1'] = data.encode('utf-8')
+        document = {'file_id': 'f1', 'file_name': file_name, 'file_size': len(data)}
+        update = {'update_id': 1, 'message': {'chat': {'id': chat_id}, 'document': document}}
+        return self.processor.handle_update(update)
+
+    def test_document_is_imported_to_chat_owner(self):
+        body = self.upload(1, 'subs.csv', CSV).decode('utf-8')
+        self.assertIn('Добавлено:* 2', body)
+        self.assertIn('С ошибками:* 1', body)
+        self.assertEqual(self.api.sent('getFile'), [{'file_id': 'f1'}])
+        names = sorted(row[1] for row in self.bot.db_manager.get_user_subscriptions(1))
+        self.assertEqual(names, ['Okko'])
+
+    def test_inactive_rows_do_not_count_as_added_or_saved(self):
+        self.upload(1, 'subs.csv', CSV)
+        db = self.bot.db_manager
+        stats = db.get_user_stats(1)
+        self.assertEqual((stats['active_count'], stats['cancelled_count'], stats['total_saved']), (1, 1, 0))
+        month = db.get_spend_history(1, months=1)['months'][-1]
+        self.assertEqual((month['spend'], month['saved']), (29900, 0))
+        with db.read() as cursor:
+            cursor.execute('SELECT added FROM monthly_spend WHERE user_id = 1')
+            self.assertEqual(cursor.fetchone(), (29900,))
+            # Отмененная до загрузки подписка не копит экономию в следующих месяцах
+            cursor.execute('SELECT cancelled_monthly FROM user_stats WHERE user_id = 1')
+            self.assertEqual(cursor.fetchone(), (0,))
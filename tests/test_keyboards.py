@@ -0,0 +1,85 @@
+"""Пропуск неизменившихся reply-клавиатур (KeyboardTracker)."""
+
+import json
+import time
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class KeyboardTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keyboards = self.bot.KeyboardTracker(ttl=60)
+        self.replies = self.bot.StaticReplies
+
+    def sends_keyboard(self, response, chat_id=1, keyboards=None):
+        response = (keyboards or self.keyboards).apply(response, chat_id)
+        return 'reply_markup' in json.loads(self.bot.encode_response(response, chat_id))
+
+    def test_same_keyboard_is_sent_once(self):
+        self.assertTrue(self.sends_keyboard(self.replies.HELP))
+        self.assertFalse(self.sends_keyboard(self.replies.LAWS))
+        # Другой чат получает клавиатуру отдельно
+        self.assertTrue(self.sends_keyboard(self.replies.LAWS, chat_id=2))
+        self.assertEqual(self.keyboards.omitted, 1)
+        self.assertEqual(self.keyboards.saved_bytes, self.replies.LAWS.markup_size)
+
+    def test_changed_keyboard_is_sent_again(self):
+        self.sends_keyboard(self.replies.HELP)
+        self.assertTrue(self.sends_keyboard(self.replies.WIZARD_NAME))
+        self.assertTrue(self.sends_keyboard(self.replies.HELP))
+
+    def test_forget_and_remove_keyboard_reset_chat(self):
+        self.sends_keyboard(self.replies.HELP)
+        self.keyboards.forget(1)
+        self.assertTrue(self.sends_keyboard(self.replies.HELP))
+        removed = {'method': 'sendMessage', 'chat_id': 1, 'text': 'x', 'reply_markup': {'remove_keyboard': True}}
+        self.assertTrue(self.sends_keyboard(removed))
+        self.assertTrue(self.sends_keyboard(self.replies.HELP))
+
+    def test_dict_response_with_persistent_keyboard(self):
+        response = {'method': 'sendMessage', 'chat_id': 1, 'text': 'x', 'reply_markup': self.bot.MAIN_KEYBOARD}
+        self.assertTrue(self.sends_keyboard(self.replies.HELP))
+        self.assertFalse(self.sends_keyboard(response))
+        self.assertIn('reply_markup', response)
+
+    def test_fingerprint_expires_and_ttl_zero_disables(self):
+        keyboards = self.bot.KeyboardTracker(ttl=0.05)
+        self.sends_keyboard(self.replies.HELP, keyboards=keyboards)
+        self.assertFalse(self.sends_keyboard(self.replies.HELP, keyboards=keyboards))
+        time.sleep(0.06)
+        self.assertTrue(self.sends_keyboard(self.replies.HELP, keyboards=keyboards))
+
+        disabled = self.bot.KeyboardTracker(ttl=0)
+        for _ in range(2):
+            self.assertTrue(self.sends_keyboard(self.replies.HELP, keyboards=disabled))
+
+    def test_lru_eviction_resends_keyboard(self):
+        keyboards = self.bot.KeyboardTracker(capacity=1, ttl=60)
+        self.sends_keyboard(self.replies.HELP, chat_id=1, keyboards=keyboards)
+        self.sends_keyboard(self.replies.HELP, chat_id=2, keyboards=keyboards)
+        self.assertTrue(self.sends_keyboard(self.replies.HELP, chat_id=1, keyboards=keyboards))
+
+    def test_repeated_edit_is_skipped(self):
+        edit = {'method': 'editMessageText', 'chat_id': 1, 'message_id': 7, 'text': 'a'}
+        self.assertIs(self.keyboards.apply(edit, 1), edit)
+        self.assertIsNone(self.keyboards.apply(dict(edit), 1))
+        self.assertIsNotNone(self.keyboards.apply(dict(edit, text='b'), 1))
+        self.assertIsNotNone(self.keyboards.apply(dict(edit, text='b', message_id=8), 1))
+        self.assertEqual(self.keyboards.skipped_edits, 1)
+
+    def test_processor_omits_keyboard_until_start(self):
+        limiter = self.bot.RateLimiter(rate=1e9, burst=1e9)
+        processor = self.bot.MessageProcessor(limiter=limiter, keyboards=self.keyboards)
+
+        def send(update_id, text):
+            update = {'update_id': update_id, 'message': {'chat': {'id': 1}, 'text': text}}
+            return json.loads(processor.handle_update(update))
+
+        self.assertIn('reply_markup', send(1, 'Помощь'))
+        self.assertNotIn('reply_markup', send(2, 'О законе'))
+        # /start всегда возвращает клавиатуру
+        self.assertIn('reply_markup', send(3, '/start'))
+        self.assertNotIn('reply_markup', send(4, 'Помощь'))
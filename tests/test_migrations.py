@@ -0,0 +1,73 @@
+"""Миграции схемы SQLite при запуске с базой прежней версии."""
+
+import io
+import os
+import sqlite3
+import unittest
+from contextlib import redirect_stdout
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class MigrationTest(unittest.TestCase):
+
+    def indexes(self, path):
+        conn = sqlite3.connect(path)
+        try:
+            return {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        finally:
+            conn.close()
+
+    def test_new_database_has_no_updated_date_index(self):
+        self.bot.db_manager.get_user_stats(1)
+        self.assertNotIn('idx_updated_date', self.indexes(self.bot.db_manager.db_path))
+
+    def test_updated_date_index_is_dropped_on_upgrade(self):
+        path = os.path.join(self.workdir, 'old.db')
+        db = self.load_bot(path).db_manager
+        db.get_user_stats(1)
+        db.close()
+        # База, обновленная прежней версией миграции 8
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE INDEX idx_updated_date ON subscriptions(updated_date)')
+        conn.execute('PRAGMA user_version = 9')
+        conn.commit()
+        conn.close()
+
+        bot = self.load_bot(path)
+        bot.db_manager.get_user_stats(1)
+        self.assertNotIn('idx_updated_date', self.indexes(path))
+        with bot.db_manager.read() as cursor:
+            self.assertEqual(cursor.execute('PRAGMA user_version').fetchone()[0], bot.SCHEMA_VERSION)
+
+    def test_end_dates_are_converted_to_iso(self):
+        path = os.path.join(self.workdir, 'v4.db')
+        conn = sqlite3.connect(path)
+        # База версии 4: даты окончания в том виде, как их ввели в мастере
+        for _, statements in self.bot.MIGRATIONS[:4]:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn.cursor())
+                else:
+                    conn.execute(statement)
+        conn.execute('PRAGMA user_version = 4')
+        rows = [('05.03', '2029-06-01'), ('31.12.31', '2029-06-01'), ('до весны', '2029-06-01'), ('2031-02-01', '2029-06-01')]
+        conn.executemany(
+            "INSERT INTO subscriptions (user_id, service_name, price, charge_day, end_date, created_date) VALUES (1, 'Okko', 299, 1, ?, ?)",
+            rows
+        )
+        conn.commit()
+        conn.close()
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            db = self.load_bot(path).db_manager
+            db.get_user_stats(1)
+        with db.read() as cursor:
+            cursor.execute('SELECT end_date FROM subscriptions ORDER BY id')
+            end_dates = [end_date for (end_date,) in cursor.fetchall()]
+        # Неразобранная дата сохраняется и попадает в лог
+        self.assertEqual(end_dates, ['2029-03-05', '2031-12-31', 'до весны', '2031-02-01'])
+        self.assertIn("3='до весны'", output.getvalue())
+        self.assertNotIn('2031-02-01', output.getvalue())
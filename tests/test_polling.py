@@ -0,0 +1,92 @@
+"""Режим long polling против локального сервера, подменяющего Bot API.
+
+Сервер отдает getUpdates из списка обновлений (как Telegram: начиная с
+offset) и запоминает все вызовы. Проверяются сохранение offset между
+запусками, отсев повторных update_id, ограничение частоты по времени
+отправки сообщений и откат записей упавшего обновления.
+"""
+
+import os
+import time
+import unittest
+
+import pytest
+
+
+def message(update_id, chat_id, text, date=None):
+    update = {'update_id': update_id, 'message': {'chat': {'id': chat_id}, 'text': text}}
+    if date is not None:
+        update['message']['date'] = date
+    return update
+
+
+@pytest.mark.usefixtures('bot_case', 'bot_api')
+class PollingWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = os.path.join(self.workdir, 'test.db')
+
+    def make_worker(self, bot=None, limiter=None):
+        bot = bot or self.bot
+        limiter = limiter or bot.RateLimiter(rate=1e9, burst=1e9)
+        client = bot.TelegramClient(token='TEST', api_url=self.api.url)
+        return bot.PollingWorker(bot.MessageProcessor(limiter=limiter), client=client, poll_timeout=0, send_rate=1e6)
+
+    def test_offset_survives_restart(self):
+        self.api.updates = [message(10, 1, 'Мои подписки'), message(11, 2, 'Статистика')]
+        self.assertEqual(self.make_worker().run_once(), 2)
+        self.assertEqual(len(self.api.sent()), 2)
+        self.bot.db_manager.close()
+
+        # Новый процесс с той же базой продолжает с сохраненного offset
+        restarted = self.load_bot(self.db_path)
+        self.assertEqual(self.make_worker(restarted).run_once(), 0)
+        self.assertEqual(self.api.sent('getUpdates')[-1]['offset'], 12)
+        self.assertEqual(len(self.api.sent()), 2)
+
+    def test_redelivered_update_is_answered_once(self):
+        self.api.updates = [message(20, 1, 'Мои подписки')]
+        self.api.ignore_offset = True
+        worker = self.make_worker()
+        worker.run_once()
+        worker.run_once()
+        self.assertEqual(len(self.api.sent()), 1)
+        self.assertEqual(worker.processor.deduplicator.duplicates, 1)
+
+    def test_backlog_from_downtime_is_not_rate_limited(self):
+        # 20 сообщений за 100 секунд простоя приходят одним пакетом
+        sent_at = time.time() - 100
+        self.api.updates = [message(40 + i, 1, 'Мои подписки', int(sent_at) + 5 * i) for i in range(20)]
+        worker = self.make_worker(limiter=self.bot.RateLimiter())
+        self.assertEqual(worker.run_once(), 20)
+        self.assertEqual(len(self.api.sent()), 20)
+        self.assertEqual(worker.processor.limiter.rejected_rate, 0)
+
+    def test_flood_sent_within_one_second_is_limited(self):
+        now = int(time.time())
+        self.api.updates = [message(60 + i, 1, 'Мои подписки', now) for i in range(20)]
+        worker = self.make_worker(limiter=self.bot.RateLimiter(burst=8))
+        worker.run_once()
+        replies = [payload['text'] for payload in self.api.sent()]
+        self.assertEqual(len(replies), 9)
+        self.assertIn('Слишком много сообщений', replies[-1])
+
+    def test_failed_update_rolls_back_only_its_writes(self):
+        self.api.updates = [message(30, 1, 'a'), message(31, 2, 'b'), message(32, 3, 'c')]
+        worker = self.make_worker()
+        db = worker.db
+
+        def dispatch(update):
+            chat_id = update['message']['chat']['id']
+            db.add_subscription(chat_id, 'Сервис', 10000, 1)
+            if update['update_id'] == 31:
+                raise RuntimeError('сбой обработчика')
+            return None
+
+        worker.processor.dispatch_update = dispatch
+        self.assertEqual(worker.run_once(), 3)
+        db.invalidate()
+        self.assertEqual(len(db.get_user_subscriptions(1)), 1)
+        self.assertEqual(db.get_user_subscriptions(2), [])
+        self.assertEqual(len(db.get_user_subscriptions(3)), 1)
+        self.assertEqual(int(db.get_state(worker.OFFSET_KEY)), 33)
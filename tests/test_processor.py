@@ -0,0 +1,46 @@
+"""Маршрутизация сообщений в MessageProcessor: меню, мастер добавления, подсказки."""
+
+import json
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class MessageProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        limiter = self.bot.RateLimiter(rate=1e9, burst=1e9)
+        self.processor = self.bot.MessageProcessor(limiter=limiter)
+        self.update_id = 0
+
+    def send(self, chat_id, text):
+        """Текст ответа на сообщение (через полный путь обработки Update)"""
+        self.update_id += 1
+        update = {'update_id': self.update_id, 'message': {'chat': {'id': chat_id}, 'text': text}}
+        body = self.processor.handle_update(update)
+        return json.loads(body)['text'] if body is not None else None
+
+    def test_static_menu_interrupts_wizard(self):
+        self.assertIn('Шаг 1 из 3', self.send(1, '➕ Своя подписка'))
+        self.assertIn('Управление подписками', self.send(1, 'Управление подписками'))
+        # Кнопка категории - снова команда, а не название подписки
+        self.assertNotIn('Шаг 2 из 3', self.send(1, '📁 Покупки'))
+        self.assertNotIn('Неверный формат цены', self.send(1, 'Мои подписки'))
+        self.assertIsNone(self.processor.sessions.get(1))
+        self.assertEqual(self.bot.db_manager.get_user_subscriptions(1), [])
+
+    def test_each_static_command_discards_wizard(self):
+        static = [text for text in self.processor.router._static if text != '/start']
+        for chat_id, text in enumerate(static, start=1):
+            self.send(chat_id, '➕ Своя подписка')
+            self.send(chat_id, text)
+            self.assertIsNone(self.processor.sessions.get(chat_id), text)
+
+    def test_wizard_adds_subscription(self):
+        self.send(1, '➕ Своя подписка')
+        self.send(1, 'Сервис')
+        self.send(1, '149.5')
+        self.send(1, '⏩ Пропустить')
+        rows = self.bot.db_manager.get_user_subscriptions(1)
+        self.assertEqual([row[1:3] for row in rows], [('Сервис', 14950)])
@@ -0,0 +1,133 @@
+"""Рассылка напоминаний (ReminderScheduler) и запуск по расписанию /cron/reminders."""
+
+import asyncio
+import http.client
+import json
+import threading
+import unittest
+from datetime import date
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+TODAY = date(2030, 1, 10)
+
+
+@pytest.mark.usefixtures('bot_case', 'bot_api')
+class ReminderSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = self.bot.TelegramClient(token='TEST', api_url=self.api.url)
+        self.db = self.bot.db_manager
+        self.db.add_subscription(1, 'Okko', 29900, 11)
+        self.db.add_subscription(1, 'Кинопоиск', 39900, 13)
+        self.db.add_subscription(2, 'Яндекс Плюс', 29900, 14)
+
+    def tearDown(self):
+        self.client.close()
+
+    def run_scheduler(self, today):
+        """Запуск рассылки за день today; возвращает отправленные в этот раз сообщения"""
+        sent = len(self.api.sent())
+        queue = self.bot.SendQueue(self.client, rate=1e6, burst=100)
+        self.bot.ReminderScheduler(self.db, days_ahead=3).run(queue, today)
+        queue.drain()
+        self.assertEqual(queue.failed, 0)
+        return self.api.sent()[sent:]
+
+    def test_one_digest_per_chat_for_window(self):
+        sent = self.run_scheduler(TODAY)
+        self.assertEqual([message['chat_id'] for message in sent], [1])
+        self.assertIn('Okko', sent[0]['text'])
+        self.assertIn('Кинопоиск', sent[0]['text'])
+
+    def test_each_date_is_reminded_once(self):
+        self.run_scheduler(TODAY)
+        sent = self.run_scheduler(date(2030, 1, 11))
+        # Окно сдвинулось на 14 января: о 11 и 13 уже напомнили
+        self.assertEqual([message['chat_id'] for message in sent], [2])
+        self.assertNotIn('Okko', sent[0]['text'])
+
+    def test_repeated_run_sends_nothing(self):
+        self.run_scheduler(TODAY)
+        self.assertEqual(self.run_scheduler(TODAY), [])
+        self.assertEqual(len(self.api.sent()), 1)
+
+    def test_missed_runs_are_caught_up(self):
+        self.assertEqual(self.run_scheduler(date(2030, 1, 7)), [])
+        # Запуски 8 и 9 января пропущены: 11 число не теряется вместе с 13
+        sent = self.run_scheduler(TODAY)
+        self.assertEqual([message['chat_id'] for message in sent], [1])
+        self.assertIn('Okko', sent[0]['text'])
+        self.assertIn('Кинопоиск', sent[0]['text'])
+        self.assertEqual(self.db.get_state(self.bot.ReminderScheduler.STATE_KEY), '2030-01-13')
+
+    def test_first_run_does_not_remind_about_past_dates(self):
+        self.assertEqual(self.run_scheduler(date(2030, 1, 15)), [])
+
+
+@pytest.mark.usefixtures('bot_case', 'bot_api')
+class CronEndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.monkeypatch.setenv('TELEGRAM_API_URL', self.api.url)
+        self.monkeypatch.setenv('TELEGRAM_BOT_TOKEN', 'TEST')
+        self.monkeypatch.delenv('CRON_SECRET', raising=False)
+        self.bot.db_manager.add_subscription(1, 'Okko', 29900, date.today().day)
+
+    def asgi(self, authorization=None):
+        """Статус и тело ответа AsgiApp на GET /cron/reminders"""
+        headers = [(b'authorization', authorization.encode('utf-8'))] if authorization else []
+        scope = {'type': 'http', 'method': 'GET', 'path': '/cron/reminders', 'headers': headers}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        async def request():
+            app = self.bot.AsgiApp(self.bot.MessageProcessor())
+            await app(scope, receive, send)
+            await app.shutdown()
+
+        asyncio.run(request())
+        return messages[0]['status'], messages[1]['body']
+
+    def handler(self, authorization=None):
+        """Статус и тело ответа BotHandler (Vercel) на GET /cron/reminders"""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), self.bot.BotHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+            conn.request('GET', '/cron/reminders', headers={'Authorization': authorization} if authorization else {})
+            response = conn.getresponse()
+            result = response.status, response.read()
+            conn.close()
+            return result
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_cron_requires_secret(self):
+        for call in (self.asgi, self.handler):
+            # Без CRON_SECRET в окружении запуск запрещен при любом заголовке
+            self.assertEqual(call()[0], 401)
+            self.assertEqual(call('Bearer ')[0], 401)
+            self.assertEqual(call('Bearer None')[0], 401)
+        self.monkeypatch.setenv('CRON_SECRET', 'cron')
+        for call in (self.asgi, self.handler):
+            self.assertEqual(call('Bearer wrong')[0], 401)
+        self.assertEqual(self.api.sent(), [])
+
+    def test_cron_sends_reminders_once_per_day(self):
+        self.monkeypatch.setenv('CRON_SECRET', 'cron')
+        status, body = self.asgi('Bearer cron')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {'chats': 1, 'sent': 1, 'failed': 0})
+        status, body = self.handler('Bearer cron')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['chats'], 0)
+        self.assertEqual([message['chat_id'] for message in self.api.sent()], [1])
@@ -0,0 +1,48 @@
+"""Заранее сериализованные ответы (PreparedReply, StaticReplies)."""
+
+import json
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class PreparedReplyTest(unittest.TestCase):
+
+    def static_replies(self):
+        replies = self.bot.StaticReplies
+        return {name: value for name, value in vars(replies).items() if isinstance(value, self.bot.PreparedReply)}
+
+    def test_rendered_bytes_match_json_payload(self):
+        replies = self.static_replies()
+        self.assertIn('START', replies)
+        for name, reply in replies.items():
+            for chat_id in (1, 123456789, -1001234567890):
+                body = reply.render(chat_id)
+                self.assertEqual(json.loads(body), reply.as_dict(chat_id), name)
+                self.assertEqual(json.loads(reply.bare.render(chat_id)), reply.bare.as_dict(chat_id), name)
+
+    def test_bare_variant_drops_only_persistent_keyboard(self):
+        reply = self.bot.StaticReplies.START
+        self.assertIsNotNone(reply.fingerprint)
+        self.assertNotIn('reply_markup', json.loads(reply.bare.render(1)))
+        full = reply.as_dict(1)
+        del full['reply_markup']
+        self.assertEqual(reply.bare.as_dict(1), full)
+        self.assertEqual(len(reply.render(1)) - len(reply.bare.render(1)), reply.markup_size)
+
+        inline = self.bot.PreparedReply('text', {'inline_keyboard': [[{'text': 'a', 'callback_data': 'x'}]]})
+        self.assertIs(inline.bare, inline)
+        self.assertIsNone(inline.fingerprint)
+        plain = self.bot.PreparedReply('text', parse_mode=None)
+        self.assertEqual(json.loads(plain.render(5)), {'method': 'sendMessage', 'chat_id': 5, 'text': 'text'})
+
+    def test_chat_id_is_rendered_as_integer(self):
+        body = self.bot.StaticReplies.HELP.render('42')
+        self.assertTrue(body.startswith(b'{"method":"sendMessage","chat_id":42,'))
+
+    def test_static_command_returns_prepared_bytes(self):
+        limiter = self.bot.RateLimiter(rate=1e9, burst=1e9)
+        processor = self.bot.MessageProcessor(limiter=limiter)
+        update = {'update_id': 1, 'message': {'chat': {'id': 7}, 'text': '/start'}}
+        self.assertEqual(processor.handle_update(update), self.bot.StaticReplies.START.render(7))
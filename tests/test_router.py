@@ -0,0 +1,45 @@
+"""Таблица маршрутов команд (CommandRouter)."""
+
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class CommandRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = self.bot.CommandRouter()
+        self.router.add('❌ Отмена', 'cancel', 'cancel')
+        self.router.add('/start', 'start', 'start', static=True)
+        self.router.add_prefix('❌ ', 'cross', 'cross')
+        self.router.add_prefix('❌ Удалить ', 'delete', 'delete')
+
+    def test_longest_prefix_wins(self):
+        self.assertEqual(self.router.resolve('❌ Удалить Okko'), ('delete', 'delete', 'Okko'))
+        # Текст обрывается внутри длинного префикса - действует короткий
+        self.assertEqual(self.router.resolve('❌ Удал'), ('cross', 'cross', 'Удал'))
+        self.assertEqual(self.router.resolve('❌ Удалить '), ('delete', 'delete', ''))
+
+    def test_exact_command_beats_prefix(self):
+        self.assertEqual(self.router.resolve('❌ Отмена'), ('cancel', 'cancel', '❌ Отмена'))
+
+    def test_unknown_text_is_not_routed(self):
+        for text in ('', '❌', 'Удалить Okko', ' ❌ Удалить Okko', '/start now'):
+            self.assertIsNone(self.router.resolve(text), text)
+
+    def test_static_routes_and_hits(self):
+        self.assertEqual(self.router.resolve_static('/start'), ('start', 'start'))
+        self.assertIsNone(self.router.resolve_static('❌ Отмена'))
+        self.router.resolve('❌ Удалить Okko')
+        self.router.resolve('❌ x')
+        self.router.resolve('нет такого')
+        self.assertEqual(self.router.hits, {'cancel': 0, 'start': 1, 'cross': 1, 'delete': 1})
+
+    def test_processor_routes(self):
+        limiter = self.bot.RateLimiter(rate=1e9, burst=1e9)
+        router = self.bot.MessageProcessor(limiter=limiter).router
+        self.assertEqual(router.resolve('📁 Покупки')[1:], ('category', 'Покупки'))
+        self.assertEqual(router.resolve('❌ Удалить Okko')[1], 'delete_subscription')
+        self.assertEqual(router.resolve('❌ Отмена')[1], 'cancel')
+        self.assertEqual(router.resolve_static('/start')[1], 'main_menu')
@@ -0,0 +1,92 @@
+"""Встроенный HTTP-сервер (AsyncHttpServer) с приложением AsgiApp."""
+
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import time
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class AsyncHttpServerTest(unittest.TestCase):
+
+    def setUp(self):
+        limiter = self.bot.RateLimiter(rate=1e9, burst=1e9)
+        self.app = self.bot.AsgiApp(self.bot.MessageProcessor(limiter=limiter), max_body=1024)
+        self.server = self.bot.AsyncHttpServer(self.app, '127.0.0.1', 0)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.server.serve(),), daemon=True)
+        self.thread.start()
+        while self.server._server is None:
+            time.sleep(0.01)
+        self.port = self.server._server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.server.stop)
+        self.thread.join(5)
+
+    def post(self, conn, path, body, headers=None):
+        conn.request('POST', path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def test_webhook_keeps_connection_alive(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        for update_id in (1, 2):
+            update = {'update_id': update_id, 'message': {'chat': {'id': 1}, 'text': 'Мои подписки'}}
+            status, body = self.post(conn, '/', json.dumps(update))
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)['chat_id'], 1)
+        conn.close()
+
+    def test_oversized_body_is_rejected_before_it_is_read(self):
+        # Заявлено 100 МБ, отправлены только заголовки: ответ приходит сразу
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall(b'POST / HTTP/1.1\r\nHost: test\r\nContent-Length: 104857600\r\n\r\n' + b'{' * 4096)
+            response = sock.recv(4096)
+        self.assertTrue(response.startswith(b'HTTP/1.1 413'))
+        self.assertIn(b'Connection: close', response)
+
+    def raw(self, request):
+        """Ответ сервера на запрос, отправленный как есть (до закрытия соединения)"""
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall(request)
+            chunks = []
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+
+    def test_ambiguous_content_length_is_rejected(self):
+        for value in (b'-5', b'abc', b'+5', b'5, 5'):
+            response = self.raw(b'POST / HTTP/1.1\r\nHost: test\r\nContent-Length: ' + value + b'\r\n\r\n{}')
+            self.assertTrue(response.startswith(b'HTTP/1.1 400'), value)
+        response = self.raw(b'POST / HTTP/1.1\r\nContent-Length: 2\r\nContent-Length: 2\r\n\r\n{}')
+        self.assertTrue(response.startswith(b'HTTP/1.1 400'))
+
+    def test_chunked_request_is_not_parsed_as_next_request(self):
+        update = json.dumps({'update_id': 1, 'message': {'chat': {'id': 1}, 'text': 'Мои подписки'}}).encode('utf-8')
+        body = b'%x\r\n%s\r\n0\r\n\r\n' % (len(update), update)
+        response = self.raw(b'POST / HTTP/1.1\r\nHost: test\r\nTransfer-Encoding: chunked\r\n\r\n' + body)
+        # Один ответ, соединение закрыто: тело не стало следующим запросом
+        self.assertTrue(response.startswith(b'HTTP/1.1 411'))
+        self.assertEqual(response.count(b'HTTP/1.1'), 1)
+        self.assertIn(b'Connection: close', response)
+        self.assertEqual(self.bot.metrics.errors, {})
+
+    def test_admin_import_body_is_streamed(self):
+        self.monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+        rows = ''.join(f'{user_id},Сервис {user_id},199,5\n' for user_id in range(5000))
+        body = ('user_id,service_name,price,charge_day\n' + rows).encode('utf-8')
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        status, report = self.post(
+            conn, '/admin/import?format=csv', body, {'Authorization': 'Bearer secret'}
+        )
+        conn.close()
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(report)['imported'], 5000)
@@ -0,0 +1,72 @@
+"""Сессии мастера (SessionStore): LRU в памяти поверх SQLite."""
+
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class SessionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = self.bot.db_manager
+
+    def store(self, **kwargs):
+        return self.bot.SessionStore(self.db, **kwargs)
+
+    def rows(self):
+        # Пустая операция дожидается записей, поставленных в очередь раньше
+        self.db.writer.execute(lambda: None)
+        with self.db.read() as cursor:
+            cursor.execute('SELECT chat_id FROM user_sessions ORDER BY chat_id')
+            return [chat_id for (chat_id,) in cursor.fetchall()]
+
+    def test_session_survives_restart(self):
+        self.store().set(1, {'step': 'price', 'name': 'Okko'})
+        # Новый инстанс с пустой памятью читает сессию из SQLite
+        self.assertEqual(self.store().get(1), {'step': 'price', 'name': 'Okko'})
+
+    def test_lru_keeps_recent_chats_in_memory(self):
+        sessions = self.store(capacity=2)
+        for chat_id in (1, 2, 3):
+            sessions.set(chat_id, {'chat': chat_id})
+        sessions.get(2)
+        sessions.set(4, {'chat': 4})
+        self.assertEqual(list(sessions._front), [2, 4])
+        # Вытесненная из памяти сессия читается с диска
+        self.assertEqual(sessions.get(1), {'chat': 1})
+        self.assertEqual(self.rows(), [1, 2, 3, 4])
+
+    def test_memory_entry_expires_after_front_ttl(self):
+        sessions = self.store(front_ttl=0)
+        sessions.set(1, {'step': 'name'})
+        # Другой инстанс продвинул мастер: без свежей записи в памяти читается SQLite
+        self.store().set(1, {'step': 'price'})
+        self.assertEqual(sessions.get(1), {'step': 'price'})
+
+    def test_expired_session_is_ignored_and_purged(self):
+        self.store().set(1, {'step': 'name'})
+        sessions = self.store(ttl=0)
+        self.assertIsNone(sessions.get(1))
+        self.assertEqual(sessions.purge_expired(), 1)
+        self.assertEqual(self.rows(), [])
+
+    def test_discard_skips_sqlite_until_next_read(self):
+        sessions = self.store()
+        sessions.set(1, {'step': 'name'})
+        sessions.set(2, {'step': 'name'})
+        sessions.discard(1)
+        self.assertIsNone(sessions.get(1))
+        self.assertEqual(self.rows(), [1, 2])
+        # Следующее чтение с диска удаляет сброшенные строки
+        self.assertEqual(self.store().get(2), {'step': 'name'})
+        sessions.get(3)
+        self.assertEqual(self.rows(), [2])
+        self.assertIsNone(self.store().get(1))
+
+    def test_delete_removes_row(self):
+        sessions = self.store()
+        sessions.set(1, {'step': 'name'})
+        sessions.delete(1)
+        self.assertIsNone(sessions.get(1))
+        self.assertEqual(self.rows(), [])
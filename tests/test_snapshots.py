@@ -0,0 +1,59 @@
+"""Сжатые снимки SQLite и восстановление на холодном старте (SnapshotStore)."""
+
+import os
+import time
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class SnapshotStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = os.path.join(self.workdir, 'bot.db')
+        self.store = self.bot.SnapshotStore(os.path.join(self.workdir, 'snapshots'), keep=2, interval=3600)
+
+    def open_db(self):
+        return self.bot.DatabaseManager(self.db_path, snapshots=self.store)
+
+    def test_missing_database_is_restored_from_newest_snapshot(self):
+        db = self.open_db()
+        db.add_subscription(1, 'Okko', 29900, 1)
+        self.store.save(db)
+        # Имена снимков различаются по времени
+        time.sleep(1.1)
+        db.add_subscription(1, 'Кинопоиск', 39900, 1)
+        self.store.save(db)
+        db.close()
+        self.assertEqual(len(self.store.snapshots(self.db_path)), 2)
+
+        os.remove(self.db_path)
+        db = self.open_db()
+        try:
+            self.assertEqual(db.get_user_stats(1)['active_count'], 2)
+        finally:
+            db.close()
+
+    def test_corrupt_snapshot_falls_back_and_keeps_metric_label(self):
+        db = self.open_db()
+        db.add_subscription(1, 'Okko', 29900, 1)
+        self.store.save(db)
+        time.sleep(1.1)
+        db.add_subscription(1, 'Кинопоиск', 39900, 1)
+        self.store.save(db)
+        db.close()
+
+        newest = self.store.snapshots(self.db_path)[0]
+        with open(newest, 'r+b') as f:
+            f.truncate(os.path.getsize(newest) // 2)
+        os.remove(self.db_path)
+
+        self.assertTrue(self.store.restore(self.db_path))
+        # Метка метрики не зависит от пути снимка
+        self.assertEqual(self.bot.metrics.errors.get('Снимок БД поврежден'), 1)
+        db = self.bot.DatabaseManager(self.db_path)
+        try:
+            self.assertEqual(db.get_user_stats(1)['active_count'], 1)
+        finally:
+            db.close()
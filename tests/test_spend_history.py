@@ -0,0 +1,67 @@
+"""Журнал событий подписок и помесячная сводка monthly_spend."""
+
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class SpendHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = self.bot.db_manager
+        last = self.bot._month_number(self.bot.current_month())
+        # Позапрошлый, прошлый и текущий месяцы
+        self.months = [self.bot._month_name(number) for number in range(last - 2, last + 1)]
+
+    def event(self, month, sub_id, kind, price, old_price=None):
+        with self.db.transaction() as cursor:
+            self.bot.record_subscription_event(
+                cursor, sub_id, 1, kind, f'service {sub_id}', 'кино', price, old_price,
+                created_at=f'{self.months[month]}-15 12:00:00'
+            )
+        self.db.invalidate(1)
+
+    def history(self):
+        history = self.db.get_spend_history(1, months=3)
+        return [(item['month'], item['spend'], item['saved']) for item in history['months']], history
+
+    def test_rollup_across_months(self):
+        self.event(0, 1, self.bot.EVENT_ADD, 100)
+        self.event(0, 2, self.bot.EVENT_ADD, 200)
+        self.event(1, 2, self.bot.EVENT_CANCEL, 200)
+        self.event(2, 2, self.bot.EVENT_REACTIVATE, 250, 200)
+        self.event(2, 1, self.bot.EVENT_PRICE_CHANGE, 150, 100)
+
+        months, history = self.history()
+        self.assertEqual(months, [
+            (self.months[0], 300, 0),
+            (self.months[1], 300, 0),
+            # На начало месяца: активна подписка 1 (100), отменена 2 (200);
+            # за месяц подключено 250 и подорожание на 50
+            (self.months[2], 400, 200),
+        ])
+        self.assertEqual((history['total_spend'], history['total_saved']), (1000, 200))
+        # Экономия: отмена 200 действовала один месяц
+        self.assertEqual(self.db.get_user_stats(1)['total_saved'], 200)
+
+    def test_months_without_events_inherit_totals(self):
+        self.event(0, 1, self.bot.EVENT_ADD, 100)
+        self.event(0, 1, self.bot.EVENT_CANCEL, 100)
+        months, history = self.history()
+        self.assertEqual(months, [(self.months[0], 100, 0), (self.months[1], 0, 100), (self.months[2], 0, 100)])
+        # Экономия за месяцы без событий досчитывается при чтении статистики
+        self.assertEqual(self.db.get_user_stats(1)['total_saved'], history['total_saved'])
+
+    def test_writes_update_current_month(self):
+        self.db.add_subscription(1, 'Okko', 29900, 1)
+        self.db.add_subscription(1, 'Кинопоиск', 39900, 1)
+        self.assertEqual(self.history()[0][-1][1:], (69800, 0))
+        self.db.delete_subscription(1, 'Okko')
+        # Отмененная в этом месяце подписка остается в расходах месяца
+        self.assertEqual(self.history()[0][-1][1:], (69800, 0))
+        with self.db.read() as cursor:
+            cursor.execute('SELECT active_total, added, cancelled_total FROM monthly_spend WHERE user_id = 1')
+            self.assertEqual(cursor.fetchall(), [(39900, 69800, 29900)])
+            cursor.execute('SELECT kind FROM subscription_events WHERE user_id = 1 ORDER BY id')
+            self.assertEqual([kind for (kind,) in cursor.fetchall()], ['add', 'add', 'cancel'])
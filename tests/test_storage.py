@@ -0,0 +1,119 @@
+"""Хранилища подписок: интерфейс SubscriptionStorage и MemoryStorage поверх SQLite."""
+
+import os
+import random
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class MemoryStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(self.workdir, 'storage.db')
+        # Фоновая запись не срабатывает сама: тест вызывает flush явно
+        self.db = self.bot.MemoryStorage(self.bot.DatabaseManager(path), flush_interval=3600, max_pending=1 << 20)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_incomplete_engine_is_rejected(self):
+        class ReadOnly(self.bot.SubscriptionStorage):
+            def get_user_subscriptions(self, user_id):
+                return []
+
+        with self.assertRaises(TypeError):
+            ReadOnly()
+
+    def test_memory_answers_match_sqlite_after_flush(self):
+        rng = random.Random(7)
+        for _ in range(2000):
+            user_id, name = rng.randrange(10), rng.choice('ABCDE')
+            roll = rng.random()
+            if roll < 0.5:
+                self.db.add_subscription(user_id, name, rng.choice([10000, 20000]), 1, category=rng.choice('xy'))
+            elif roll < 0.7:
+                self.db.delete_subscription(user_id, name)
+            else:
+                subscriptions = self.db.get_user_subscriptions(user_id)
+                if subscriptions:
+                    self.db.delete_subscription_by_id(user_id, rng.choice(subscriptions)[0])
+
+        in_memory = {
+            user_id: (self.db.get_user_subscriptions(user_id), self.db.get_user_stats(user_id))
+            for user_id in range(10)
+        }
+        self.assertGreater(self.db.flush(), 0)
+        self.assertEqual(self.db.stats()['mismatches'], 0)
+
+        backing = self.db.backing
+        backing.invalidate()
+        for user_id, (subscriptions, stats) in in_memory.items():
+            self.assertEqual(
+                [row[1:4] for row in subscriptions],
+                [row[1:4] for row in backing.get_user_subscriptions(user_id)]
+            )
+            self.assertEqual(stats, backing.get_user_stats(user_id))
+
+    def test_unflushed_row_can_be_deleted_by_its_provisional_id(self):
+        self.db.add_subscription(1, 'Okko', 29900, 1)
+        subscription_id = self.db.get_user_subscriptions(1)[0][0]
+        self.assertLess(subscription_id, 0)
+        self.assertEqual(self.db.delete_subscription_by_id(1, subscription_id), (True, 'Подписка удалена'))
+        self.db.flush()
+        self.assertEqual(self.db.backing.get_user_subscriptions(1), [])
+        self.assertEqual(self.db.backing.get_user_stats(1)['cancelled_count'], 1)
+
+    def test_flushed_rows_get_their_sqlite_ids(self):
+        self.db.add_subscription(1, 'Okko', 29900, 1)
+        provisional_id = self.db.get_user_subscriptions(1)[0][0]
+        self.db.flush()
+        stored_id = self.db.backing.get_user_subscriptions(1)[0][0]
+        self.assertGreater(stored_id, 0)
+        self.assertEqual(self.db.get_user_subscriptions(1)[0][0], stored_id)
+        # Кнопка, отправленная до записи, по-прежнему удаляет подписку
+        self.assertEqual(self.db.delete_subscription_by_id(1, provisional_id), (True, 'Подписка удалена'))
+        self.db.flush()
+        self.assertEqual(self.db.backing.get_user_subscriptions(1), [])
+
+    def fail_writes(self, times):
+        """Следующие times записей подписок в SQLite завершаются ошибкой"""
+        backing, original = self.db.backing, self.db.backing._add_subscription
+        failures = [times]
+
+        def add(*args):
+            if failures[0]:
+                failures[0] -= 1
+                return False, 'Ошибка при сохранении подписки'
+            return original(*args)
+
+        backing._add_subscription = add
+
+    def test_failed_flush_is_retried_without_losing_writes(self):
+        self.db.add_subscription(1, 'Okko', 29900, 1)
+        self.db.add_subscription(2, 'Кинопоиск', 39900, 1)
+        self.fail_writes(1)
+        self.assertEqual(self.db.flush(), 0)
+        # Подтвержденная пользователю запись остается в памяти и в очереди
+        self.assertEqual(len(self.db.get_user_subscriptions(1)), 1)
+        self.assertEqual(self.db.stats()['pending'], 2)
+
+        self.assertEqual(self.db.flush(), 2)
+        self.assertEqual(self.db.stats()['retries'], 1)
+        self.assertEqual(self.db.stats()['lost'], 0)
+        self.assertEqual(self.db.stats()['mismatches'], 0)
+        self.assertEqual(len(self.db.backing.get_user_subscriptions(1)), 1)
+        self.assertEqual(len(self.db.backing.get_user_subscriptions(2)), 1)
+
+    def test_writes_are_dropped_only_after_all_attempts(self):
+        self.db.add_subscription(1, 'Okko', 29900, 1)
+        self.fail_writes(self.db.MAX_ATTEMPTS)
+        for _ in range(self.db.MAX_ATTEMPTS - 1):
+            self.db.flush()
+            self.assertEqual(len(self.db.get_user_subscriptions(1)), 1)
+        self.db.flush()
+        self.assertEqual(self.db.stats()['lost'], 1)
+        # Запись признана потерянной: пользователь перечитывается из SQLite
+        self.assertEqual(self.db.get_user_subscriptions(1), [])
+        self.assertEqual(self.db.stats()['pending'], 0)
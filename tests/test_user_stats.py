@@ -0,0 +1,79 @@
+"""Агрегаты user_stats, поддерживаемые при каждой записи."""
+
+import random
+import unittest
+
+import pytest
+
+NAMES = ['Okko', 'Кинопоиск', 'Яндекс Плюс', 'Spotify', 'iCloud']
+CATEGORIES = ['кино', 'музыка', 'облако']
+
+
+@pytest.mark.usefixtures('bot_case')
+class UserStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = self.bot.db_manager
+
+    def expected(self, user_id):
+        """Агрегаты, посчитанные заново по строкам subscriptions"""
+        with self.db.read() as cursor:
+            cursor.execute(
+                'SELECT category, price, is_active FROM subscriptions WHERE user_id = ?', (user_id,)
+            )
+            rows = cursor.fetchall()
+        categories = {}
+        for category, price, is_active in rows:
+            if is_active:
+                categories[category] = categories.get(category, 0) + price
+        total = sum(price for _, price, is_active in rows if is_active)
+        return {
+            'active_count': sum(1 for row in rows if row[2]),
+            'monthly_total': total,
+            'cancelled_count': sum(1 for row in rows if not row[2]),
+            'yearly_total': total * 12,
+            'categories': categories,
+        }
+
+    def actual(self, user_id):
+        stats = dict(self.db.get_user_stats(user_id))
+        del stats['total_saved']
+        return stats
+
+    def test_add_price_change_and_reactivation(self):
+        self.db.add_subscription(1, 'Okko', 29900, 1, category='кино')
+        self.db.add_subscription(1, 'Spotify', 16900, 5, category='музыка')
+        self.assertEqual(self.actual(1), self.expected(1))
+        self.db.add_subscription(1, 'Okko', 39900, 1, category='кино')
+        self.assertEqual(self.actual(1)['monthly_total'], 39900 + 16900)
+        self.db.delete_subscription(1, 'Spotify')
+        self.assertEqual(self.actual(1), self.expected(1))
+        self.assertEqual(self.actual(1)['categories'], {'кино': 39900})
+        self.db.add_subscription(1, 'Spotify', 19900, 5, category='музыка')
+        self.assertEqual(self.actual(1), self.expected(1))
+        self.assertEqual(self.actual(1)['cancelled_count'], 0)
+
+    def test_random_writes_keep_stats_consistent(self):
+        rng = random.Random(7)
+        for _ in range(300):
+            user_id = rng.randint(1, 3)
+            action = rng.random()
+            if action < 0.55:
+                self.db.add_subscription(
+                    user_id, rng.choice(NAMES), rng.choice([9900, 19900, 29900]), rng.randint(1, 31),
+                    category=rng.choice(CATEGORIES)
+                )
+            elif action < 0.8:
+                self.db.delete_subscription(user_id, rng.choice(NAMES))
+            else:
+                rows = self.db.get_user_subscriptions(user_id)
+                if rows:
+                    self.db.delete_subscription_by_id(user_id, rng.choice(rows)[0])
+            self.assertEqual(self.actual(user_id), self.expected(user_id))
+
+    def test_delete_of_missing_subscription_changes_nothing(self):
+        self.db.add_subscription(1, 'Okko', 29900, 1)
+        before = self.actual(1)
+        self.assertFalse(self.db.delete_subscription(1, 'Spotify')[0])
+        self.assertFalse(self.db.delete_subscription_by_id(2, self.db.get_user_subscriptions(1)[0][0])[0])
+        self.assertEqual(self.actual(1), before)
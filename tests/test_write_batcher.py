@@ -0,0 +1,67 @@
+"""Групповая фиксация записей (WriteBatcher)."""
+
+import threading
+import unittest
+
+import pytest
+
+
+@pytest.mark.usefixtures('bot_case')
+class WriteBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = self.bot.db_manager
+        with self.db.transaction() as cursor:
+            cursor.execute('CREATE TABLE batch_values (value TEXT NOT NULL)')
+        # Пауза собирает все операции теста в один пакет
+        self.writer = self.bot.WriteBatcher(self.db, linger=0.3)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def insert(self, value, fail=False):
+        with self.db.transaction() as cursor:
+            cursor.execute('INSERT INTO batch_values (value) VALUES (?)', (value,))
+        if fail:
+            raise ValueError(value)
+        return value
+
+    def values(self):
+        with self.db.read() as cursor:
+            cursor.execute('SELECT value FROM batch_values ORDER BY value')
+            return [value for (value,) in cursor.fetchall()]
+
+    def test_failed_operation_does_not_roll_back_batch(self):
+        futures = [
+            self.writer.submit(self.insert, 'a'),
+            self.writer.submit(self.insert, 'b', True),
+            self.writer.submit(self.insert, 'c'),
+        ]
+        self.assertEqual(futures[0].result(5), 'a')
+        with self.assertRaises(ValueError):
+            futures[1].result(5)
+        self.assertEqual(futures[2].result(5), 'c')
+        self.assertEqual(self.values(), ['a', 'c'])
+        self.assertEqual((self.writer.batches, self.writer.operations), (1, 3))
+
+    def test_concurrent_writers_share_commits(self):
+        threads = [threading.Thread(target=self.writer.execute, args=(self.insert, str(n))) for n in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(self.values()), 20)
+        self.assertLess(self.writer.batches, 20)
+
+    def test_execute_inside_transaction_runs_inline(self):
+        with self.db.transaction():
+            self.writer.execute(self.insert, 'inline')
+            self.assertEqual(self.writer.operations, 0)
+        self.assertEqual(self.values(), ['inline'])
+
+    def test_closed_batcher_rejects_writes(self):
+        self.writer.submit(self.insert, 'last')
+        self.writer.close()
+        self.assertEqual(self.values(), ['last'])
+        with self.assertRaises(RuntimeError):
+            self.writer.submit(self.insert, 'late')